@@ -1,85 +1,226 @@
 from __future__ import annotations
 
+from collections import OrderedDict
+from collections.abc import Iterable
 from typing import Any
 
 import discord
 
-def is_admin(new_msg: (discord.Member | discord.Interaction), config: dict[str, Any]) -> bool:
-    permissions = config["permissions"]
+class PermissionPolicy:
+    """Permissions from config.yaml compiled into frozensets and precomputed flags.
 
+    Built once per config version (see `get_policy`); authorization decisions are
+    memoized per (user, roles, channel, parent, category, is_dm) key, so a role change
+    produces a new key and a config reload produces a new policy.
+    """
+
+    MAX_CACHED_DECISIONS: int = 10_000
+
+    def __init__(self, config: dict[str, Any]) -> None:
+        permissions = config["permissions"]
+        users, roles, channels = (
+            permissions["users"],
+            permissions["roles"],
+            permissions["channels"],
+        )
+
+        self.admin_user_ids = frozenset(users.get("admin_ids") or ())
+        self.admin_role_ids = frozenset(roles.get("admin_ids") or ())
+        self.allowed_user_ids = frozenset(users.get("allowed_ids") or ())
+        self.blocked_user_ids = frozenset(users.get("blocked_ids") or ())
+        self.allowed_role_ids = frozenset(roles.get("allowed_ids") or ())
+        self.blocked_role_ids = frozenset(roles.get("blocked_ids") or ())
+        self.allowed_channel_ids = frozenset(channels.get("allowed_ids") or ())
+        self.blocked_channel_ids = frozenset(channels.get("blocked_ids") or ())
+
+        self.allow_dms: bool = config.get("allow_dms", True)
+        self.allow_all_users_in_dms = not self.allowed_user_ids
+        self.allow_all_users_in_guilds = (
+            not self.allowed_user_ids and not self.allowed_role_ids
+        )
+        self.allow_all_channels = not self.allowed_channel_ids
+
+        self._decisions: dict[tuple[Any, ...], bool] = {}
+
+    def is_admin(self, user_id: int, role_ids: frozenset[int]) -> bool:
+        return user_id in self.admin_user_ids or not self.admin_role_ids.isdisjoint(
+            role_ids
+        )
+
+    def is_authorized(
+        self,
+        *,
+        user_id: int,
+        role_ids: frozenset[int],
+        channel_ids: tuple[int | None, int | None, int | None],
+        is_dm: bool,
+    ) -> bool:
+        key = (user_id, role_ids, channel_ids, is_dm)
+        decision = self._decisions.get(key)
+        if decision is None:
+            if len(self._decisions) >= self.MAX_CACHED_DECISIONS:
+                self._decisions.clear()
+            decision = self._decisions[key] = self._evaluate(
+                user_id, role_ids, channel_ids, is_dm
+            )
+        return decision
+
+    def _evaluate(
+        self,
+        user_id: int,
+        role_ids: frozenset[int],
+        channel_ids: tuple[int | None, int | None, int | None],
+        is_dm: bool,
+    ) -> bool:
+        user_is_admin = self.is_admin(user_id, role_ids)
+
+        allow_all_users = (
+            self.allow_all_users_in_dms if is_dm else self.allow_all_users_in_guilds
+        )
+        is_good_user = (
+            user_is_admin
+            or allow_all_users
+            or user_id in self.allowed_user_ids
+            or not self.allowed_role_ids.isdisjoint(role_ids)
+        )
+        is_bad_user = (
+            not is_good_user
+            or user_id in self.blocked_user_ids
+            or not self.blocked_role_ids.isdisjoint(role_ids)
+        )
+
+        is_good_channel = (
+            user_is_admin or self.allow_dms
+            if is_dm
+            else self.allow_all_channels
+            or not self.allowed_channel_ids.isdisjoint(channel_ids)
+        )
+        is_bad_channel = not is_good_channel or not self.blocked_channel_ids.isdisjoint(
+            channel_ids
+        )
+
+        return not (is_bad_user or is_bad_channel)
+
+    def is_channel_allowed(
+        self, channel_ids: tuple[int | None, int | None, int | None], is_dm: bool
+    ) -> bool:
+        """Whether anyone at all may use the bot in a channel."""
+        if is_dm:
+            return self.allow_dms or bool(self.admin_user_ids)
+        return (
+            self.allow_all_channels
+            or not self.allowed_channel_ids.isdisjoint(channel_ids)
+        ) and self.blocked_channel_ids.isdisjoint(channel_ids)
+
+
+# id(config) -> (config, compiled policy) for the most recently used config objects.
+# get_config returns the same object until the file changes, but after a reload some
+# holders (e.g. components configured before it) still pass the previous one; keeping
+# a few versions stops them from rebuilding each other's policy on every call. The
+# entry keeps its config alive, so the id can't be reused by another object.
+MAX_CACHED_POLICIES = 4
+_policy_cache: OrderedDict[int, tuple[dict[str, Any], PermissionPolicy]] = OrderedDict()
+
+
+def get_policy(config: dict[str, Any]) -> PermissionPolicy:
+    """The compiled policy of a config object, which must not be mutated afterwards."""
+    cached = _policy_cache.get(id(config))
+    if cached is not None:
+        _policy_cache.move_to_end(id(config))
+        return cached[1]
+
+    policy = PermissionPolicy(config)
+    _policy_cache[id(config)] = (config, policy)
+    if len(_policy_cache) > MAX_CACHED_POLICIES:
+        _policy_cache.popitem(last=False)
+    return policy
+
+
+def _role_ids(user: Any) -> frozenset[int]:
+    # Interaction.user / Message.author may be a plain User (no roles) in DMs
+    return frozenset(role.id for role in getattr(user, "roles", ()))
+
+
+def is_admin(
+    new_msg: (discord.Member | discord.Interaction), config: dict[str, Any]
+) -> bool:
     # Determine the user object
     if isinstance(new_msg, discord.Interaction):
         user = new_msg.user
     else:  # assume discord.Member
         user = new_msg
 
-    # Get role IDs safely; Interaction.user may not have roles if it's in a DM
-    role_ids = set(getattr(user, "roles", ()))
-    role_ids = {role.id for role in role_ids}
-
-    # Check user ID or role ID
-    user_is_admin = user.id in permissions["users"]["admin_ids"] or bool(role_ids & set(permissions["roles"]["admin_ids"]))
+    return get_policy(config).is_admin(user.id, _role_ids(user))
 
-    return user_is_admin
 
 def is_authorized(
     *, new_msg: discord.Message, config: dict[str, Any], is_dm: bool
 ) -> bool:
     """Check if user is authorized to use the bot."""
-
-    role_ids = set(role.id for role in getattr(new_msg.author, "roles", ()))
-    channel_ids = set(
-        filter(
-            None,
-            (
-                new_msg.channel.id,
-                getattr(new_msg.channel, "parent_id", None),
-                getattr(new_msg.channel, "category_id", None),
-            ),
-        )
+    return is_user_authorized(
+        user=new_msg.author, channel=new_msg.channel, config=config, is_dm=is_dm
     )
 
-    allow_dms = config.get("allow_dms", True)
-    permissions = config["permissions"]
-    (
-        (allowed_user_ids, blocked_user_ids),
-        (allowed_role_ids, blocked_role_ids),
-        (allowed_channel_ids, blocked_channel_ids),
-    ) = (
-        (perm["allowed_ids"], perm["blocked_ids"])
-        for perm in (
-            permissions["users"],
-            permissions["roles"],
-            permissions["channels"],
-        )
-    )
 
-    allow_all_users = (
-        not allowed_user_ids if is_dm else not allowed_user_ids and not allowed_role_ids
-    )
-    is_good_user = (
-        is_admin
-        or allow_all_users
-        or new_msg.author.id in allowed_user_ids
-        or any(id in allowed_role_ids for id in role_ids)
-    )
-    is_bad_user = (
-        not is_good_user
-        or new_msg.author.id in blocked_user_ids
-        or any(id in blocked_role_ids for id in role_ids)
+def is_user_authorized(
+    *, user: Any, channel: Any, config: dict[str, Any], is_dm: bool
+) -> bool:
+    """Same check as is_authorized, for events that carry a user and channel only."""
+    return get_policy(config).is_authorized(
+        user_id=user.id,
+        role_ids=_role_ids(user),
+        channel_ids=(
+            channel.id,
+            getattr(channel, "parent_id", None),
+            getattr(channel, "category_id", None),
+        ),
+        is_dm=is_dm,
     )
 
-    allow_all_channels = not allowed_channel_ids
-    is_good_channel = (
-        is_admin or allow_dms
-        if is_dm
-        else allow_all_channels or any(id in allowed_channel_ids for id in channel_ids)
-    )
-    is_bad_channel = not is_good_channel or any(
-        id in blocked_channel_ids for id in channel_ids
+
+def is_channel_allowed(*, channel: Any, config: dict[str, Any], is_dm: bool) -> bool:
+    """The channel part of is_authorized, for any user."""
+    return get_policy(config).is_channel_allowed(
+        (
+            channel.id,
+            getattr(channel, "parent_id", None),
+            getattr(channel, "category_id", None),
+        ),
+        is_dm,
     )
 
-    return not (is_bad_user or is_bad_channel)
+
+TIME_GRANULARITY_FORMATS: dict[str, str] = {
+    "second": "%H:%M:%S %Z%z",
+    "minute": "%H:%M %Z%z",
+    "hour": "%H:00 %Z%z",
+}
+
+VOLATILE_PLACEHOLDERS: tuple[str, ...] = ("{date}", "{time}")
+
+
+def split_volatile_prompt(system_prompt: str) -> tuple[str, str]:
+    """Split a system prompt into (stable, volatile) parts.
+
+    Lines that reference a volatile placeholder (`{date}`, `{time}`) are moved to the
+    volatile part so the stable part stays byte-identical between requests.
+    """
+    stable_lines: list[str] = []
+    volatile_lines: list[str] = []
+    for line in (system_prompt or "").splitlines():
+        if any(p in line for p in VOLATILE_PLACEHOLDERS):
+            volatile_lines.append(line)
+        else:
+            stable_lines.append(line)
+    return "\n".join(stable_lines), "\n".join(volatile_lines)
+
+
+def build_users_listing(members: Iterable[discord.Member]) -> str:
+    """List guild members in a deterministic (ID) order for the `{users}` placeholder."""
+    return "\n".join(
+        f"username: {member.name}, nickname: {member.display_name}, mention: <@{member.id}>"
+        for member in sorted(members, key=lambda m: m.id)
+    )
 
 
 def format_system_prompt(
@@ -87,6 +228,7 @@ def format_system_prompt(
     *,
     accept_usernames: bool,
     users_listing: str | None = None,
+    time_granularity: str = "second",
 ) -> str:
     """Format system prompt with username support if needed."""
     from datetime import datetime
@@ -95,9 +237,12 @@ def format_system_prompt(
         return ""
 
     now = datetime.now().astimezone()
+    time_format = TIME_GRANULARITY_FORMATS.get(
+        time_granularity, TIME_GRANULARITY_FORMATS["second"]
+    )
     formatted = (
         system_prompt.replace("{date}", now.strftime("%B %d %Y"))
-        .replace("{time}", now.strftime("%H:%M:%S %Z%z"))
+        .replace("{time}", now.strftime(time_format))
         .strip()
     )
 
@@ -0,0 +1,360 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import sys
+import time
+from collections import Counter
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any
+
+import yaml
+
+from .auth import format_system_prompt
+from .config import get_config
+from .log import setup_logging
+from .metrics import percentile
+from .pipeline import provider_request_options
+from .providers import close_openai_clients, get_openai_client
+from .streaming import chat_deltas, close_stream, open_chat_stream
+
+DEFAULT_PROMPTS: list[str] = [
+    "In one sentence, what is a context window?",
+    "Explain how a hash map handles collisions, with a short example.",
+    "Write a Python function that returns the n-th Fibonacci number iteratively.",
+    "List five tips for writing clear commit messages.",
+]
+
+
+@dataclass
+class RequestResult:
+    ok: bool
+    # Seconds from sending the request to the first content or reasoning token
+    ttft: float | None = None
+    latency: float = 0.0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # Whether the token counts came from the provider's usage chunk (else ~4 chars/token)
+    reported_usage: bool = False
+    error: str | None = None
+
+
+@dataclass
+class ModelResult:
+    model: str
+    requests: int
+    errors: int
+    error_rate: float
+    ttft_p50: float
+    ttft_p95: float
+    latency_p50: float
+    latency_p95: float
+    latency_p99: float
+    # Completion tokens per second after the first token, per request
+    tokens_per_second_p50: float
+    tokens_per_second_p95: float
+    mean_prompt_tokens: float
+    mean_completion_tokens: float
+    usage_reported: bool
+    error_types: dict[str, int] = field(default_factory=dict)
+
+
+def load_prompts(path: str | None) -> list[list[dict[str, Any]]]:
+    """Prompts as chat messages. A file holds a YAML/JSON list whose items are either a
+    user message string or a list of chat messages."""
+    items: list[Any] = DEFAULT_PROMPTS
+    if path is not None:
+        with open(path, encoding="utf-8") as file:
+            items = yaml.safe_load(file) or []
+    prompts = [
+        [dict(role="user", content=item)] if isinstance(item, str) else list(item)
+        for item in items
+    ]
+    if not prompts:
+        raise SystemExit(f"No prompts in {path}")
+    return prompts
+
+
+async def _measure(
+    cfg: dict[str, Any],
+    provider_slash_model: str,
+    messages: list[dict[str, Any]],
+    options: argparse.Namespace,
+) -> RequestResult:
+    """Stream one completion the way the bot does and time it."""
+    _, backend = provider_request_options(cfg, provider_slash_model)
+    extra_body = dict(backend.extra_body or {})
+    if options.max_tokens:
+        extra_body.setdefault("max_tokens", options.max_tokens)
+
+    result = RequestResult(ok=False)
+    text_chars = 0
+    stream: Any = None
+    start = time.perf_counter()
+    try:
+        async with asyncio.timeout(options.timeout):
+            stream = await open_chat_stream(
+                backend, messages, extra_body, fast_stream=cfg.get("fast_stream", False)
+            )
+            async for delta in chat_deltas(stream):
+                if (delta.content or delta.reasoning) and result.ttft is None:
+                    result.ttft = time.perf_counter() - start
+                text_chars += len(delta.content) + len(delta.reasoning)
+                if delta.usage is not None:
+                    result.prompt_tokens, result.completion_tokens, _ = delta.usage
+                    result.reported_usage = True
+        result.ok = True
+    except Exception as e:
+        result.error = type(e).__name__
+        logging.debug("Request to %s failed", provider_slash_model, exc_info=True)
+    finally:
+        await close_stream(stream)
+    result.latency = time.perf_counter() - start
+    if not result.reported_usage:
+        result.completion_tokens = round(text_chars / 4)
+    return result
+
+
+def _summarize(model: str, results: list[RequestResult]) -> ModelResult:
+    ok = [r for r in results if r.ok]
+    ttfts = [r.ttft for r in ok if r.ttft is not None]
+    latencies = [r.latency for r in ok]
+    rates = [
+        r.completion_tokens / (r.latency - r.ttft)
+        for r in ok
+        if r.ttft is not None and r.latency > r.ttft and r.completion_tokens
+    ]
+    return ModelResult(
+        model=model,
+        requests=len(results),
+        errors=len(results) - len(ok),
+        error_rate=(len(results) - len(ok)) / len(results) if results else 0.0,
+        ttft_p50=percentile(ttfts, 50),
+        ttft_p95=percentile(ttfts, 95),
+        latency_p50=percentile(latencies, 50),
+        latency_p95=percentile(latencies, 95),
+        latency_p99=percentile(latencies, 99),
+        tokens_per_second_p50=percentile(rates, 50),
+        tokens_per_second_p95=percentile(rates, 95),
+        mean_prompt_tokens=sum(r.prompt_tokens for r in ok) / len(ok) if ok else 0.0,
+        mean_completion_tokens=(
+            sum(r.completion_tokens for r in ok) / len(ok) if ok else 0.0
+        ),
+        usage_reported=bool(ok) and all(r.reported_usage for r in ok),
+        error_types=dict(Counter(r.error for r in results if r.error is not None)),
+    )
+
+
+async def bench_model(
+    cfg: dict[str, Any],
+    provider_slash_model: str,
+    prompts: list[list[dict[str, Any]]],
+    options: argparse.Namespace,
+) -> ModelResult:
+    system_prompt = format_system_prompt(
+        cfg.get("system_prompt", "") or "", accept_usernames=False
+    )
+    system = [dict(role="system", content=system_prompt)] if system_prompt else []
+    semaphore = asyncio.Semaphore(options.concurrency)
+
+    async def one(messages: list[dict[str, Any]]) -> RequestResult:
+        async with semaphore:
+            return await _measure(cfg, provider_slash_model, system + messages, options)
+
+    # Not counted: the first request pays for connection setup that a running bot
+    # has already done
+    for messages in itertools.islice(itertools.cycle(prompts), options.warmup):
+        await _measure(cfg, provider_slash_model, system + messages, options)
+
+    chosen = itertools.islice(itertools.cycle(prompts), options.requests)
+    results = await asyncio.gather(*(one(messages) for messages in chosen))
+    return _summarize(provider_slash_model, results)
+
+
+async def run_bench(options: argparse.Namespace) -> list[ModelResult]:
+    """Measure time to first token, throughput and errors for each configured model.
+
+    Requests go through the same provider clients and stream decoding as replies, with
+    the configured system prompt and model parameters. Models are measured one after
+    another: `--warmup` uncounted requests, then `--requests` requests with at most
+    `--concurrency` in flight. With `--offline`, every provider is pointed at a local
+    fake server instead.
+    """
+    cfg = get_config(options.config)
+    logging_cfg = (cfg.get("logging") or {}) | dict(level=options.log_level)
+    setup_logging(cfg | dict(logging=logging_cfg))
+    models = options.models or list(cfg.get("models") or {})
+    providers = cfg.get("providers") or {}
+    if unknown := [m for m in models if m.split("/", 1)[0] not in providers]:
+        raise SystemExit(f"No provider configured for: {', '.join(unknown)}")
+    prompts = load_prompts(options.prompts)
+
+    fake_openai = None
+    if options.offline:
+        from .fakes import FakeOpenAI
+
+        fake_openai = FakeOpenAI(
+            latency=options.latency,
+            token_interval=options.token_interval,
+            completion_tokens=options.tokens,
+        )
+        await fake_openai.start()
+        offline = dict(base_url=fake_openai.base_url, api_key="offline")
+        cfg = cfg | dict(
+            providers={
+                name: (provider or {}) | offline for name, provider in providers.items()
+            }
+        )
+
+    results: list[ModelResult] = []
+    try:
+        # Import the provider SDK up front so it isn't counted in the first request
+        for provider in cfg["providers"].values():
+            get_openai_client(provider)
+
+        print(_format_header())
+        for model in models:
+            result = await bench_model(cfg, model, prompts, options)
+            results.append(result)
+            print(_format_row(result), flush=True)
+    finally:
+        await close_openai_clients()
+        if fake_openai is not None:
+            await fake_openai.stop()
+
+    if options.json:
+        await asyncio.to_thread(
+            Path(options.json).write_text,
+            json.dumps([asdict(r) for r in results], indent=2),
+            encoding="utf-8",
+        )
+    if any(r.error_rate > options.max_error_rate for r in results):
+        sys.exit(1)
+    return results
+
+
+_COLUMNS = (
+    ("model", 32),
+    ("ok/err", 8),
+    ("ttft p50/p95 s", 16),
+    ("latency p50/p95/p99 s", 23),
+    ("tok/s p50/p95", 15),
+    ("prompt", 8),
+    ("compl.", 8),
+)
+
+
+def _format_header() -> str:
+    return " ".join(
+        name.ljust(width) if i == 0 else name.rjust(width)
+        for i, (name, width) in enumerate(_COLUMNS)
+    )
+
+
+def _format_row(r: ModelResult) -> str:
+    estimated = "" if r.usage_reported else "~"
+    values = (
+        r.model,
+        f"{r.requests - r.errors}/{r.errors}",
+        f"{r.ttft_p50:.2f}/{r.ttft_p95:.2f}",
+        f"{r.latency_p50:.2f}/{r.latency_p95:.2f}/{r.latency_p99:.2f}",
+        f"{estimated}{r.tokens_per_second_p50:.0f}/{r.tokens_per_second_p95:.0f}",
+        f"{r.mean_prompt_tokens:.0f}",
+        f"{estimated}{r.mean_completion_tokens:.0f}",
+    )
+    row = " ".join(
+        v.ljust(width) if i == 0 else v.rjust(width)
+        for i, (v, (_, width)) in enumerate(zip(values, _COLUMNS))
+    )
+    if r.error_types:
+        row += "  " + ", ".join(f"{k} x{v}" for k, v in r.error_types.items())
+    return row
+
+
+def add_parser(subparsers: Any) -> None:
+    parser = subparsers.add_parser(
+        "bench",
+        help="Measure time to first token and throughput of the configured models",
+        description=run_bench.__doc__,
+    )
+    parser.add_argument(
+        "models",
+        nargs="*",
+        help="<provider>/<model> entries to measure (default: every model in the config)",
+    )
+    parser.add_argument("--config", default="config.yaml")
+    parser.add_argument(
+        "--prompts",
+        help="YAML or JSON list of prompts: user messages, or lists of chat messages "
+        "(default: a small built-in set)",
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=20,
+        help="Requests per model, cycling through the prompts (default: 20)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="Requests in flight per model (default: 4)",
+    )
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=1,
+        help="Uncounted requests per model before measuring (default: 1)",
+    )
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        default=256,
+        help="max_tokens per request unless the model's parameters set it; 0 for no "
+        "limit (default: 256)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=120,
+        help="Seconds before a request counts as failed (default: 120)",
+    )
+    parser.add_argument(
+        "--max-error-rate",
+        type=float,
+        default=0.0,
+        help="Exit with status 1 when a model's error rate is above this (default: 0)",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Point every provider at a local fake server (no network, e.g. for CI)",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.5,
+        help="Fake provider time to first token in seconds, with --offline (default: 0.5)",
+    )
+    parser.add_argument(
+        "--token-interval",
+        type=float,
+        default=0.02,
+        help="Fake provider seconds between tokens, with --offline (default: 0.02)",
+    )
+    parser.add_argument(
+        "--tokens",
+        type=int,
+        default=200,
+        help="Fake provider completion tokens, with --offline (default: 200)",
+    )
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", help="Also write per-model results to this JSON file")
+    parser.set_defaults(func=lambda options: asyncio.run(run_bench(options)))
+
+
+__all__ = ["ModelResult", "RequestResult", "add_parser", "run_bench"]
@@ -1,75 +1,120 @@
 from __future__ import annotations
 
+import argparse
 import asyncio
+import contextlib
+import io
 import logging
-from typing import Any, Literal, cast
+import signal
+import time
+from typing import Any, Literal
 
 import discord
 from discord.app_commands import Choice
 from discord.ext import commands
 import httpx
-from openai import AsyncOpenAI
-from openai.types.chat import ChatCompletionMessageParam
 
 from .config import get_config
 from .constants import (
-    PROVIDERS_SUPPORTING_USERNAMES,
-    EMBED_DESCRIPTION_MAX_LENGTH,
-    STREAMING_INDICATOR,
-    MAX_MESSAGE_NODES,
+    STOP_REACTIONS,
+    CANCEL_REASON_MESSAGE_DELETED,
+    CANCEL_REASON_STOPPED_BY_USER,
+    CANCEL_REASON_STOPPED_BY_ADMIN,
+    CANCEL_REASON_RESTART,
+    WORKERS_BUSY_TEXT,
+    QUOTA_EXCEEDED_USER_TEMPLATE,
+    QUOTA_EXCEEDED_GUILD_TEMPLATE,
 )
-from .discord_utils import build_warnings_embed
-from .messages import MsgNode, build_conversation_context
-from .auth import is_authorized, is_admin, format_system_prompt
-from .streaming import stream_and_reply
-
-
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
-
-# Global state
-config = get_config()
-curr_model = next(iter(config["models"]))
+from .capture import recorder
+from .coalesce import coalescer
+from .discord_utils import sync_command_tree
+from .health import HealthServer, loop_monitor
+from .history import message_history
+from .messages import MsgNode, invalidate_msg_node
+from .auth import is_authorized, is_admin, is_user_authorized
+from .log import bind_request, setup_logging
+from .tracing import NOOP_TRACE, tracer
+from .providers import close_openai_clients, provider_health, provider_of
+from .tasks import ActiveRequest, RequestRegistry
+from .pipeline import generate_reply, users_listing_for
+from .memory import channel_memory
+from .prewarm import prewarmer
+from .profiling import profiler
+from .quotas import quotas
+from .workers import WorkerPool
+from . import bench, health, loadtest, replay
+
+
+# Global state (populated in main())
+process_start = time.perf_counter()
+config: dict[str, Any] = {}
+curr_model: str = ""
 msg_nodes: dict[int, MsgNode] = {}
-running_tasks: dict[int, asyncio.Task] = {}
+active_requests = RequestRegistry()
+worker_pool: WorkerPool | None = None
+health_server: HealthServer | None = None
+startup_done = False
+# Set on SIGTERM/SIGINT: new messages are ignored while in-flight replies finish
+draining = False
+shutdown_task: asyncio.Task | None = None
 
 # Discord bot setup
 intents = discord.Intents.all()
-activity = discord.CustomActivity(
-    name=(config["status_message"] or "github.com/GrainWare/llmcord")[:128]
-)
-discord_bot = commands.Bot(intents=intents, activity=activity, command_prefix="")
+discord_bot = commands.Bot(intents=intents, command_prefix="")
 
 # Attachment handling
 httpx_client: httpx.AsyncClient | None = None
 
 
 @discord_bot.tree.command(
-    name="stop", description="Stops all current messages in case they loop"
-)  # Admin command to "kill" all messages being worked on
-async def stop_command(interaction: discord.Interaction) -> None:
-    # Permission check
-    if is_admin(interaction, config):
-        if not running_tasks:
-            await interaction.response.send_message(
-                "No running tasks to stop.", ephemeral=True
-            )
-            return
-
-        for task in list(running_tasks.values()):
-            task.cancel()
+    name="stop", description="Stops running replies (all, one message, or one user's)"
+)  # Command to "kill" messages being worked on; non-admins can only stop their own
+@discord.app_commands.describe(
+    message_id="ID of the triggering message or of a reply to stop",
+    user="Stop all replies requested by this user",
+)
+async def stop_command(
+    interaction: discord.Interaction,
+    message_id: str | None = None,
+    user: discord.User | None = None,
+) -> None:
+    user_is_admin = is_admin(interaction, config)
+    if not user_is_admin and user is not None and user.id != interaction.user.id:
+        await interaction.response.send_message(
+            "You don't have permission to stop other users' replies", ephemeral=True
+        )
+        return
 
-        for task in list(running_tasks.values()):
-            try:
-                await task
-            except asyncio.CancelledError:
-                pass
+    if message_id is not None:
+        found = active_requests.find(int(message_id)) if message_id.isdigit() else None
+        targets = [found] if found is not None else []
     else:
-        await interaction.response.send_message("You don't have permission to stop tasks", ephemeral=True)
+        targets = active_requests.items()
+    if user is not None:
+        targets = [(t, r) for t, r in targets if r.requester_id == user.id]
+    if not user_is_admin:
+        targets = [(t, r) for t, r in targets if r.requester_id == interaction.user.id]
+
+    if not targets:
+        await interaction.response.send_message(
+            "No running tasks to stop.", ephemeral=True
+        )
         return
 
-    running_tasks.clear()
+    reason = (
+        CANCEL_REASON_STOPPED_BY_ADMIN
+        if user_is_admin
+        else CANCEL_REASON_STOPPED_BY_USER
+    )
+    for trigger_id, _ in targets:
+        active_requests.cancel(trigger_id, reason)
+
+    # Let the replies finalize, but answer within Discord's interaction deadline
+    await asyncio.wait([request.task for _, request in targets], timeout=2)
+
+    s = "" if len(targets) == 1 else "s"
     await interaction.response.send_message(
-        "All running tasks have been cancelled.", ephemeral=True
+        f"Cancelled {len(targets)} running task{s}.", ephemeral=True
     )
 
 
@@ -100,6 +145,161 @@ async def prompt_command(
     )
 
 
+@discord_bot.tree.command(
+    name="profile", description="Profiles the bot's CPU or memory use for a few seconds"
+)  # Admin command to see where time or memory goes while the bot keeps serving
+@discord.app_commands.describe(
+    kind="Sample CPU stacks or trace memory allocations",
+    seconds="How long to profile for",
+)
+async def profile_command(
+    interaction: discord.Interaction,
+    kind: Literal["cpu", "memory"] = "cpu",
+    seconds: int = 10,
+) -> None:
+    # Permission check
+    if not is_admin(interaction, config):
+        await interaction.response.send_message(
+            "You don't have permission to profile the bot", ephemeral=True
+        )
+        return
+    if not profiler.enabled:
+        await interaction.response.send_message(
+            "Profiling is disabled. Set `profiling.enabled` in config.yaml to enable it.",
+            ephemeral=True,
+        )
+        return
+    if profiler.running is not None:
+        await interaction.response.send_message(
+            f"A {profiler.running} profile is already running, try again when it finishes.",
+            ephemeral=True,
+        )
+        return
+
+    # Profiles outlast Discord's 3 second deadline for a response
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    try:
+        profile = await profiler.run(kind, seconds)
+    except RuntimeError:
+        # Another /profile started while this one was deferring
+        await interaction.followup.send(
+            f"A {profiler.running} profile is already running, try again when it finishes.",
+            ephemeral=True,
+        )
+        return
+    await interaction.followup.send(
+        f"```{profile.summary[: 2000 - 6]}```",
+        file=discord.File(io.BytesIO(profile.data), filename=profile.filename),
+        ephemeral=True,
+    )
+
+
+@discord_bot.tree.command(
+    name="traces", description="Shows the slowest recently traced requests"
+)  # Admin command to dump the slowest sampled request traces
+@discord.app_commands.describe(count="How many traces to show")
+async def traces_command(interaction: discord.Interaction, count: int = 3) -> None:
+    # Permission check
+    if not is_admin(interaction, config):
+        await interaction.response.send_message(
+            "You don't have permission to view traces", ephemeral=True
+        )
+        return
+
+    slowest = tracer.slowest(max(1, min(count, 10)))
+    if not slowest:
+        output = "No traces recorded. Set `tracing.sample_rate` in config.yaml to enable tracing."
+    else:
+        output = "\n\n".join(f"```{trace.summary()}```" for trace in slowest)
+    await interaction.response.send_message(output[:2000], ephemeral=True)
+
+
+@discord_bot.tree.command(
+    name="usage", description="Shows the top token consumers"
+)  # Admin command to list the heaviest users or servers from the usage ledger
+@discord.app_commands.describe(
+    period="How far back to look",
+    by="Rank users or servers",
+    count="How many to show",
+)
+async def usage_command(
+    interaction: discord.Interaction,
+    period: Literal["day", "week", "month"] = "day",
+    by: Literal["user", "guild"] = "user",
+    count: int = 10,
+) -> None:
+    # Permission check
+    if not is_admin(interaction, config):
+        await interaction.response.send_message(
+            "You don't have permission to view usage", ephemeral=True
+        )
+        return
+    if not quotas.ledger.is_open:
+        await interaction.response.send_message(
+            "The usage ledger is disabled. Set `quotas.ledger` in config.yaml to enable it.",
+            ephemeral=True,
+        )
+        return
+
+    days = dict(day=1, week=7, month=30)[period]
+    rows = await quotas.top_consumers(
+        by, since=time.time() - days * 86400, limit=max(1, min(count, 25))
+    )
+    if not rows:
+        output = f"No usage recorded in the last {period}."
+    else:
+        lines = []
+        for rank, (target_id, prompt, completion, requests) in enumerate(rows, 1):
+            if by == "user":
+                name = f"<@{target_id}>"
+            else:
+                guild = discord_bot.get_guild(target_id)
+                name = guild.name if guild else str(target_id)
+            lines.append(
+                f"{rank}. {name}: {prompt + completion:,} tokens "
+                f"({prompt:,} prompt, {completion:,} completion) in {requests:,} requests"
+            )
+        output = f"Top {by}s in the last {period}:\n" + "\n".join(lines)
+    await interaction.response.send_message(
+        output[:2000],
+        ephemeral=True,
+        allowed_mentions=discord.AllowedMentions.none(),
+    )
+
+
+@discord_bot.tree.command(
+    name="providers", description="Shows provider health and open circuit breakers"
+)  # Admin command to see which providers are failing fast
+async def providers_command(interaction: discord.Interaction) -> None:
+    # Permission check
+    if not is_admin(interaction, config):
+        await interaction.response.send_message(
+            "You don't have permission to view provider health", ephemeral=True
+        )
+        return
+
+    if not provider_health.enabled:
+        output = "Circuit breakers are disabled. Set `circuit_breaker.enabled` in config.yaml to enable them."
+    else:
+        status = provider_health.status()
+        lines = []
+        for provider in config.get("providers") or {}:
+            state = status.get(provider)
+            if state is None or state["state"] == "closed":
+                failures = state["failures"] if state else 0
+                s = "" if failures == 1 else "s"
+                recent = f" ({failures} recent failure{s})" if failures else ""
+                lines.append(f"🟢 `{provider}`: up{recent}")
+            else:
+                lines.append(
+                    f"🔴 `{provider}`: down since <t:{state['since']}:R>, "
+                    f"last probed <t:{state['last_probe'] or state['since']}:R>\n"
+                    f"  {state['last_error']}"
+                )
+        output = "\n".join(lines) or "No providers configured."
+    await interaction.response.send_message(output[:2000], ephemeral=True)
+
+
 @discord_bot.tree.command(name="model", description="View or switch the current model")
 async def model_command(interaction: discord.Interaction, model: str) -> None:
     global curr_model
@@ -135,13 +335,16 @@ async def model_autocomplete(
     if curr_str == "":
         config = await asyncio.to_thread(get_config)
 
+    def down(model: str) -> str:
+        return "" if provider_health.available(provider_of(model)) else " (unavailable)"
+
     choices = (
-        [Choice(name=f"◉ {curr_model} (current)", value=curr_model)]
+        [Choice(name=f"◉ {curr_model} (current){down(curr_model)}", value=curr_model)]
         if curr_str.lower() in curr_model.lower()
         else []
     )
     choices += [
-        Choice(name=f"○ {model}", value=model)
+        Choice(name=f"○ {model}{down(model)}", value=model)
         for model in config["models"]
         if model != curr_model and curr_str.lower() in model.lower()
     ][:24]
@@ -151,19 +354,53 @@ async def model_autocomplete(
 
 @discord_bot.event
 async def on_ready() -> None:
+    global startup_done
+
+    # on_ready also fires after gateway reconnects; one-time startup work only runs once
+    if startup_done:
+        logging.info("Gateway ready again after reconnect")
+        # A new session doesn't replay what was sent while disconnected
+        message_history.clear()
+        return
+    startup_done = True
+
     if client_id := config["client_id"]:
         logging.info(
             f"\n\nBOT INVITE URL:\nhttps://discord.com/oauth2/authorize?client_id={client_id}&permissions=377957190720&scope=bot\n"
         )
-    await discord_bot.tree.sync()
+    try:
+        await sync_command_tree(
+            discord_bot.tree,
+            application_id=discord_bot.application_id,
+            state_dir=config.get("state_dir", ".llmcord"),
+        )
+    except discord.HTTPException:
+        logging.exception("Failed to sync command tree")
+
+    logging.info(
+        "Ready in %.2fs (cold start)",
+        time.perf_counter() - process_start,
+        extra={"cold_start_seconds": time.perf_counter() - process_start},
+    )
+
+
+def is_ready() -> bool:
+    """Whether this instance is connected and accepting new messages."""
+    return startup_done and not draining and not discord_bot.is_closed()
 
 
 @discord_bot.event
 async def on_message(new_msg: discord.Message) -> None:
-    if new_msg.author.bot:
+    # Every message (the bot's own too) so the history has no gaps
+    message_history.observe(new_msg)
+    if new_msg.author.bot or draining:
         return
 
+    prewarmer.observe(new_msg)
+    channel_memory.observe(new_msg)
+
     async def _handler():
+        trace: Any = NOOP_TRACE
         try:
             assert discord_bot.user is not None
 
@@ -171,155 +408,393 @@ async def on_message(new_msg: discord.Message) -> None:
             if not is_dm and discord_bot.user not in new_msg.mentions:
                 return
 
-            cfg = await asyncio.to_thread(get_config)
-            if not is_authorized(new_msg=new_msg, config=cfg, is_dm=is_dm):
-                return
-
-            provider_slash_model = curr_model
-            provider, model = provider_slash_model.removesuffix(":vision").split("/", 1)
-
-            provider_config = cfg["providers"][provider]
-            base_url = provider_config["base_url"]
-            api_key = provider_config.get("api_key", "sk-no-key-required")
-            openai_client = AsyncOpenAI(base_url=base_url, api_key=api_key)
-
-            model_parameters = cfg["models"].get(provider_slash_model, None)
-
-            extra_headers = provider_config.get("extra_headers", None)
-            extra_query = provider_config.get("extra_query", None)
-            extra_body = (provider_config.get("extra_body", None) or {}) | (
-                model_parameters or {}
+            bind_request(
+                request_id=str(new_msg.id),
+                guild_id=new_msg.guild.id if new_msg.guild else None,
+                channel_id=new_msg.channel.id,
+                user_id=new_msg.author.id,
             )
-
-            try:
-                existing_stream_options = cast(
-                    dict[str, Any], extra_body.get("stream_options", {})
-                )
-            except Exception:
-                existing_stream_options = {}
-            extra_body["stream_options"] = {
-                **existing_stream_options,
-                "include_usage": True,
-            }
-
-            accept_images = curr_model.endswith(":vision")
-            accept_usernames = any(
-                x in provider_slash_model.lower()
-                for x in PROVIDERS_SUPPORTING_USERNAMES
+            timings: dict[str, float] = {}
+            trace = tracer.start(
+                "on_message", new_msg.id, channel_id=new_msg.channel.id
             )
+            stage_start = time.perf_counter()
+
+            with trace.span("get_config"):
+                cfg = await asyncio.to_thread(get_config)
+            tracer.configure(cfg)
+            prewarmer.configure(cfg)
+            quotas.configure(cfg)
+            recorder.configure(cfg)
+            coalescer.configure(cfg)
+            message_history.configure(cfg)
+            timings["config"] = time.perf_counter() - stage_start
+
+            stage_start = time.perf_counter()
+            with trace.span("is_authorized"):
+                authorized = is_authorized(new_msg=new_msg, config=cfg, is_dm=is_dm)
+            timings["auth"] = time.perf_counter() - stage_start
+            if not authorized:
+                trace = NOOP_TRACE
+                return
+
+            # /model may switch models while this request is running
+            model = curr_model
+            if not await admit_within_quota(new_msg, model):
+                trace = NOOP_TRACE
+                return
 
-            max_text = cfg.get("max_text", 100000)
-            max_images = cfg.get("max_images", 5) if accept_images else 0
-            max_messages = cfg.get("max_messages", 25)
+            merged = coalescer.join(new_msg, active_requests)
+            with trace.span("coalesce"):
+                await coalescer.settle(new_msg)
 
-            assert httpx_client is not None, "HTTPX client not initialized"
-            messages, user_warnings = await build_conversation_context(
+            async with recorder.record(
                 new_msg=new_msg,
+                cfg=cfg,
+                provider_slash_model=model,
                 bot_user=discord_bot.user,
-                accept_images=accept_images,
-                accept_usernames=accept_usernames,
-                experimental_message_formatting=cfg.get(
-                    "experimental_message_formatting", False
-                ),
-                max_text=max_text,
-                max_images=max_images,
-                max_messages=max_messages,
                 msg_nodes=msg_nodes,
-                httpx_client=httpx_client,
-            )
-
-            logging.info(
-                f"Message received (user ID: {new_msg.author.id}, attachments: {len(new_msg.attachments)}, conversation length: {len(messages)}):\n{new_msg.content}"
-            )
-
-            if system_prompt := format_system_prompt(
-                cfg.get("system_prompt", ""),
-                accept_usernames=accept_usernames,
-                users_listing=(
-                    "\n".join(
-                        [
-                            f"username: {member.name}, nickname: {member.display_name}, mention: <@{member.id}>"
-                            for member in (
-                                new_msg.guild.members if new_msg.guild else []
-                            )
-                        ]
-                    )
-                ),
             ):
-                messages.append(dict(role="system", content=system_prompt))
-
-            embed = build_warnings_embed(user_warnings)
-            use_plain_responses = cfg.get("use_plain_responses", False)
-            max_message_length = (
-                2000
-                if use_plain_responses
-                else (EMBED_DESCRIPTION_MAX_LENGTH - len(STREAMING_INDICATOR))
-            )
-
-            try:
-                response_msgs, response_contents = await stream_and_reply(
+                await generate_reply(
                     new_msg=new_msg,
-                    openai_client=openai_client,
-                    model=model,
-                    display_model=provider_slash_model,
-                    messages=cast(list[ChatCompletionMessageParam], messages),
-                    embed=embed,
-                    use_plain_responses=use_plain_responses,
-                    max_message_length=max_message_length,
-                    extra_headers=extra_headers,
-                    extra_query=extra_query,
-                    extra_body=extra_body,
+                    cfg=cfg,
+                    provider_slash_model=model,
+                    bot_user=discord_bot.user,
                     msg_nodes=msg_nodes,
-                    block_response_regex=cfg.get("block_response_regex"),
-                    reply_length_cap=cfg.get("reply_length_cap"),
+                    httpx_client=httpx_client,
+                    users_listing=users_listing_for(new_msg, cfg),
+                    timings=timings,
+                    trace=trace,
+                    on_response_msg=lambda msg: track_response(new_msg, msg),
+                    on_usage=lambda prompt, completion, cached: quotas.record(
+                        user_id=new_msg.author.id,
+                        guild_id=new_msg.guild.id if new_msg.guild else None,
+                        model=model,
+                        prompt_tokens=prompt,
+                        completion_tokens=completion,
+                        cached_tokens=cached,
+                    ),
+                    merged=merged,
                 )
-            except asyncio.CancelledError:
-                logging.info(f"Task for message {new_msg.id} was cancelled.")
-                raise
-            except Exception:
-                logging.exception("Error while generating response")
-                return
-
-            for response_msg in response_msgs:
-                msg_nodes[response_msg.id].text = "".join(response_contents)
-                msg_nodes[response_msg.id].lock.release()
-
-            if (num_nodes := len(msg_nodes)) > MAX_MESSAGE_NODES:
-                for msg_id in sorted(msg_nodes.keys())[: num_nodes - MAX_MESSAGE_NODES]:
-                    node = msg_nodes.get(msg_id)
-                    if node is None:
-                        continue
-                    async with node.lock:
-                        msg_nodes.pop(msg_id, None)
 
         except asyncio.CancelledError:
             raise
         except Exception:
             logging.exception("Unexpected error in on_message handler")
+        finally:
+            tracer.finish(trace)
+
+    if worker_pool is not None:
+        await dispatch_to_worker(new_msg)
+        return
 
     # Basiclly wrapped this entire thing in a task so it can be shutdown with a command
     task = asyncio.create_task(_handler())
-    running_tasks[new_msg.id] = task
-    task.add_done_callback(lambda t: running_tasks.pop(new_msg.id, None))
+    active_requests.add(
+        new_msg.id,
+        ActiveRequest(
+            task=task, requester_id=new_msg.author.id, channel_id=new_msg.channel.id
+        ),
+    )
+    task.add_done_callback(lambda t: active_requests.pop(new_msg.id))
+    task.add_done_callback(lambda t: coalescer.forget(new_msg))
+
+
+async def admit_within_quota(new_msg: discord.Message, model: str) -> bool:
+    """Check the author's and guild's token buckets, replying once when exhausted."""
+    exceeded = await quotas.check(
+        user_id=new_msg.author.id,
+        guild_id=new_msg.guild.id if new_msg.guild else None,
+        model=model,
+    )
+    if exceeded is None:
+        return True
+
+    scope, retry_after = exceeded
+    logging.info(
+        "Rejected message %s: %s quota exhausted for %.0fs",
+        new_msg.id,
+        scope,
+        retry_after,
+    )
+    if quotas.should_notify(new_msg.author.id, retry_after):
+        template = (
+            QUOTA_EXCEEDED_USER_TEMPLATE
+            if scope == "user"
+            else QUOTA_EXCEEDED_GUILD_TEMPLATE
+        )
+        try:
+            await new_msg.reply(
+                embed=discord.Embed(
+                    description=template.format(ts=int(time.time() + retry_after) + 1),
+                    color=discord.Color.red(),
+                ),
+                silent=True,
+            )
+        except discord.HTTPException:
+            pass
+    return False
+
+
+def track_response(new_msg: discord.Message, response_msg: discord.Message) -> None:
+    active_requests.add_response(new_msg.id, response_msg.id)
+    prewarmer.note_reply(new_msg.channel.id, new_msg.author.id, response_msg.id)
+
+
+async def dispatch_to_worker(new_msg: discord.Message) -> None:
+    """Gateway side of worker mode: authorize, then hand the job to a worker process."""
+    assert discord_bot.user is not None and worker_pool is not None
+
+    is_dm = new_msg.channel.type == discord.ChannelType.private
+    if not is_dm and discord_bot.user not in new_msg.mentions:
+        return
+
+    cfg = await asyncio.to_thread(get_config)
+    if not is_authorized(new_msg=new_msg, config=cfg, is_dm=is_dm):
+        return
+    quotas.configure(cfg)
+    channel_memory.configure(cfg)
+    message_history.configure(cfg)
+    if not await admit_within_quota(new_msg, curr_model):
+        return
+
+    future = worker_pool.dispatch(
+        dict(
+            trigger_id=new_msg.id,
+            channel_id=new_msg.channel.id,
+            guild_id=new_msg.guild.id if new_msg.guild else None,
+            requester_id=new_msg.author.id,
+            model=curr_model,
+            users_listing=users_listing_for(new_msg, cfg),
+        )
+    )
+    if future is None:
+        logging.warning("All workers busy, rejecting message %s", new_msg.id)
+        try:
+            await new_msg.reply(
+                embed=discord.Embed(
+                    description=WORKERS_BUSY_TEXT, color=discord.Color.red()
+                ),
+                silent=True,
+            )
+        except discord.HTTPException:
+            pass
+        return
+
+    active_requests.add(
+        new_msg.id,
+        ActiveRequest(
+            task=future, requester_id=new_msg.author.id, channel_id=new_msg.channel.id
+        ),
+    )
+    future.add_done_callback(lambda f: active_requests.pop(new_msg.id))
+
+
+@discord_bot.event
+async def on_typing(
+    channel: discord.abc.Messageable, user: discord.User | discord.Member, when: Any
+) -> None:
+    # Workers resolve their own context, so pre-warming only helps in-process replies
+    if not prewarmer.enabled or worker_pool is not None or user.bot or draining:
+        return
+    assert discord_bot.user is not None
+
+    cfg = await asyncio.to_thread(get_config)
+    is_dm = isinstance(channel, discord.DMChannel)
+    if not is_user_authorized(user=user, channel=channel, config=cfg, is_dm=is_dm):
+        return
+
+    await prewarmer.maybe_prewarm(
+        channel=channel,
+        user=user,
+        cfg=cfg,
+        provider_slash_model=curr_model,
+        bot_user=discord_bot.user,
+        msg_nodes=msg_nodes,
+        httpx_client=httpx_client,
+        cached_messages=discord_bot.cached_messages,
+    )
+
+
+@discord_bot.event
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent) -> None:
+    # Deleting the triggering message cancels its generation
+    if payload.message_id in active_requests:
+        active_requests.cancel(payload.message_id, CANCEL_REASON_MESSAGE_DELETED)
+    if worker_pool is not None:
+        worker_pool.broadcast(
+            ("invalidate", payload.message_id, payload.channel_id, True)
+        )
+    message_history.forget(payload.channel_id, payload.message_id)
+    await invalidate_msg_node(msg_nodes, payload.message_id, deleted=True)
+    await channel_memory.forget(payload.message_id, payload.guild_id)
+
+
+@discord_bot.event
+async def on_raw_bulk_message_delete(
+    payload: discord.RawBulkMessageDeleteEvent,
+) -> None:
+    for msg_id in payload.message_ids:
+        if msg_id in active_requests:
+            active_requests.cancel(msg_id, CANCEL_REASON_MESSAGE_DELETED)
+        if worker_pool is not None:
+            worker_pool.broadcast(("invalidate", msg_id, payload.channel_id, True))
+        message_history.forget(payload.channel_id, msg_id)
+        await invalidate_msg_node(msg_nodes, msg_id, deleted=True)
+        await channel_memory.forget(msg_id, payload.guild_id)
+
+
+@discord_bot.event
+async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent) -> None:
+    # Including our own streaming edits, which are what a later lookup should see
+    message_history.update(payload.message)
+
+    # Our own streaming edits and embed unfurls don't change what the model should see
+    updated = payload.message
+    if updated.author.id == getattr(discord_bot.user, "id", None):
+        return
+    cached = payload.cached_message
+    if cached is not None and (cached.content, cached.attachments) == (
+        updated.content,
+        updated.attachments,
+    ):
+        return
+
+    if channel_memory.enabled and not updated.author.bot:
+        await channel_memory.forget(payload.message_id, payload.guild_id)
+        channel_memory.observe(updated)
+
+    if worker_pool is not None:
+        worker_pool.broadcast(
+            ("invalidate", payload.message_id, payload.channel_id, False)
+        )
+    await invalidate_msg_node(msg_nodes, payload.message_id, message=updated)
+
+
+@discord_bot.event
+async def on_raw_reaction_add(payload: discord.RawReactionActionEvent) -> None:
+    # The requester can stop a reply by reacting to it with a stop emoji
+    if str(payload.emoji) not in STOP_REACTIONS:
+        return
+    found = active_requests.find(payload.message_id)
+    if found is not None and found[1].requester_id == payload.user_id:
+        active_requests.cancel(found[0], CANCEL_REASON_STOPPED_BY_USER)
+
+
+async def shutdown() -> None:
+    """Stop accepting messages, let in-flight replies finish, then disconnect."""
+    global draining
+    draining = True
+    grace = config.get("shutdown_grace_seconds", 30)
+    logging.info(
+        "Shutting down: no longer accepting messages, draining %d request(s) for up to %ss",
+        len(active_requests),
+        grace,
+    )
+    start = time.monotonic()
+    cancelled = await active_requests.drain(grace, CANCEL_REASON_RESTART)
+    logging.info(
+        "Drain finished in %.1fs (%d cancelled)", time.monotonic() - start, cancelled
+    )
+    await discord_bot.close()
+
+
+def request_shutdown(signame: str) -> None:
+    global shutdown_task
+    if shutdown_task is None:
+        logging.info("Received %s", signame)
+        shutdown_task = asyncio.create_task(shutdown())
+    else:
+        # A second signal skips the wait; cancelled replies are still finalized
+        logging.warning("Received %s again, cancelling in-flight requests", signame)
+        active_requests.cancel_all(CANCEL_REASON_RESTART)
 
 
 async def main() -> None:
-    global httpx_client
-    httpx_client = httpx.AsyncClient()
+    global config, curr_model, httpx_client
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        # Not available on Windows, where Ctrl+C still exits immediately
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, request_shutdown, sig.name)
+
+    config = await asyncio.to_thread(get_config)
+    setup_logging(config)
+    tracer.configure(config)
+    prewarmer.configure(config)
+    quotas.configure(config)
+    channel_memory.configure(config)
+    recorder.configure(config)
+    provider_health.configure(config)
+    profiler.configure(config)
+    message_history.configure(config)
+    quotas.open(config.get("state_dir", ".llmcord"))
+    curr_model = next(iter(config["models"]))
+
+    discord_bot.activity = discord.CustomActivity(
+        name=(config["status_message"] or "github.com/GrainWare/llmcord")[:128]
+    )
+    httpx_client = httpx.AsyncClient(event_hooks=recorder.event_hooks())
+    recorder.install(discord_bot.http)
+
+    global health_server
+    loop_monitor.configure(config)
+    loop_monitor.start()
+    if (health_cfg := config.get("health") or {}).get("enabled", False):
+        health_server = HealthServer(loop_monitor, active_requests, is_ready)
+        health_server.configure(config)
+        await health_server.start(
+            health_cfg.get("host", "127.0.0.1"), health_cfg.get("port", 8080)
+        )
+
+    global worker_pool
+    if (num_workers := config.get("workers", 0) or 0) > 0:
+        worker_pool = WorkerPool(
+            num_workers,
+            max_jobs=config.get("worker_max_jobs", 8),
+            heartbeat_timeout=config.get("worker_heartbeat_timeout", 30),
+        )
+        worker_pool.start(
+            on_response=active_requests.add_response, on_usage=quotas.record
+        )
+
     try:
         await discord_bot.start(config["bot_token"])
     finally:
+        if worker_pool is not None:
+            # Workers finalize replies cancelled by the drain before exiting
+            await worker_pool.stop(timeout=10)
         try:
             client = httpx_client
             if client is not None:
                 await client.aclose()
         except Exception:
             pass
+        await provider_health.stop()
+        await close_openai_clients()
+        await quotas.close()
+        if health_server is not None:
+            await health_server.stop()
+        await loop_monitor.stop()
 
 
 def _run() -> None:
+    parser = argparse.ArgumentParser(
+        prog="llmcord", description="Run the bot (default) or a tool."
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    loadtest.add_parser(subparsers)
+    health.add_parser(subparsers)
+    replay.add_parser(subparsers)
+    bench.add_parser(subparsers)
+    options = parser.parse_args()
+
     try:
-        asyncio.run(main())
+        if options.command is None:
+            asyncio.run(main())
+        else:
+            options.func(options)
     except KeyboardInterrupt:
         pass
 
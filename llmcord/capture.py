@@ -0,0 +1,536 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import gzip
+import json
+import logging
+import random
+import time
+import weakref
+from collections.abc import AsyncIterator, Callable
+from contextvars import ContextVar
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+from urllib.parse import urlsplit
+
+import discord
+import httpx
+
+from .history import SeenMessage, message_history
+from .metrics import metrics
+
+if TYPE_CHECKING:
+    from .messages import MsgNode
+
+
+CAPTURE_FORMAT_VERSION = 1
+REDACTED = "<redacted>"
+# Settings that are secret or don't affect how a reply is built
+_UNCAPTURED_SETTINGS = (
+    "bot_token",
+    "client_id",
+    "status_message",
+    "permissions",
+    "providers",
+    "models",
+    "workers",
+    "worker_max_jobs",
+    "worker_heartbeat_timeout",
+    "logging",
+    "tracing",
+    "health",
+    "quotas",
+    "capture",
+    "state_dir",
+)
+
+
+class Recording:
+    """What one request sent and received, while it is being captured."""
+
+    def __init__(self, resolved: set[int]) -> None:
+        self.started = time.perf_counter()
+        # Messages whose node text was already cached when the request arrived
+        self.resolved = resolved
+        # HTTP exchanges through hooked clients (provider streams, attachment downloads)
+        self.http: list[dict[str, Any]] = []
+        # Discord REST calls: fetched payloads and what the bot posted
+        self.discord: list[dict[str, Any]] = []
+
+
+_current: ContextVar[Recording | None] = ContextVar("llmcord_capture", default=None)
+
+
+class _RecordingStream(httpx.AsyncByteStream):
+    """Passes a response body through, keeping each chunk and the delay before it."""
+
+    def __init__(
+        self, stream: httpx.AsyncByteStream, exchange: dict[str, Any], max_bytes: int
+    ) -> None:
+        self._stream = stream
+        self._exchange = exchange
+        self._max_bytes = max_bytes
+        self._size = 0
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        chunks = self._exchange["chunks"]
+        last = time.perf_counter()
+        async for chunk in self._stream:
+            now = time.perf_counter()
+            self._size += len(chunk)
+            if self._size <= self._max_bytes:
+                # Latin-1 maps bytes to code points 1:1, so chunks split inside a
+                # UTF-8 sequence survive and SSE text stays readable in the file
+                chunks.append([round(now - last, 4), chunk.decode("latin-1")])
+            else:
+                self._exchange["truncated"] = True
+            last = now
+            yield chunk
+
+    async def aclose(self) -> None:
+        await self._stream.aclose()
+
+
+def user_payload(user: discord.abc.User) -> dict[str, Any]:
+    return dict(
+        id=str(user.id),
+        username=user.name,
+        discriminator=user.discriminator,
+        global_name=user.global_name,
+        avatar=None,
+        bot=user.bot,
+    )
+
+
+def message_payload(msg: discord.Message) -> dict[str, Any]:
+    """Rebuild the gateway payload of a message from its parsed attributes."""
+    data: dict[str, Any] = dict(
+        id=str(msg.id),
+        channel_id=str(msg.channel.id),
+        author=user_payload(msg.author),
+        content=msg.content,
+        timestamp=msg.created_at.isoformat(),
+        edited_timestamp=msg.edited_at and msg.edited_at.isoformat(),
+        tts=msg.tts,
+        mention_everyone=msg.mention_everyone,
+        mentions=[user_payload(user) for user in msg.mentions],
+        mention_roles=[],
+        attachments=[att.to_dict() for att in msg.attachments],
+        embeds=[embed.to_dict() for embed in msg.embeds],
+        pinned=msg.pinned,
+        type=msg.type.value,
+        flags=msg.flags.value,
+    )
+    if msg.guild is not None:
+        data["guild_id"] = str(msg.guild.id)
+    if isinstance(msg.author, discord.Member) and msg.author.nick:
+        data["member"] = dict(
+            nick=msg.author.nick, roles=[], joined_at=None, deaf=False, mute=False
+        )
+    if msg.reference is not None and msg.reference.message_id is not None:
+        data["message_reference"] = dict(
+            message_id=str(msg.reference.message_id),
+            channel_id=str(msg.reference.channel_id),
+            guild_id=msg.reference.guild_id and str(msg.reference.guild_id),
+        )
+    return data
+
+
+def _seen_payload(msg: SeenMessage) -> dict[str, Any]:
+    """The gateway payload of a message answered from the message history."""
+    data: dict[str, Any] = dict(
+        id=str(msg.id),
+        channel_id=str(msg.channel.id),
+        author=user_payload(msg.author),
+        content=msg.content,
+        timestamp=discord.utils.snowflake_time(msg.id).isoformat(),
+        edited_timestamp=None,
+        tts=False,
+        mention_everyone=False,
+        mentions=[],
+        mention_roles=[],
+        attachments=[
+            dict(
+                id=str(att.id),
+                filename=att.filename,
+                size=att.size,
+                url=att.url,
+                proxy_url=att.url,
+                content_type=att.content_type,
+            )
+            for att in msg.attachments
+        ],
+        embeds=[embed.to_dict() for embed in msg.embeds],
+        pinned=False,
+        type=msg.type.value,
+        flags=0,
+    )
+    if (guild := getattr(msg.channel, "guild", None)) is not None:
+        data["guild_id"] = str(guild.id)
+    if isinstance(msg.author, discord.Member) and msg.author.nick:
+        data["member"] = dict(
+            nick=msg.author.nick, roles=[], joined_at=None, deaf=False, mute=False
+        )
+    if msg.reference is not None and msg.reference.message_id is not None:
+        data["message_reference"] = dict(
+            message_id=str(msg.reference.message_id),
+            channel_id=str(msg.reference.channel_id),
+            guild_id=data.get("guild_id"),
+        )
+    return data
+
+
+def _node_payload(
+    msg_id: int, node: MsgNode, channel_id: int, bot_user: dict[str, Any]
+) -> dict[str, Any]:
+    """A stand-in message for a node resolved before capture started."""
+    author = (
+        bot_user
+        if node.role == "assistant"
+        else dict(
+            id=str(node.user_id or 0),
+            username=node.display_name or "unknown",
+            discriminator="0",
+            global_name=node.display_name,
+            avatar=None,
+        )
+    )
+    data: dict[str, Any] = dict(
+        id=str(msg_id),
+        channel_id=str(channel_id),
+        author=author,
+        content=node.text or "",
+        timestamp=discord.utils.snowflake_time(msg_id).isoformat(),
+        edited_timestamp=None,
+        tts=False,
+        mention_everyone=False,
+        mentions=[],
+        mention_roles=[],
+        attachments=[],
+        embeds=[],
+        pinned=False,
+        type=0,
+        flags=0,
+    )
+    if node.parent_id is not None:
+        data["type"] = 19
+        data["message_reference"] = dict(
+            message_id=str(node.parent_id),
+            channel_id=str(node.parent_channel_id or channel_id),
+        )
+    return data
+
+
+def _channel_payload(channel: Any) -> dict[str, Any]:
+    data: dict[str, Any] = dict(
+        id=str(channel.id),
+        type=channel.type.value,
+        name=getattr(channel, "name", None),
+    )
+    if (guild := getattr(channel, "guild", None)) is not None:
+        parent_id = getattr(channel, "parent_id", None)
+        data.update(
+            guild_id=str(guild.id),
+            position=getattr(channel, "position", 0),
+            permission_overwrites=[],
+            nsfw=False,
+            parent_id=parent_id and str(parent_id),
+        )
+    if isinstance(channel, discord.DMChannel) and channel.recipient is not None:
+        data["recipients"] = [user_payload(channel.recipient)]
+    if isinstance(channel, discord.Thread):
+        data.update(
+            owner_id=str(channel.owner_id),
+            member_count=channel.member_count or 0,
+            message_count=channel.message_count or 0,
+            thread_metadata=dict(
+                archived=False,
+                auto_archive_duration=channel.auto_archive_duration,
+                archive_timestamp=channel.archive_timestamp.isoformat(),
+                locked=False,
+            ),
+        )
+    return data
+
+
+def _request_json(request: httpx.Request, max_bytes: int) -> Any:
+    try:
+        content = request.content
+    except httpx.RequestNotRead:
+        return None
+    if not content or len(content) > max_bytes:
+        return None
+    try:
+        return json.loads(content)
+    except ValueError:
+        return None
+
+
+def _form_payload(form: list[dict[str, Any]] | None) -> Any:
+    for field in form or []:
+        if field.get("name") == "payload_json":
+            return json.loads(field["value"])
+    return None
+
+
+class Recorder:
+    """Captures requests to compact files for `llmcord replay`.
+
+    While a request is captured, a context variable marks its task. Provider and
+    attachment downloads made through clients with `event_hooks()` record their
+    request bodies, status and response chunks with timing, and Discord REST calls
+    record the payloads fetched and posted. Headers and query strings are never
+    stored, and configured secrets are replaced in everything that is.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.sample_rate = 1.0
+        self.directory = Path(".llmcord") / "captures"
+        self.max_body_bytes = 1 << 20
+        # Receives finished captures instead of writing them (used by replay)
+        self.sink: Callable[[dict[str, Any]], None] | None = None
+
+        self._secrets: list[str] = []
+        self._sent: weakref.WeakKeyDictionary[httpx.Request, float] = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def configure(self, config: dict[str, Any]) -> None:
+        capture_cfg = config.get("capture") or {}
+        self.enabled = capture_cfg.get("enabled", False)
+        self.sample_rate = capture_cfg.get("sample_rate", 1.0)
+        self.directory = Path(
+            capture_cfg.get("dir")
+            or Path(config.get("state_dir", ".llmcord")) / "captures"
+        )
+        self.max_body_bytes = capture_cfg.get("max_body_bytes", 1 << 20)
+
+        secrets = [config.get("bot_token")]
+        for provider in (config.get("providers") or {}).values():
+            provider = provider or {}
+            secrets.append(provider.get("api_key"))
+            for extra in ("extra_headers", "extra_query"):
+                secrets += [v for v in (provider.get(extra) or {}).values()]
+        # Short values would redact unrelated text
+        self._secrets = sorted(
+            {s for s in secrets if isinstance(s, str) and len(s) >= 8},
+            key=len,
+            reverse=True,
+        )
+
+    def event_hooks(self) -> dict[str, list[Callable[..., Any]]]:
+        """httpx `event_hooks` that record exchanges made while capturing."""
+        return dict(request=[self._on_request], response=[self._on_response])
+
+    async def _on_request(self, request: httpx.Request) -> None:
+        if _current.get() is not None:
+            self._sent[request] = time.perf_counter()
+
+    async def _on_response(self, response: httpx.Response) -> None:
+        if (recording := _current.get()) is None:
+            return
+        request = response.request
+        sent = self._sent.pop(request, None)
+        exchange: dict[str, Any] = dict(
+            method=request.method,
+            path=request.url.path,
+            request=_request_json(request, self.max_body_bytes),
+            status=response.status_code,
+            content_type=response.headers.get("content-type", ""),
+            ttfb=round(time.perf_counter() - sent, 4) if sent is not None else 0.0,
+            chunks=[],
+        )
+        recording.http.append(exchange)
+        response.stream = _RecordingStream(
+            response.stream,  # type: ignore[arg-type]
+            exchange,
+            self.max_body_bytes,
+        )
+
+    def install(self, http: Any) -> None:
+        """Record the Discord REST calls a discord.py HTTPClient makes while capturing."""
+        request = http.request
+
+        async def recording_request(route: discord.http.Route, **kwargs: Any) -> Any:
+            if (recording := _current.get()) is None:
+                return await request(route, **kwargs)
+
+            entry: dict[str, Any] = dict(
+                method=route.method, path=route.url.removeprefix(route.BASE)
+            )
+            if route.method != "GET":
+                entry["payload"] = kwargs.get("json") or _form_payload(
+                    kwargs.get("form")
+                )
+            recording.discord.append(entry)
+            try:
+                response = await request(route, **kwargs)
+            except discord.HTTPException as e:
+                entry.update(status=e.status, code=e.code)
+                raise
+            entry["status"] = 200
+            if route.method == "GET":
+                entry["response"] = response
+            elif isinstance(response, dict) and "id" in response:
+                entry["id"] = response["id"]
+            return response
+
+        http.request = recording_request
+
+    @contextlib.asynccontextmanager
+    async def record(
+        self,
+        *,
+        new_msg: discord.Message,
+        cfg: dict[str, Any],
+        provider_slash_model: str,
+        bot_user: discord.ClientUser,
+        msg_nodes: dict[int, MsgNode],
+    ) -> AsyncIterator[None]:
+        """Capture the request handled inside this block, if capture is enabled."""
+        if not self.enabled or random.random() >= self.sample_rate:
+            yield
+            return
+
+        recording = Recording(
+            {msg_id for msg_id, node in msg_nodes.items() if node.text is not None}
+        )
+        token = _current.set(recording)
+        try:
+            yield
+        finally:
+            _current.reset(token)
+            try:
+                capture = self._finish(
+                    recording, new_msg, cfg, provider_slash_model, bot_user, msg_nodes
+                )
+                if self.sink is not None:
+                    self.sink(capture)
+                else:
+                    await asyncio.to_thread(self._write, new_msg.id, capture)
+            except Exception:
+                logging.exception(
+                    "Failed to save the capture of message %s", new_msg.id
+                )
+
+    def _finish(
+        self,
+        recording: Recording,
+        new_msg: discord.Message,
+        cfg: dict[str, Any],
+        provider_slash_model: str,
+        bot_user: discord.ClientUser,
+        msg_nodes: dict[int, MsgNode],
+    ) -> dict[str, Any]:
+        bot_payload = user_payload(bot_user)
+
+        # The conversation as the bot saw it. Nodes resolved before this request are
+        # stored as their cached text (which can differ from the message itself, e.g.
+        # replies without their header); replay seeds these over fetched payloads.
+        messages = []
+        fetched = {
+            int(m["id"])
+            for entry in recording.discord
+            if entry["method"] == "GET" and entry.get("response")
+            for m in (
+                entry["response"]
+                if isinstance(entry["response"], list)
+                else [entry["response"]]
+            )
+            if isinstance(m, dict) and "author" in m
+        }
+        msg_id = new_msg.id
+        channel_id = new_msg.channel.id
+        seen: set[int] = set()
+        while msg_id is not None and msg_id not in seen:
+            seen.add(msg_id)
+            node = msg_nodes.get(msg_id)
+            if msg_id == new_msg.id:
+                pass
+            elif msg_id in recording.resolved and node is not None:
+                messages.append(_node_payload(msg_id, node, channel_id, bot_payload))
+            elif msg_id not in fetched:
+                if (cached := new_msg._state._get_message(msg_id)) is not None:
+                    messages.append(message_payload(cached))
+                elif (recent := message_history.get(channel_id, msg_id)) is not None:
+                    messages.append(_seen_payload(recent))
+            if node is None:
+                break
+            if node.parent_id is None:
+                # The chain may have ended on the message before this one (not from
+                # the same author), which the history answered without a fetch
+                _, previous = message_history.previous(channel_id, msg_id)
+                if previous is not None and previous.id not in fetched:
+                    messages.append(_seen_payload(previous))
+            msg_id, channel_id = node.parent_id, node.parent_channel_id or channel_id
+
+        models = [provider_slash_model]
+        if fallback_model := (cfg.get("stream_recovery") or {}).get("fallback_model"):
+            models.append(fallback_model)
+        providers = {}
+        for model in models:
+            name = model.split("/", 1)[0]
+            provider = cfg["providers"][name]
+            providers[name] = dict(
+                path=urlsplit(provider["base_url"]).path,
+                extra_body=provider.get("extra_body"),
+                continuation=provider.get("continuation"),
+            )
+
+        members = {bot_payload["id"]: bot_payload}
+        for payload in [message_payload(new_msg), *messages]:
+            members.setdefault(payload["author"]["id"], payload["author"])
+        capture = dict(
+            format=CAPTURE_FORMAT_VERSION,
+            recorded_at=time.time(),
+            duration=round(time.perf_counter() - recording.started, 4),
+            model=provider_slash_model,
+            config={k: v for k, v in cfg.items() if k not in _UNCAPTURED_SETTINGS}
+            | dict(
+                providers=providers,
+                models={model: cfg["models"].get(model) for model in models},
+            ),
+            bot_user=bot_payload,
+            guild=new_msg.guild
+            and dict(
+                id=str(new_msg.guild.id),
+                name=new_msg.guild.name,
+                members=list(members.values()),
+            ),
+            channel=_channel_payload(new_msg.channel),
+            trigger=message_payload(new_msg),
+            messages=messages,
+            discord=recording.discord,
+            http=recording.http,
+        )
+        return self._redact(capture)
+
+    def _redact(self, capture: dict[str, Any]) -> dict[str, Any]:
+        if not self._secrets:
+            return capture
+        text = json.dumps(capture, ensure_ascii=False)
+        for secret in self._secrets:
+            text = text.replace(json.dumps(secret)[1:-1], REDACTED)
+        return json.loads(text)
+
+    def _write(self, trigger_id: int, capture: dict[str, Any]) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f"{trigger_id}.json.gz"
+        with gzip.open(path, "wt", encoding="utf-8") as file:
+            json.dump(capture, file, ensure_ascii=False, separators=(",", ":"))
+        metrics.incr("captures_written")
+        logging.info("Captured message %s to %s", trigger_id, path)
+
+
+recorder = Recorder()
+
+
+__all__ = [
+    "CAPTURE_FORMAT_VERSION",
+    "Recorder",
+    "Recording",
+    "message_payload",
+    "recorder",
+]
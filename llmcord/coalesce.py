@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
+
+import discord
+
+from .constants import CANCEL_REASON_SUPERSEDED
+from .metrics import metrics
+from .tasks import RequestRegistry
+
+# Bound for the per-(channel, user) bookkeeping
+MAX_TRACKED_BURSTS = 10000
+
+
+@dataclass(slots=True)
+class _Burst:
+    # Oldest first; the newest one's reply answers all of them
+    messages: list[discord.Message]
+    last_seen: float
+    # Whether the newest message's reply got past the window (its provider call was made)
+    generating: bool = False
+
+
+class BurstCoalescer:
+    """Folds quick consecutive mentions from one user in one channel into one reply.
+
+    Each mention waits `window_seconds` before its provider request. A mention from the
+    same author in the same channel within the window, or while the previous reply is
+    still waiting for its first output, supersedes the previous one: that reply is
+    cancelled and the new reply's conversation continues from every message of the
+    burst. A burst answers at most `max_merge` messages, and a reply that is already
+    visible is never superseded.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.window_seconds = 2.0
+        self.max_merge = 5
+
+        # (channel ID, user ID) -> the burst that the author's latest reply answers
+        self._bursts: OrderedDict[tuple[int, int], _Burst] = OrderedDict()
+
+    def configure(self, config: dict[str, Any]) -> None:
+        coalesce_cfg = config.get("coalescing") or {}
+        self.enabled = coalesce_cfg.get("enabled", False)
+        self.window_seconds = coalesce_cfg.get("window_seconds", 2)
+        self.max_merge = coalesce_cfg.get("max_merge", 5)
+
+    def _can_extend(
+        self,
+        burst: _Burst,
+        new_msg: discord.Message,
+        requests: RequestRegistry,
+        now: float,
+    ) -> bool:
+        previous = burst.messages[-1]
+        if (
+            len(burst.messages) >= self.max_merge
+            # Handlers can reach this out of order
+            or new_msg.id < previous.id
+        ):
+            return False
+        # A reply to something else starts its own conversation
+        if new_msg.reference is not None and new_msg.reference.message_id not in (
+            previous.id,
+            getattr(previous.reference, "message_id", None),
+        ):
+            return False
+        request = requests.get(previous.id)
+        if request is None or request.task.done() or request.response_msg_ids:
+            return False
+        return burst.generating or now - burst.last_seen <= self.window_seconds
+
+    def join(
+        self, new_msg: discord.Message, requests: RequestRegistry
+    ) -> list[discord.Message]:
+        """Add an authorized mention to its author's burst in the channel.
+
+        Returns the earlier messages to answer along with it (oldest first), after
+        cancelling the reply they were waiting on. Empty when new_msg starts a burst.
+        """
+        if not self.enabled:
+            return []
+        key = (new_msg.channel.id, new_msg.author.id)
+        now = time.monotonic()
+
+        merged: list[discord.Message] = []
+        burst = self._bursts.get(key)
+        if burst is not None and self._can_extend(burst, new_msg, requests, now):
+            requests.cancel(burst.messages[-1].id, CANCEL_REASON_SUPERSEDED)
+            merged = burst.messages
+            metrics.incr("coalesced_messages")
+            if not burst.generating:
+                metrics.incr("provider_calls_saved")
+            logging.info(
+                "Message %s supersedes %s (%d in burst, %s)",
+                new_msg.id,
+                merged[-1].id,
+                len(merged) + 1,
+                "in flight" if burst.generating else "before the provider call",
+            )
+
+        self._bursts[key] = _Burst([*merged, new_msg], now)
+        self._bursts.move_to_end(key)
+        if len(self._bursts) > MAX_TRACKED_BURSTS:
+            self._bursts.popitem(last=False)
+        return merged
+
+    async def settle(self, new_msg: discord.Message) -> None:
+        """Give the author `window_seconds` to add to new_msg before it is answered.
+
+        Cancelled (by join) when a newer message supersedes new_msg meanwhile.
+        """
+        if not self.enabled:
+            return
+        await asyncio.sleep(self.window_seconds)
+        burst = self._bursts.get((new_msg.channel.id, new_msg.author.id))
+        if burst is not None and burst.messages[-1].id == new_msg.id:
+            burst.generating = True
+
+    def forget(self, new_msg: discord.Message) -> None:
+        """Drop the burst answered by new_msg's reply once that reply is finished."""
+        key = (new_msg.channel.id, new_msg.author.id)
+        burst = self._bursts.get(key)
+        if burst is not None and burst.messages[-1].id == new_msg.id:
+            del self._bursts[key]
+
+
+coalescer = BurstCoalescer()
+
+
+__all__ = ["BurstCoalescer", "coalescer"]
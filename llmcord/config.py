@@ -1,12 +1,32 @@
 from __future__ import annotations
 
+import os
 from typing import Any
 import yaml
 
 
+# filename -> ((mtime_ns, size), parsed config)
+_config_cache: dict[str, tuple[tuple[int, int], dict[str, Any]]] = {}
+
+
 def get_config(filename: str = "config.yaml") -> dict[str, Any]:
+    """Load config.yaml, re-parsing only when the file changed.
+
+    While the file is unchanged the same dict object is returned, so derived state
+    (e.g. the compiled permission policy) can be cached per config version. Callers
+    must treat it as read-only.
+    """
+    stat = os.stat(filename)
+    version = (stat.st_mtime_ns, stat.st_size)
+
+    cached = _config_cache.get(filename)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
     with open(filename, encoding="utf-8") as file:
-        return yaml.safe_load(file)
+        config = yaml.safe_load(file)
+    _config_cache[filename] = (version, config)
+    return config
 
 
 __all__ = ["get_config"]
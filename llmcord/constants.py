@@ -4,6 +4,18 @@ import discord
 
 PROVIDERS_SUPPORTING_USERNAMES: tuple[str, ...] = ("openai",)
 
+# Prompt caching hints (matched against "<provider>/<model>" like usernames)
+PROVIDERS_SUPPORTING_PROMPT_CACHE_KEY: tuple[str, ...] = ("openai",)
+PROVIDERS_SUPPORTING_CACHE_PROMPT: tuple[str, ...] = (
+    "llamacpp",
+    "llama.cpp",
+    "llama-cpp",
+)
+
+# Idle provider connections are kept this long (the SDK default is 5s), so a
+# connection opened by pre-warming or a previous reply is still there for the next one
+PROVIDER_KEEPALIVE_SECONDS = 60
+
 
 # Discord embed styles
 EMBED_COLOR_COMPLETE = discord.Color.dark_green()
@@ -15,7 +27,39 @@ EMBED_DESCRIPTION_MAX_LENGTH = 4096
 EMBED_TOTAL_MAX_LENGTH = 6000
 STREAMING_INDICATOR = " ⚪"
 EDIT_DELAY_SECONDS = 1
+STREAM_RETRY_DELAY_SECONDS = 0.5
+
+
+# Cancellation
+STOP_REACTIONS: tuple[str, ...] = ("🛑", "⏹️")
+CANCEL_REASON_DEFAULT = "cancelled"
+CANCEL_REASON_MESSAGE_DELETED = "message deleted"
+CANCEL_REASON_STOPPED_BY_USER = "stopped by user"
+CANCEL_REASON_STOPPED_BY_ADMIN = "stopped by admin"
+CANCEL_REASON_RESTART = "cancelled by restart"
+CANCEL_REASON_SUPERSEDED = "superseded"
+FOOTER_CANCELLED_TEMPLATE = " • {reason}"
+
+
+# Worker mode
+WORKERS_BUSY_TEXT = "I'm busy with other replies right now, please try again shortly."
+
+
+# Usage quotas
+QUOTA_EXCEEDED_USER_TEMPLATE = "You've reached your usage limit. Try again <t:{ts}:R>."
+QUOTA_EXCEEDED_GUILD_TEMPLATE = (
+    "This server has reached its usage limit. Try again <t:{ts}:R>."
+)
+
+
+# Channel memory
+MEMORY_PROMPT_HEADER = "Possibly relevant earlier messages (oldest first):"
 
+# Stream recovery (for providers that can't continue a trailing assistant message)
+STREAM_RECOVERY_CONTINUE_PROMPT = (
+    "Your previous reply was cut off. Continue it exactly where it stopped, without "
+    "repeating anything or commenting on the interruption."
+)
 
 # Internal caches
 MAX_MESSAGE_NODES = 500
@@ -37,12 +81,29 @@ WARNING_ONLY_USING_LAST_TEMPLATE = "⚠️ Only using last {messages_count} mess
 
 __all__ = [
     "PROVIDERS_SUPPORTING_USERNAMES",
+    "PROVIDERS_SUPPORTING_PROMPT_CACHE_KEY",
+    "PROVIDERS_SUPPORTING_CACHE_PROMPT",
+    "PROVIDER_KEEPALIVE_SECONDS",
     "EMBED_COLOR_COMPLETE",
     "EMBED_COLOR_INCOMPLETE",
     "EMBED_DESCRIPTION_MAX_LENGTH",
     "EMBED_TOTAL_MAX_LENGTH",
     "STREAMING_INDICATOR",
     "EDIT_DELAY_SECONDS",
+    "STREAM_RETRY_DELAY_SECONDS",
+    "STOP_REACTIONS",
+    "CANCEL_REASON_DEFAULT",
+    "CANCEL_REASON_MESSAGE_DELETED",
+    "CANCEL_REASON_STOPPED_BY_USER",
+    "CANCEL_REASON_STOPPED_BY_ADMIN",
+    "CANCEL_REASON_RESTART",
+    "CANCEL_REASON_SUPERSEDED",
+    "FOOTER_CANCELLED_TEMPLATE",
+    "WORKERS_BUSY_TEXT",
+    "QUOTA_EXCEEDED_USER_TEMPLATE",
+    "QUOTA_EXCEEDED_GUILD_TEMPLATE",
+    "MEMORY_PROMPT_HEADER",
+    "STREAM_RECOVERY_CONTINUE_PROMPT",
     "MAX_MESSAGE_NODES",
     "FOOTER_REASONING_SUFFIX",
     "FOOTER_STREAMING_SUFFIX",
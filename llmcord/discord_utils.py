@@ -1,6 +1,12 @@
 from __future__ import annotations
 
+import json
+import logging
+from hashlib import sha256
+from pathlib import Path
+
 import discord
+from discord import app_commands
 
 
 def build_warnings_embed(warnings: set[str]) -> discord.Embed:
@@ -15,4 +21,41 @@ def copy_embed_fields(src: discord.Embed, dst: discord.Embed) -> None:
         dst.add_field(name=f.name, value=f.value, inline=f.inline)
 
 
-__all__ = ["build_warnings_embed", "copy_embed_fields"]
+async def sync_command_tree(
+    tree: app_commands.CommandTree, *, application_id: int | None, state_dir: str
+) -> bool:
+    """Sync slash commands only if they changed since the last successful sync.
+
+    A hash of the serialized command tree is persisted in `state_dir`, so restarts and
+    gateway reconnects skip the heavily rate-limited global sync. Returns True if a
+    sync was performed.
+    """
+    payload = json.dumps(
+        {
+            "application_id": application_id,
+            "commands": [cmd.to_dict(tree) for cmd in tree.get_commands()],
+        },
+        sort_keys=True,
+        default=str,
+    )
+    digest = sha256(payload.encode("utf-8")).hexdigest()
+
+    hash_path = Path(state_dir) / "command_tree.sha256"
+    try:
+        if hash_path.read_text(encoding="utf-8").strip() == digest:
+            logging.info("Command tree unchanged, skipping sync")
+            return False
+    except OSError:
+        pass
+
+    await tree.sync()
+    try:
+        hash_path.parent.mkdir(parents=True, exist_ok=True)
+        hash_path.write_text(digest, encoding="utf-8")
+    except OSError:
+        logging.warning("Could not persist command tree hash to %s", hash_path)
+    logging.info("Command tree synced")
+    return True
+
+
+__all__ = ["build_warnings_embed", "copy_embed_fields", "sync_command_tree"]
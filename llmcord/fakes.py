@@ -0,0 +1,504 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import itertools
+import json
+import socket
+import time
+from collections import defaultdict
+from collections.abc import Callable
+from typing import Any
+
+from aiohttp import web
+from discord.utils import DISCORD_EPOCH, utcnow
+
+
+class _FakeServer:
+    """Local aiohttp app bound to an ephemeral port."""
+
+    def __init__(self, host: str = "127.0.0.1") -> None:
+        self.host = host
+        self.app = web.Application()
+        self._runner: web.AppRunner | None = None
+        self.port = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self) -> str:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind((self.host, 0))
+        self.port = sock.getsockname()[1]
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.SockSite(self._runner, sock).start()
+        return self.url
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+EMBEDDING_DIM = 256
+
+
+class FakeOpenAI(_FakeServer):
+    """OpenAI-compatible chat completions server with configurable latency.
+
+    Streams `completion_tokens` word tokens, the first after `latency` seconds and the
+    rest every `token_interval` seconds, followed by a usage chunk. `/embeddings`
+    returns hashed bag-of-words vectors, so texts sharing words come out similar.
+    """
+
+    def __init__(
+        self,
+        *,
+        latency: float = 0.5,
+        token_interval: float = 0.02,
+        completion_tokens: int = 200,
+        host: str = "127.0.0.1",
+    ) -> None:
+        super().__init__(host)
+        self.latency = latency
+        self.token_interval = token_interval
+        self.completion_tokens = completion_tokens
+        self.requests = 0
+        self.active = 0
+        self.peak_active = 0
+        self.app.router.add_get("/v1/models", self._models)
+        self.app.router.add_post("/v1/chat/completions", self._chat_completions)
+        self.app.router.add_post("/v1/embeddings", self._embeddings)
+
+    @property
+    def base_url(self) -> str:
+        return f"{self.url}/v1"
+
+    async def _models(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            dict(
+                object="list",
+                data=[dict(id="fake", object="model", owned_by="llmcord")],
+            )
+        )
+
+    @staticmethod
+    def embed(text: str, dim: int = EMBEDDING_DIM) -> list[float]:
+        vector = [0.0] * dim
+        for word in text.lower().split():
+            digest = hashlib.blake2b(word.encode(), digest_size=8).digest()
+            vector[int.from_bytes(digest[:4], "little") % dim] += (
+                1.0 if digest[4] & 1 else -1.0
+            )
+        return vector
+
+    async def _embeddings(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        inputs = body.get("input", [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        self.requests += 1
+        return web.json_response(
+            dict(
+                object="list",
+                model=body.get("model", "fake"),
+                data=[
+                    dict(object="embedding", index=i, embedding=self.embed(text))
+                    for i, text in enumerate(inputs)
+                ],
+                usage=dict(prompt_tokens=0, total_tokens=0),
+            )
+        )
+
+    @staticmethod
+    def _chunk(model: str, **fields: Any) -> bytes:
+        data = dict(
+            id="chatcmpl-fake", object="chat.completion.chunk", created=0, model=model
+        )
+        return f"data: {json.dumps(data | fields)}\n\n".encode()
+
+    async def _chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        model = body.get("model", "fake")
+        prompt_tokens = len(json.dumps(body.get("messages", []))) // 4
+        words = [f"word{i % 97} " for i in range(self.completion_tokens)]
+        usage = dict(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=self.completion_tokens,
+            total_tokens=prompt_tokens + self.completion_tokens,
+        )
+
+        self.requests += 1
+        self.active += 1
+        self.peak_active = max(self.peak_active, self.active)
+        try:
+            await asyncio.sleep(self.latency)
+
+            if not body.get("stream"):
+                message = dict(role="assistant", content="".join(words))
+                return web.json_response(
+                    dict(
+                        id="chatcmpl-fake",
+                        object="chat.completion",
+                        created=0,
+                        model=model,
+                        choices=[dict(index=0, message=message, finish_reason="stop")],
+                        usage=usage,
+                    )
+                )
+
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            for i, word in enumerate(words):
+                if i:
+                    await asyncio.sleep(self.token_interval)
+                delta = (
+                    dict(role="assistant", content=word)
+                    if i == 0
+                    else dict(content=word)
+                )
+                await response.write(
+                    self._chunk(
+                        model, choices=[dict(index=0, delta=delta, finish_reason=None)]
+                    )
+                )
+            await response.write(
+                self._chunk(
+                    model, choices=[dict(index=0, delta={}, finish_reason="stop")]
+                )
+            )
+            await response.write(self._chunk(model, choices=[], usage=usage))
+            await response.write(b"data: [DONE]\n\n")
+            return response
+        finally:
+            self.active -= 1
+
+
+# (method, route template) -> (requests, per seconds), per major parameter (channel)
+DISCORD_ROUTE_LIMITS: dict[tuple[str, str], tuple[int, float]] = {
+    ("POST", "/api/v10/channels/{channel_id}/messages"): (5, 5.0),
+    ("PATCH", "/api/v10/channels/{channel_id}/messages/{message_id}"): (5, 5.0),
+    ("DELETE", "/api/v10/channels/{channel_id}/messages/{message_id}"): (5, 1.0),
+}
+DISCORD_DEFAULT_LIMIT = (50, 1.0)
+
+
+def _discord_json(
+    data: Any, *, status: int = 200, headers: dict[str, str] | None = None
+) -> web.Response:
+    # discord.py only decodes bodies whose content type is exactly application/json
+    return web.Response(
+        body=json.dumps(data).encode(),
+        status=status,
+        headers={"Content-Type": "application/json"} | (headers or {}),
+    )
+
+
+class _Bucket:
+    __slots__ = ("limit", "per", "remaining", "reset_at")
+
+    def __init__(self, limit: int, per: float) -> None:
+        self.limit = limit
+        self.per = per
+        self.remaining = limit
+        self.reset_at = 0.0
+
+    def acquire(self, now: float) -> bool:
+        if now >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = now + self.per
+        if self.remaining <= 0:
+            return False
+        self.remaining -= 1
+        return True
+
+
+class FakeDiscord(_FakeServer):
+    """Minimal Discord REST API with per-route and global rate limits.
+
+    Point discord.py at it with `discord.http.Route.BASE = f"{fake.url}/api/v10"`.
+    Messages, channels and attachments live in memory; `seed_message` adds history.
+    Rate limits answer with real 429 bodies and headers so discord.py's own limiter
+    and retry logic are exercised.
+    """
+
+    def __init__(
+        self,
+        *,
+        global_limit: int = 50,
+        route_limits: dict[tuple[str, str], tuple[int, float]] | None = None,
+        host: str = "127.0.0.1",
+    ) -> None:
+        super().__init__(host)
+        self.global_limit = global_limit
+        self.route_limits = (
+            DISCORD_ROUTE_LIMITS if route_limits is None else route_limits
+        )
+        self._global_bucket = _Bucket(global_limit, 1.0)
+        self._buckets: dict[tuple[str, str, str], _Bucket] = {}
+        self._ids = itertools.count()
+
+        self.bot_user = dict(
+            id=str(self.snowflake()),
+            username="llmcord",
+            discriminator="0",
+            global_name=None,
+            avatar=None,
+            bot=True,
+        )
+        self.channels: dict[int, dict[str, Any]] = {}
+        self.messages: dict[int, dict[int, dict[str, Any]]] = defaultdict(dict)
+        self.attachments: dict[str, bytes] = {}
+        # Called with (trigger message ID, payload) when the bot posts or edits a reply
+        self.on_reply_write: Callable[[int, dict[str, Any]], None] | None = None
+        self._reply_to: dict[int, int] = {}
+
+        self.requests: dict[str, int] = defaultdict(int)
+        self.rate_limited: dict[str, int] = defaultdict(int)
+
+        api = "/api/v10"
+        router = self.app.router
+        router.add_get(f"{api}/users/@me", self._get_me)
+        router.add_get(f"{api}/oauth2/applications/@me", self._get_application)
+        router.add_get(f"{api}/channels/{{channel_id}}", self._get_channel)
+        router.add_post(f"{api}/channels/{{channel_id}}/typing", self._typing)
+        router.add_get(f"{api}/channels/{{channel_id}}/messages", self._history)
+        router.add_post(f"{api}/channels/{{channel_id}}/messages", self._create_message)
+        router.add_get(
+            f"{api}/channels/{{channel_id}}/messages/{{message_id}}", self._get_message
+        )
+        router.add_patch(
+            f"{api}/channels/{{channel_id}}/messages/{{message_id}}", self._edit_message
+        )
+        router.add_delete(
+            f"{api}/channels/{{channel_id}}/messages/{{message_id}}",
+            self._delete_message,
+        )
+        router.add_get("/attachments/{name}", self._get_attachment)
+        self.app.middlewares.append(self._rate_limit)
+
+    def snowflake(self) -> int:
+        ms = int(utcnow().timestamp() * 1000) - DISCORD_EPOCH
+        return (ms << 22) | (next(self._ids) & 0x3FFFFF)
+
+    @property
+    def total_rate_limited(self) -> int:
+        return sum(self.rate_limited.values())
+
+    def add_channel(self, data: dict[str, Any]) -> None:
+        self.channels[int(data["id"])] = data
+
+    def add_attachment(self, filename: str, content: bytes) -> str:
+        self.attachments[filename] = content
+        return f"{self.url}/attachments/{filename}"
+
+    def seed_message(
+        self,
+        channel_id: int,
+        *,
+        author: dict[str, Any],
+        content: str,
+        guild_id: int | None = None,
+        reference_id: int | None = None,
+        attachments: list[dict[str, Any]] | None = None,
+        mentions: list[dict[str, Any]] | None = None,
+    ) -> dict[str, Any]:
+        """Store a message payload as if it had been sent to the channel."""
+        msg_id = self.snowflake()
+        data: dict[str, Any] = dict(
+            id=str(msg_id),
+            channel_id=str(channel_id),
+            author=author,
+            content=content,
+            timestamp=utcnow().isoformat(),
+            edited_timestamp=None,
+            tts=False,
+            mention_everyone=False,
+            mentions=mentions or [],
+            mention_roles=[],
+            attachments=attachments or [],
+            embeds=[],
+            pinned=False,
+            type=19 if reference_id else 0,
+            flags=0,
+        )
+        if guild_id is not None:
+            data["guild_id"] = str(guild_id)
+        if reference_id is not None:
+            data["message_reference"] = dict(
+                message_id=str(reference_id),
+                channel_id=str(channel_id),
+                guild_id=None if guild_id is None else str(guild_id),
+            )
+        self.messages[channel_id][msg_id] = data
+        return data
+
+    @web.middleware
+    async def _rate_limit(
+        self, request: web.Request, handler: Any
+    ) -> web.StreamResponse:
+        if not request.path.startswith("/api/"):
+            return await handler(request)
+
+        template = request.match_info.route.resource.canonical  # type: ignore[union-attr]
+        route = f"{request.method} {template}"
+        self.requests[route] += 1
+
+        now = time.monotonic()
+        limit, per = self.route_limits.get(
+            (request.method, template), DISCORD_DEFAULT_LIMIT
+        )
+        major = request.match_info.get("channel_id", "")
+        bucket = self._buckets.get((request.method, template, major))
+        if bucket is None:
+            bucket = self._buckets[(request.method, template, major)] = _Bucket(
+                limit, per
+            )
+
+        is_global = not self._global_bucket.acquire(now)
+        if is_global or not bucket.acquire(now):
+            self.rate_limited[route] += 1
+            retry_after = (
+                self._global_bucket.reset_at if is_global else bucket.reset_at
+            ) - now
+            return _discord_json(
+                dict(
+                    message="You are being rate limited.",
+                    retry_after=round(max(retry_after, 0.001), 3),
+                    code=0,
+                    **{"global": is_global},
+                ),
+                status=429,
+                headers={
+                    "Retry-After": str(max(1, round(retry_after))),
+                    "X-RateLimit-Scope": "global" if is_global else "user",
+                    "Via": "1.1 google",
+                },
+            )
+
+        response = await handler(request)
+        reset_after = max(bucket.reset_at - now, 0.0)
+        response.headers.update(
+            {
+                "X-RateLimit-Limit": str(bucket.limit),
+                "X-RateLimit-Remaining": str(bucket.remaining),
+                "X-RateLimit-Reset": f"{time.time() + reset_after:.3f}",
+                "X-RateLimit-Reset-After": f"{reset_after:.3f}",
+                "X-RateLimit-Bucket": hashlib.md5(route.encode()).hexdigest(),
+            }
+        )
+        return response
+
+    async def _get_me(self, request: web.Request) -> web.Response:
+        return _discord_json(self.bot_user)
+
+    async def _get_application(self, request: web.Request) -> web.Response:
+        return _discord_json(
+            dict(
+                id=self.bot_user["id"],
+                name="llmcord",
+                icon=None,
+                description="",
+                rpc_origins=[],
+                bot_public=True,
+                bot_require_code_grant=False,
+                owner=self.bot_user,
+                summary="",
+                verify_key="0" * 64,
+                flags=0,
+            )
+        )
+
+    def _channel_id(self, request: web.Request) -> int:
+        return int(request.match_info["channel_id"])
+
+    async def _get_channel(self, request: web.Request) -> web.Response:
+        channel = self.channels.get(self._channel_id(request))
+        if channel is None:
+            return _discord_json(
+                dict(message="Unknown Channel", code=10003), status=404
+            )
+        return _discord_json(channel)
+
+    async def _typing(self, request: web.Request) -> web.Response:
+        return web.Response(status=204)
+
+    async def _history(self, request: web.Request) -> web.Response:
+        messages = self.messages[self._channel_id(request)]
+        before = int(request.query.get("before", 1 << 63))
+        limit = int(request.query.get("limit", 50))
+        ids = sorted((i for i in messages if i < before), reverse=True)[:limit]
+        return _discord_json([messages[i] for i in ids])
+
+    async def _create_message(self, request: web.Request) -> web.Response:
+        if request.content_type.startswith("multipart/"):
+            form = await request.post()
+            body = json.loads(str(form.get("payload_json", "{}")))
+        else:
+            body = await request.json()
+
+        channel_id = self._channel_id(request)
+        reference_id = int((body.get("message_reference") or {}).get("message_id") or 0)
+        data = self.seed_message(
+            channel_id,
+            author=self.bot_user,
+            content=body.get("content") or "",
+            guild_id=(self.channels.get(channel_id) or {}).get("guild_id"),
+            reference_id=reference_id or None,
+        )
+        data["embeds"] = body.get("embeds") or []
+
+        trigger_id = self._reply_to.get(reference_id, reference_id)
+        if trigger_id:
+            self._reply_to[int(data["id"])] = trigger_id
+            if self.on_reply_write is not None:
+                self.on_reply_write(trigger_id, data)
+        return _discord_json(data)
+
+    async def _get_message(self, request: web.Request) -> web.Response:
+        data = self.messages[self._channel_id(request)].get(
+            int(request.match_info["message_id"])
+        )
+        if data is None:
+            return _discord_json(
+                dict(message="Unknown Message", code=10008), status=404
+            )
+        return _discord_json(data)
+
+    async def _edit_message(self, request: web.Request) -> web.Response:
+        msg_id = int(request.match_info["message_id"])
+        data = self.messages[self._channel_id(request)].get(msg_id)
+        if data is None:
+            return _discord_json(
+                dict(message="Unknown Message", code=10008), status=404
+            )
+
+        body = await request.json()
+        if "content" in body:
+            data["content"] = body["content"] or ""
+        if "embeds" in body:
+            data["embeds"] = body["embeds"] or []
+        data["edited_timestamp"] = utcnow().isoformat()
+
+        if (
+            trigger_id := self._reply_to.get(msg_id)
+        ) and self.on_reply_write is not None:
+            self.on_reply_write(trigger_id, data)
+        return _discord_json(data)
+
+    async def _delete_message(self, request: web.Request) -> web.Response:
+        self.messages[self._channel_id(request)].pop(
+            int(request.match_info["message_id"]), None
+        )
+        return web.Response(status=204)
+
+    async def _get_attachment(self, request: web.Request) -> web.Response:
+        content = self.attachments.get(request.match_info["name"])
+        if content is None:
+            return web.Response(status=404)
+        return web.Response(body=content, content_type="text/plain")
+
+
+__all__ = ["DISCORD_ROUTE_LIMITS", "FakeDiscord", "FakeOpenAI"]
@@ -0,0 +1,264 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import urllib.error
+import urllib.request
+from collections import deque
+from collections.abc import Callable
+from typing import Any
+
+from aiohttp import web
+
+from .config import get_config
+from .log import stop_logging
+from .metrics import metrics, percentile
+from .providers import provider_health
+from .tasks import RequestRegistry
+
+LAG_INTERVAL_SECONDS = 0.1
+# Lag samples (and stalls) older than this are dropped
+LAG_WINDOW_SECONDS = 60.0
+MAX_STALLS_KEPT = 20
+
+
+class LoopMonitor:
+    """Measures event loop scheduling lag and samples what blocks it.
+
+    A task on the loop wakes every 100 ms and records how late it ran. A watchdog
+    thread checks that those wakeups keep coming: when the loop has been stuck in one
+    callback for longer than `block_threshold_ms`, it logs the loop thread's stack (so
+    the blocking code shows up), once per stall. Optionally it exits the process after
+    `exit_after_seconds` so the container's restart policy replaces it.
+    """
+
+    def __init__(self) -> None:
+        self.block_threshold = 0.25
+        self.exit_after = 0.0
+
+        self._samples: deque[tuple[float, float]] = deque()
+        self._stalls: deque[dict[str, Any]] = deque(maxlen=MAX_STALLS_KEPT)
+        self._last_tick = time.monotonic()
+        self._ticks = 0
+        self._loop_thread_id: int | None = None
+        self._task: asyncio.Task | None = None
+        self._thread: threading.Thread | None = None
+        self._stop = threading.Event()
+
+    def configure(self, config: dict[str, Any]) -> None:
+        health_cfg = config.get("health") or {}
+        self.block_threshold = health_cfg.get("block_threshold_ms", 250) / 1000
+        self.exit_after = health_cfg.get("exit_after_seconds", 0) or 0
+
+    def start(self) -> None:
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._last_tick = time.monotonic()
+        self._task = asyncio.create_task(self._measure())
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._watch, name="llmcord-loop-watchdog", daemon=True
+        )
+        self._thread.start()
+
+    async def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _measure(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + LAG_INTERVAL_SECONDS
+            await asyncio.sleep(LAG_INTERVAL_SECONDS)
+            lag = max(0.0, loop.time() - expected)
+            now = time.monotonic()
+            self._last_tick = now
+            self._ticks += 1
+            self._samples.append((now, lag))
+            while self._samples and now - self._samples[0][0] > LAG_WINDOW_SECONDS:
+                self._samples.popleft()
+            if lag > self.block_threshold:
+                metrics.incr("loop_lag_over_threshold")
+
+    def _watch(self) -> None:
+        sampled_tick = -1
+        while not self._stop.wait(LAG_INTERVAL_SECONDS):
+            ticks = self._ticks
+            blocked = time.monotonic() - self._last_tick - LAG_INTERVAL_SECONDS
+            if blocked <= self.block_threshold:
+                continue
+
+            if sampled_tick != ticks:
+                # First sample of this stall: record what the loop thread is running
+                sampled_tick = ticks
+                frame = sys._current_frames().get(self._loop_thread_id or 0)
+                stack = "".join(traceback.format_stack(frame)) if frame else ""
+                self._stalls.append(
+                    dict(at=time.time(), blocked_ms=round(blocked * 1000), stack=stack)
+                )
+                metrics.incr("loop_stalls")
+                logging.warning(
+                    "Event loop blocked for %.0f ms; loop thread stack:\n%s",
+                    blocked * 1000,
+                    stack,
+                )
+
+            if self.exit_after and blocked > self.exit_after:
+                logging.critical(
+                    "Event loop blocked for %.0fs, exiting so the bot is restarted",
+                    blocked,
+                )
+                stop_logging()
+                os._exit(1)
+
+    def lag_stats(self) -> dict[str, float]:
+        """Lag percentiles in milliseconds over the last minute."""
+        lags = [lag * 1000 for _, lag in self._samples]
+        # A blocked loop doesn't record samples; count the current stall too
+        current = (time.monotonic() - self._last_tick - LAG_INTERVAL_SECONDS) * 1000
+        return dict(
+            p50=round(percentile(lags, 50), 1),
+            p99=round(percentile(lags, 99), 1),
+            max=round(max(lags, default=0.0), 1),
+            current=round(max(0.0, current), 1),
+        )
+
+    def recent_stalls(self) -> list[dict[str, Any]]:
+        now = time.time()
+        return [s for s in self._stalls if now - s["at"] <= LAG_WINDOW_SECONDS]
+
+
+loop_monitor = LoopMonitor()
+
+
+class HealthServer:
+    """Local HTTP endpoints for container health checks and orchestrators.
+
+    `/healthz` fails (503) when lag over the last minute, or the age of the oldest
+    in-flight reply, exceeds its limit. `/readyz` fails while the bot isn't connected
+    or is draining for shutdown. `/metrics` returns the in-process counters.
+    """
+
+    def __init__(
+        self,
+        monitor: LoopMonitor,
+        requests: RequestRegistry,
+        is_ready: Callable[[], bool],
+    ) -> None:
+        self.monitor = monitor
+        self.requests = requests
+        self.is_ready = is_ready
+        self.max_lag_ms = 1000.0
+        self.max_request_seconds = 600.0
+
+        self.app = web.Application()
+        self.app.router.add_get("/healthz", self._healthz)
+        self.app.router.add_get("/readyz", self._readyz)
+        self.app.router.add_get("/metrics", self._metrics)
+        self._runner: web.AppRunner | None = None
+
+    def configure(self, config: dict[str, Any]) -> None:
+        health_cfg = config.get("health") or {}
+        self.max_lag_ms = health_cfg.get("max_lag_ms", 1000)
+        self.max_request_seconds = health_cfg.get("max_request_seconds", 600)
+
+    async def start(self, host: str, port: int) -> None:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logging.info("Health endpoints listening on http://%s:%d", host, port)
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def status(self) -> tuple[bool, dict[str, Any]]:
+        lag = self.monitor.lag_stats()
+        now = time.monotonic()
+        stuck = [
+            trigger_id
+            for trigger_id, request in self.requests.items()
+            if now - request.started > self.max_request_seconds
+        ]
+        problems = []
+        if max(lag["p99"], lag["current"]) > self.max_lag_ms:
+            problems.append("loop_lag")
+        if stuck:
+            problems.append("stuck_requests")
+        return not problems, dict(
+            ok=not problems,
+            problems=problems,
+            lag_ms=lag,
+            in_flight=len(self.requests),
+            stuck_requests=[str(trigger_id) for trigger_id in stuck],
+            recent_stalls=[
+                dict(s, stack=s["stack"].splitlines()[-6:])
+                for s in self.monitor.recent_stalls()
+            ],
+        )
+
+    async def _healthz(self, request: web.Request) -> web.Response:
+        ok, body = self.status()
+        return web.json_response(body, status=200 if ok else 503)
+
+    async def _readyz(self, request: web.Request) -> web.Response:
+        ready = self.is_ready()
+        return web.json_response(dict(ready=ready), status=200 if ready else 503)
+
+    async def _metrics(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            dict(
+                loop_lag_ms=self.monitor.lag_stats(),
+                in_flight=len(self.requests),
+                providers=provider_health.status(),
+                counters=metrics.snapshot(),
+            )
+        )
+
+
+def healthcheck(options: argparse.Namespace) -> None:
+    """Exit 0 if /healthz passes (or health endpoints are disabled), else 1."""
+    health_cfg = get_config(options.config).get("health") or {}
+    if not health_cfg.get("enabled", False):
+        return
+    host = health_cfg.get("host", "127.0.0.1")
+    if host in ("0.0.0.0", "::", ""):
+        host = "127.0.0.1"
+    url = f"http://{host}:{health_cfg.get('port', 8080)}/healthz"
+    try:
+        with urllib.request.urlopen(url, timeout=options.timeout) as response:
+            ok = response.status == 200
+    except (urllib.error.URLError, OSError) as e:
+        print(f"Health check failed: {e}", file=sys.stderr)
+        ok = False
+    if not ok:
+        sys.exit(1)
+
+
+def add_parser(subparsers: Any) -> None:
+    parser = subparsers.add_parser(
+        "healthcheck",
+        help="Check a running bot's /healthz (for container health checks)",
+        description=healthcheck.__doc__,
+    )
+    parser.add_argument("--config", default="config.yaml")
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=5.0,
+        help="Seconds to wait for a response (default: 5)",
+    )
+    parser.set_defaults(func=healthcheck)
+
+
+__all__ = ["HealthServer", "LoopMonitor", "add_parser", "loop_monitor"]
@@ -0,0 +1,263 @@
+from __future__ import annotations
+
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
+
+import discord
+
+from .auth import is_channel_allowed
+from .metrics import metrics
+
+# Rough per-message cost of a record and its containers, on top of its text
+RECORD_OVERHEAD_BYTES = 600
+ATTACHMENT_OVERHEAD_BYTES = 200
+EMBED_OVERHEAD_BYTES = 500
+
+
+@dataclass(frozen=True, slots=True)
+class SeenAttachment:
+    id: int
+    url: str
+    filename: str
+    content_type: str | None
+    size: int
+
+
+@dataclass(frozen=True, slots=True)
+class SeenReference:
+    message_id: int | None
+    channel_id: int
+    # The referenced message is looked up in the history instead
+    cached_message: None = None
+
+
+@dataclass(slots=True)
+class SeenMessage:
+    """The parts of a gateway message that conversations are resolved from.
+
+    Stands in for discord.Message in build_conversation_context without keeping the
+    message's object graph (mentions, resolved references, state) alive.
+    """
+
+    id: int
+    channel: Any
+    author: Any
+    type: discord.MessageType
+    content: str
+    reference: SeenReference | None
+    attachments: tuple[SeenAttachment, ...]
+    embeds: tuple[discord.Embed, ...]
+    # Estimated bytes held, for the global budget
+    size: int
+
+    @classmethod
+    def from_message(cls, msg: discord.Message) -> SeenMessage:
+        attachments = tuple(
+            SeenAttachment(att.id, att.url, att.filename, att.content_type, att.size)
+            for att in msg.attachments
+        )
+        reference = msg.reference
+        size = (
+            RECORD_OVERHEAD_BYTES
+            + len(msg.content)
+            + sum(
+                ATTACHMENT_OVERHEAD_BYTES + len(att.url) + len(att.filename)
+                for att in attachments
+            )
+            + sum(
+                EMBED_OVERHEAD_BYTES
+                + len(embed.title or "")
+                + len(embed.description or "")
+                for embed in msg.embeds
+            )
+        )
+        return cls(
+            id=msg.id,
+            channel=msg.channel,
+            author=msg.author,
+            type=msg.type,
+            content=msg.content,
+            reference=(
+                SeenReference(reference.message_id, reference.channel_id)
+                if reference is not None
+                else None
+            ),
+            attachments=attachments,
+            embeds=tuple(msg.embeds),
+            size=size,
+        )
+
+
+class MessageHistory:
+    """The latest messages seen on the gateway in each allowed channel, oldest first.
+
+    Every message from an allowed channel is recorded as it arrives (including the
+    bot's own, kept current through edits), up to `depth` per channel and `max_mb`
+    overall, evicting from the least recently active channels first. Parent lookups
+    consult it before falling back to REST. Since a channel's messages are recorded
+    without gaps, it also answers "which message came before this one" for any
+    recorded message except the oldest, which is what the same-author continuation
+    rule needs.
+    """
+
+    def __init__(self) -> None:
+        self.depth = 200
+        self.max_bytes = 16 * 2**20
+        self.size = 0
+        self._config: dict[str, Any] = {}
+
+        # Channel ID -> its records by message ID (ascending); least recently active
+        # channels first
+        self._channels: OrderedDict[int, OrderedDict[int, SeenMessage]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return sum(len(messages) for messages in self._channels.values())
+
+    def configure(self, config: dict[str, Any]) -> None:
+        history_cfg = config.get("message_history") or {}
+        self._config = config
+        depth = history_cfg.get("depth", 200) or 0
+        self.max_bytes = int((history_cfg.get("max_mb", 16) or 0) * 2**20)
+        if depth != self.depth:
+            self.depth = depth
+            for channel_id in list(self._channels):
+                self._trim(channel_id)
+        self._evict()
+
+    def _is_recorded(self, msg: discord.Message) -> bool:
+        return is_channel_allowed(
+            channel=msg.channel,
+            config=self._config,
+            is_dm=msg.channel.type == discord.ChannelType.private,
+        )
+
+    def observe(self, msg: discord.Message) -> None:
+        """Record a message received on the gateway."""
+        if not self.depth or not self._config or not self._is_recorded(msg):
+            return
+        channel_id = msg.channel.id
+        messages = self._channels.get(channel_id)
+        if messages is None:
+            messages = self._channels[channel_id] = OrderedDict()
+        else:
+            self._channels.move_to_end(channel_id)
+            if msg.id in messages:
+                self.update(msg)
+                return
+            if messages and msg.id < next(reversed(messages)):
+                # Gateway events arrive in order, so this only follows a gap; what
+                # came before is unknown again
+                self._drop_channel(channel_id)
+                messages = self._channels[channel_id] = OrderedDict()
+
+        record = SeenMessage.from_message(msg)
+        messages[msg.id] = record
+        self.size += record.size
+        self._trim(channel_id)
+        self._evict()
+
+    def update(self, msg: discord.Message) -> None:
+        """Replace the record of an edited message, if it is recorded."""
+        messages = self._channels.get(msg.channel.id)
+        if messages is None or (old := messages.get(msg.id)) is None:
+            return
+        record = SeenMessage.from_message(msg)
+        messages[msg.id] = record
+        self.size += record.size - old.size
+        self._evict()
+
+    def forget(self, channel_id: int, msg_id: int) -> None:
+        """Drop a deleted message (the one before it becomes its successor's previous)."""
+        messages = self._channels.get(channel_id)
+        if messages is not None and (record := messages.pop(msg_id, None)) is not None:
+            self.size -= record.size
+
+    def clear(self) -> None:
+        """Forget everything, e.g. after a gateway session was replaced and events may
+        have been missed."""
+        self._channels.clear()
+        self.size = 0
+
+    def get(
+        self, channel_id: int, msg_id: int, *, lookup: str | None = None
+    ) -> SeenMessage | None:
+        """The recorded message, counting a hit or miss for `lookup` if given."""
+        messages = self._channels.get(channel_id)
+        record = messages.get(msg_id) if messages is not None else None
+        if lookup is not None:
+            self._score(record is not None, lookup)
+        return record
+
+    def previous(
+        self, channel_id: int, msg_id: int, *, lookup: str | None = None
+    ) -> tuple[bool, SeenMessage | None]:
+        """The message right before msg_id in its channel, as (known, message).
+
+        Only known when msg_id is recorded and isn't the channel's oldest record.
+        """
+        messages = self._channels.get(channel_id)
+        found: tuple[bool, SeenMessage | None] = (False, None)
+        if messages is not None:
+            # Lookups are nearly always for recent messages, at the end
+            ids = reversed(messages)
+            for key in ids:
+                if key == msg_id:
+                    if (previous_id := next(ids, None)) is not None:
+                        found = (True, messages[previous_id])
+                    break
+                if key < msg_id:
+                    break
+        if lookup is not None:
+            self._score(found[0], lookup)
+        return found
+
+    def _score(self, hit: bool, lookup: str) -> None:
+        if not self.depth:
+            return
+        metrics.incr(
+            "message_history_hits" if hit else "message_history_misses", lookup=lookup
+        )
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            hits = metrics.get("message_history_hits", lookup=lookup)
+            misses = metrics.get("message_history_misses", lookup=lookup)
+            logging.debug(
+                "Message history %s for %s lookup (hit rate %.1f%% of %d)",
+                "hit" if hit else "miss",
+                lookup,
+                hits / (hits + misses) * 100,
+                hits + misses,
+            )
+
+    def _trim(self, channel_id: int) -> None:
+        messages = self._channels[channel_id]
+        while len(messages) > self.depth:
+            _, record = messages.popitem(last=False)
+            self.size -= record.size
+        if not messages:
+            del self._channels[channel_id]
+
+    def _drop_channel(self, channel_id: int) -> None:
+        messages = self._channels.pop(channel_id)
+        self.size -= sum(record.size for record in messages.values())
+
+    def _evict(self) -> None:
+        while self.size > self.max_bytes and self._channels:
+            channel_id, messages = next(iter(self._channels.items()))
+            _, record = messages.popitem(last=False)
+            self.size -= record.size
+            if not messages:
+                del self._channels[channel_id]
+
+
+message_history = MessageHistory()
+
+
+__all__ = [
+    "MessageHistory",
+    "SeenAttachment",
+    "SeenMessage",
+    "SeenReference",
+    "message_history",
+]
@@ -0,0 +1,522 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+import discord
+import httpx
+import yaml
+
+from .config import get_config
+from .log import setup_logging
+from .metrics import percentile
+from .providers import get_openai_client
+from .tracing import tracer
+
+if TYPE_CHECKING:
+    from .fakes import FakeDiscord, FakeOpenAI
+
+LOOP_LAG_INTERVAL_SECONDS = 0.05
+STAGE_END_CANCEL_REASON = "load test stage ended"
+
+
+@dataclass
+class StageResult:
+    rate: float
+    sent: int
+    completed: int
+    no_output: int
+    first_edit_p50: float
+    first_edit_p95: float
+    first_edit_p99: float
+    completion_p50: float
+    completion_p95: float
+    completion_p99: float
+    loop_lag_p99_ms: float
+    loop_lag_max_ms: float
+    rss_mb: float
+    discord_requests: int
+    discord_429s: int
+    provider_peak_streams: int
+
+
+def current_rss_mb() -> float:
+    try:
+        with open("/proc/self/statm", encoding="ascii") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        # Peak rather than current RSS (kilobytes on Linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class _World:
+    """Synthetic guilds, channels and members registered with the bot's connection state."""
+
+    def __init__(
+        self,
+        fake: FakeDiscord,
+        state: Any,
+        rng: random.Random,
+        *,
+        guilds: int,
+        channels_per_guild: int,
+        guild_sizes: list[int],
+    ) -> None:
+        self.fake = fake
+        self.state = state
+        self.rng = rng
+        self.bot_user = fake.bot_user
+        self.channels: list[tuple[discord.TextChannel, list[dict[str, Any]]]] = []
+        self._attachment_ids = 0
+
+        for g in range(guilds):
+            guild_id = fake.snowflake()
+            users = [
+                dict(
+                    id=str(fake.snowflake()),
+                    username=f"user{g}_{i}",
+                    discriminator="0",
+                    global_name=f"User {g}.{i}",
+                    avatar=None,
+                )
+                for i in range(guild_sizes[g % len(guild_sizes)])
+            ]
+            channel_payloads = [
+                dict(
+                    id=str(fake.snowflake()),
+                    type=0,
+                    guild_id=str(guild_id),
+                    name=f"general-{c}",
+                    position=c,
+                    permission_overwrites=[],
+                    nsfw=False,
+                    parent_id=None,
+                )
+                for c in range(channels_per_guild)
+            ]
+            guild = state._add_guild_from_data(
+                dict(
+                    id=str(guild_id),
+                    name=f"Load test guild {g}",
+                    icon=None,
+                    owner_id=users[0]["id"] if users else self.bot_user["id"],
+                    member_count=len(users) + 1,
+                    features=[],
+                    emojis=[],
+                    stickers=[],
+                    roles=[
+                        dict(
+                            id=str(guild_id),
+                            name="@everyone",
+                            permissions="0",
+                            position=0,
+                            color=0,
+                            hoist=False,
+                            managed=False,
+                            mentionable=False,
+                        )
+                    ],
+                    channels=channel_payloads,
+                    members=[
+                        dict(
+                            user=user,
+                            roles=[],
+                            joined_at=None,
+                            deaf=False,
+                            mute=False,
+                            flags=0,
+                        )
+                        for user in [self.bot_user, *users]
+                    ],
+                )
+            )
+            for payload in channel_payloads:
+                fake.add_channel(payload)
+                channel = guild.get_channel(int(payload["id"]))
+                assert isinstance(channel, discord.TextChannel)
+                self.channels.append((channel, users))
+
+    def _attachment(self) -> dict[str, Any]:
+        self._attachment_ids += 1
+        filename = f"notes{self._attachment_ids}.txt"
+        size = self.rng.randint(1024, 16 * 1024)
+        content = ("lorem ipsum dolor sit amet " * (size // 27 + 1))[:size].encode()
+        url = self.fake.add_attachment(filename, content)
+        return dict(
+            id=str(self.fake.snowflake()),
+            filename=filename,
+            size=size,
+            url=url,
+            proxy_url=url,
+            content_type="text/plain; charset=utf-8",
+        )
+
+    def make_event(self, *, depth: int, with_attachment: bool) -> discord.Message:
+        """Seed a reply chain of `depth` earlier messages and return a new mention."""
+        channel, users = self.rng.choice(self.channels)
+        user = self.rng.choice(users) if users else self.bot_user
+        mention = f"<@{self.bot_user['id']}>"
+
+        reference_id = None
+        for i in range(depth):
+            from_bot = i % 2 == 1
+            seeded = self.fake.seed_message(
+                channel.id,
+                author=self.bot_user if from_bot else user,
+                content=f"{'answer' if from_bot else mention + ' question'} {i} "
+                + "filler " * self.rng.randint(5, 60),
+                guild_id=channel.guild.id,
+                reference_id=reference_id,
+                mentions=[] if from_bot else [self.bot_user],
+            )
+            reference_id = int(seeded["id"])
+
+        data = self.fake.seed_message(
+            channel.id,
+            author=user,
+            content=f"{mention} how does this work? "
+            + "context " * self.rng.randint(0, 40),
+            guild_id=channel.guild.id,
+            reference_id=reference_id,
+            attachments=[self._attachment()] if with_attachment else [],
+            mentions=[self.bot_user],
+        )
+        return self.state.create_message(channel=channel, data=data)
+
+
+async def _monitor_loop_lag(samples: list[float]) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + LOOP_LAG_INTERVAL_SECONDS
+        await asyncio.sleep(LOOP_LAG_INTERVAL_SECONDS)
+        samples.append(max(0.0, loop.time() - expected))
+
+
+def _write_config(options: argparse.Namespace, base_url: str, directory: str) -> None:
+    base: dict[str, Any] = {}
+    if options.config and os.path.exists(options.config):
+        with open(options.config, encoding="utf-8") as file:
+            base = yaml.safe_load(file) or {}
+
+    # Keep the user's prompt and behaviour settings, but never their secrets/providers
+    config = {
+        k: v
+        for k, v in base.items()
+        if k not in ("bot_token", "providers", "models", "permissions", "workers")
+    }
+    config.update(
+        bot_token="loadtest",
+        client_id=None,
+        status_message=None,
+        providers=dict(loadtest=dict(base_url=base_url)),
+        models={"loadtest/fake": None},
+        permissions=dict(
+            users=dict(admin_ids=[], allowed_ids=[], blocked_ids=[]),
+            roles=dict(allowed_ids=[], blocked_ids=[]),
+            channels=dict(allowed_ids=[], blocked_ids=[]),
+        ),
+        logging=(base.get("logging") or {}) | dict(level=options.log_level),
+    )
+    config.setdefault(
+        "system_prompt", "You are a helpful Discord bot.\nServer members:\n{users}"
+    )
+    with open(os.path.join(directory, "config.yaml"), "w", encoding="utf-8") as file:
+        yaml.safe_dump(config, file)
+
+
+async def _run_stage(
+    bot: Any,
+    world: _World,
+    fake_discord: FakeDiscord,
+    fake_openai: FakeOpenAI,
+    options: argparse.Namespace,
+    rng: random.Random,
+    rate: float,
+    lag_samples: list[float],
+    first_write: dict[int, float],
+) -> StageResult:
+    started: dict[int, float] = {}
+    finished: dict[int, float] = {}
+    pending: list[asyncio.Future[Any]] = []
+
+    lag_samples.clear()
+    requests_before = sum(fake_discord.requests.values())
+    limited_before = fake_discord.total_rate_limited
+    fake_openai.peak_active = fake_openai.active
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + options.duration
+    next_at = loop.time()
+    while True:
+        # Poisson arrivals on an absolute schedule, so slow dispatch doesn't lower the rate
+        next_at += rng.expovariate(rate)
+        if next_at >= deadline:
+            break
+        await asyncio.sleep(max(0.0, next_at - loop.time()))
+
+        msg = world.make_event(
+            depth=rng.choice(options.depths),
+            with_attachment=rng.random() < options.attachment_ratio,
+        )
+        started[msg.id] = time.perf_counter()
+        await bot.on_message(msg)
+        if (request := bot.active_requests.get(msg.id)) is None:
+            continue
+        request.task.add_done_callback(
+            lambda _, msg_id=msg.id: finished.setdefault(msg_id, time.perf_counter())
+        )
+        pending.append(request.task)
+
+    if pending:
+        await asyncio.wait(pending, timeout=options.drain_timeout)
+    for trigger_id, request in bot.active_requests.items():
+        bot.active_requests.cancel(trigger_id, STAGE_END_CANCEL_REASON)
+        pending.append(request.task)
+    if pending:
+        await asyncio.wait(pending, timeout=5)
+
+    first_edit = [first_write[i] - t for i, t in started.items() if i in first_write]
+    completion = [finished[i] - started[i] for i in finished]
+    lag_ms = [lag * 1000 for lag in lag_samples]
+    return StageResult(
+        rate=rate,
+        sent=len(started),
+        completed=len(finished),
+        no_output=sum(1 for i in started if i not in first_write),
+        first_edit_p50=percentile(first_edit, 50),
+        first_edit_p95=percentile(first_edit, 95),
+        first_edit_p99=percentile(first_edit, 99),
+        completion_p50=percentile(completion, 50),
+        completion_p95=percentile(completion, 95),
+        completion_p99=percentile(completion, 99),
+        loop_lag_p99_ms=percentile(lag_ms, 99),
+        loop_lag_max_ms=max(lag_ms, default=0.0),
+        rss_mb=current_rss_mb(),
+        discord_requests=sum(fake_discord.requests.values()) - requests_before,
+        discord_429s=fake_discord.total_rate_limited - limited_before,
+        provider_peak_streams=fake_openai.peak_active,
+    )
+
+
+async def run_loadtest(options: argparse.Namespace) -> list[StageResult]:
+    """Drive `on_message` with synthetic mentions at increasing arrival rates.
+
+    Replies are generated in-process against a local fake provider and posted to a
+    fake Discord REST API that enforces rate limits, so results are reproducible and
+    nothing leaves the machine.
+    """
+    from . import bot
+    from .fakes import FakeDiscord, FakeOpenAI
+
+    rng = random.Random(options.seed)
+    fake_openai = FakeOpenAI(
+        latency=options.latency,
+        token_interval=options.token_interval,
+        completion_tokens=options.tokens,
+    )
+    fake_discord = FakeDiscord(global_limit=options.global_rate_limit)
+    await fake_openai.start()
+    await fake_discord.start()
+
+    original_base = discord.http.Route.BASE
+    original_cwd = os.getcwd()
+    workdir = tempfile.TemporaryDirectory(prefix="llmcord-loadtest-")
+    lag_samples: list[float] = []
+    lag_monitor = asyncio.create_task(_monitor_loop_lag(lag_samples))
+    results: list[StageResult] = []
+    try:
+        _write_config(options, fake_openai.base_url, workdir.name)
+        os.chdir(workdir.name)
+        bot.config = get_config()
+        setup_logging(bot.config)
+        # Rate limits are counted by the fake server; discord.py's warnings are noise here
+        logging.getLogger("discord.http").setLevel(logging.ERROR)
+        tracer.configure(bot.config)
+        bot.curr_model = next(iter(bot.config["models"]))
+        bot.httpx_client = httpx.AsyncClient()
+        # Import the provider SDK up front so it doesn't show up as first-stage loop lag
+        get_openai_client(bot.config["providers"]["loadtest"])
+
+        discord.http.Route.BASE = f"{fake_discord.url}/api/v10"
+        await bot.discord_bot.login(bot.config["bot_token"])
+
+        world = _World(
+            fake_discord,
+            bot.discord_bot._connection,
+            rng,
+            guilds=options.guilds,
+            channels_per_guild=options.channels_per_guild,
+            guild_sizes=options.guild_sizes,
+        )
+        first_write: dict[int, float] = {}
+        fake_discord.on_reply_write = lambda trigger_id, _: first_write.setdefault(
+            trigger_id, time.perf_counter()
+        )
+
+        print(_format_header())
+        for rate in options.rates:
+            result = await _run_stage(
+                bot,
+                world,
+                fake_discord,
+                fake_openai,
+                options,
+                rng,
+                rate,
+                lag_samples,
+                first_write,
+            )
+            results.append(result)
+            print(_format_row(result), flush=True)
+    finally:
+        lag_monitor.cancel()
+        os.chdir(original_cwd)
+        workdir.cleanup()
+        if bot.httpx_client is not None:
+            await bot.httpx_client.aclose()
+        await bot.discord_bot.close()
+        discord.http.Route.BASE = original_base
+        await fake_discord.stop()
+        await fake_openai.stop()
+
+    if options.json:
+        await asyncio.to_thread(
+            Path(options.json).write_text,
+            json.dumps([asdict(r) for r in results], indent=2),
+            encoding="utf-8",
+        )
+    return results
+
+
+_COLUMNS = (
+    ("rate/s", 7),
+    ("sent", 6),
+    ("done", 6),
+    ("no out", 7),
+    ("first edit p50/p95/p99 s", 25),
+    ("complete p50/p95/p99 s", 25),
+    ("lag p99/max ms", 16),
+    ("rss MB", 8),
+    ("REST", 7),
+    ("429s", 6),
+)
+
+
+def _format_header() -> str:
+    return " ".join(name.rjust(width) for name, width in _COLUMNS)
+
+
+def _format_row(r: StageResult) -> str:
+    values = (
+        f"{r.rate:g}",
+        str(r.sent),
+        str(r.completed),
+        str(r.no_output),
+        f"{r.first_edit_p50:.2f}/{r.first_edit_p95:.2f}/{r.first_edit_p99:.2f}",
+        f"{r.completion_p50:.2f}/{r.completion_p95:.2f}/{r.completion_p99:.2f}",
+        f"{r.loop_lag_p99_ms:.0f}/{r.loop_lag_max_ms:.0f}",
+        f"{r.rss_mb:.0f}",
+        str(r.discord_requests),
+        str(r.discord_429s),
+    )
+    return " ".join(v.rjust(width) for v, (_, width) in zip(values, _COLUMNS))
+
+
+def _floats(value: str) -> list[float]:
+    return [float(x) for x in value.split(",") if x]
+
+
+def _ints(value: str) -> list[int]:
+    return [int(x) for x in value.split(",") if x]
+
+
+def add_parser(subparsers: Any) -> None:
+    parser = subparsers.add_parser(
+        "loadtest",
+        help="Measure latency and saturation under synthetic concurrent mentions",
+        description=run_loadtest.__doc__,
+    )
+    parser.add_argument(
+        "--rates",
+        type=_floats,
+        default=[1, 2, 5, 10, 20],
+        help="Mentions per second for each stage (default: 1,2,5,10,20)",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=20,
+        help="Seconds of arrivals per stage (default: 20)",
+    )
+    parser.add_argument(
+        "--drain-timeout",
+        type=float,
+        default=60,
+        help="Seconds to wait for a stage's replies before cancelling them (default: 60)",
+    )
+    parser.add_argument("--guilds", type=int, default=20)
+    parser.add_argument("--channels-per-guild", type=int, default=3)
+    parser.add_argument(
+        "--guild-sizes",
+        type=_ints,
+        default=[10, 200, 2000],
+        help="Member counts cycled across guilds (default: 10,200,2000)",
+    )
+    parser.add_argument(
+        "--depths",
+        type=_ints,
+        default=[0, 1, 4, 12],
+        help="Reply chain depths picked at random (default: 0,1,4,12)",
+    )
+    parser.add_argument(
+        "--attachment-ratio",
+        type=float,
+        default=0.2,
+        help="Fraction of mentions with a text attachment (default: 0.2)",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.5,
+        help="Fake provider time to first token in seconds (default: 0.5)",
+    )
+    parser.add_argument(
+        "--token-interval",
+        type=float,
+        default=0.02,
+        help="Fake provider seconds between tokens (default: 0.02)",
+    )
+    parser.add_argument(
+        "--tokens",
+        type=int,
+        default=200,
+        help="Completion tokens per reply (default: 200)",
+    )
+    parser.add_argument(
+        "--global-rate-limit",
+        type=int,
+        default=50,
+        help="Fake Discord global requests per second (default: 50)",
+    )
+    parser.add_argument(
+        "--config",
+        default="config.yaml",
+        help="Config to take prompt/behaviour settings from (providers and secrets are ignored)",
+    )
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write per-stage results to this JSON file")
+    parser.set_defaults(func=lambda options: asyncio.run(run_loadtest(options)))
+
+
+__all__ = ["StageResult", "add_parser", "run_loadtest"]
@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+import atexit
+import copy
+import json
+import logging
+import queue
+import random
+import sys
+from contextvars import ContextVar, Token
+from datetime import UTC, datetime
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any
+
+from .metrics import metrics
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s: %(message)s"
+
+# Attributes present on every LogRecord; anything else was passed through `extra=`
+_RESERVED_RECORD_ATTRS = frozenset(
+    vars(logging.LogRecord("", 0, "", 0, "", None, None)).keys()
+) | {"message", "asctime", "taskName"}
+
+# Request-scoped fields (request_id, guild_id, channel_id, user_id) added to every record
+request_context: ContextVar[dict[str, Any]] = ContextVar("request_context")
+
+_content_mode: str = "truncate"
+_content_max_chars: int = 200
+_listener: QueueListener | None = None
+
+
+def bind_request(**fields: Any) -> Token[dict[str, Any]]:
+    """Attach fields to all log records emitted from the current task."""
+    return request_context.set({**request_context.get({}), **fields})
+
+
+def format_content(text: str | None) -> str:
+    """Apply the configured redaction/truncation policy to user or model content."""
+    if not text:
+        return ""
+    if _content_mode == "redact":
+        return f"<redacted {len(text)} chars>"
+    if _content_mode == "truncate" and len(text) > _content_max_chars:
+        return text[:_content_max_chars] + "… (truncated)"
+    return text
+
+
+class RequestContextFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in request_context.get({}).items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class DebugSampler(logging.Filter):
+    """Let through only a fraction of DEBUG records; other levels always pass."""
+
+    def __init__(self, rate: float) -> None:
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Queue handler that drops records instead of blocking when the queue is full."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Records never leave the process, so keep exc_info and let the listener
+        # thread do the (comparatively expensive) traceback formatting.
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.incr("log_records_dropped")
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload: dict[str, Any] = {
+            "ts": datetime.fromtimestamp(record.created, UTC).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        payload.update(
+            (key, value)
+            for key, value in vars(record).items()
+            if key not in _RESERVED_RECORD_ATTRS
+        )
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, default=str, ensure_ascii=False)
+
+
+def setup_logging(config: dict[str, Any]) -> QueueListener:
+    """Route all logging through a bounded queue drained by a background thread.
+
+    The event loop only ever pays for a `put_nowait`; formatting and writes to a slow
+    stdout/stderr (e.g. Docker log drivers) happen on the listener thread.
+    """
+    global _content_mode, _content_max_chars, _listener
+
+    log_cfg = config.get("logging") or {}
+    _content_mode = log_cfg.get("content", "truncate")
+    _content_max_chars = log_cfg.get("content_max_chars", 200)
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(
+        JsonFormatter()
+        if log_cfg.get("format", "text") == "json"
+        else logging.Formatter(TEXT_FORMAT)
+    )
+
+    queue_handler = NonBlockingQueueHandler(
+        queue.Queue(maxsize=log_cfg.get("queue_size", 10000))
+    )
+    queue_handler.addFilter(RequestContextFilter())
+    queue_handler.addFilter(DebugSampler(log_cfg.get("debug_sample_rate", 0.01)))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(log_cfg.get("level", "INFO"))
+
+    if _listener is None:
+        atexit.register(stop_logging)
+    else:
+        stop_logging()
+    _listener = QueueListener(
+        queue_handler.queue, stream_handler, respect_handler_level=True
+    )
+    _listener.start()
+    return _listener
+
+
+def stop_logging() -> None:
+    """Flush queued records and stop the listener thread."""
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+
+__all__ = [
+    "DebugSampler",
+    "JsonFormatter",
+    "NonBlockingQueueHandler",
+    "RequestContextFilter",
+    "bind_request",
+    "format_content",
+    "request_context",
+    "setup_logging",
+    "stop_logging",
+]
@@ -0,0 +1,546 @@
+from __future__ import annotations
+
+import asyncio
+import datetime as dt
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Iterable
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+import discord
+
+from .auth import is_authorized
+from .constants import MEMORY_PROMPT_HEADER
+from .metrics import metrics
+from .providers import get_openai_client
+
+try:
+    import numpy as np
+except ImportError:  # Optional: install the `memory` extra to enable channel memory
+    np = None  # type: ignore[assignment]
+
+if TYPE_CHECKING:
+    from numpy.typing import NDArray
+
+    from .messages import MsgNode
+
+
+# Rows are scored in chunks of this many vectors to bound temporary memory
+SEARCH_CHUNK_ROWS = 65536
+# Messages waiting to be embedded beyond this are dropped (oldest first)
+MAX_PENDING_MESSAGES = 10000
+# Query vectors kept so an in-process trigger message isn't embedded twice
+MAX_CACHED_VECTORS = 1000
+EMBED_TIMEOUT_SECONDS = 10.0
+
+ROW_DTYPE: Any = (
+    np.dtype(
+        [
+            ("msg_id", "<i8"),
+            ("channel_id", "<i8"),
+            ("author_id", "<i8"),
+            ("text_offset", "<i8"),
+            ("text_length", "<i4"),
+            ("deleted", "u1"),
+        ]
+    )
+    if np is not None
+    else None
+)
+DELETED_FIELD_OFFSET = ROW_DTYPE.fields["deleted"][1] if np is not None else 0
+
+
+@dataclass(slots=True)
+class Recollection:
+    msg_id: int
+    score: float
+    text: str
+
+
+class GuildIndex:
+    """Append-only embedding index for one guild, persisted as flat files.
+
+    `vectors.bin` holds unit-length vectors, `rows.bin` one fixed-size record per
+    vector (message/channel/author IDs, where its text is in `texts.bin`, and a
+    deleted flag). Files are only ever appended to (or have a deleted flag set in
+    place) by the bot process; searches memory-map them, so worker processes read the
+    same index and pick up new rows by checking file sizes. A row only counts once
+    its record is written, which happens last, and an append first cuts off whatever
+    an earlier failed one left past the last record, so a failure (or crash)
+    mid-append loses at most that batch.
+    """
+
+    def __init__(self, path: Path, *, model: str, dtype: str) -> None:
+        self.path = path
+        self.model = model
+        self.dtype = np.dtype(dtype)
+        self.dim = 0
+        self._count = 0
+        self._vectors: NDArray[Any] | None = None
+        self._rows: NDArray[Any] | None = None
+        # Held while the mapped arrays are replaced or read; re-entrant because
+        # append and delete refresh under it
+        self._lock = threading.RLock()
+        self._load_meta()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _load_meta(self) -> None:
+        try:
+            meta = json.loads((self.path / "meta.json").read_text())
+        except FileNotFoundError:
+            return
+        if meta.get("model") != self.model or meta.get("dtype") != self.dtype.name:
+            logging.warning(
+                "Embedding settings changed for %s; clearing its memory index",
+                self.path,
+            )
+            shutil.rmtree(self.path, ignore_errors=True)
+            return
+        self.dim = meta["dim"]
+
+    def refresh(self) -> None:
+        """Map rows appended since the last call (possibly by another process)."""
+        with self._lock:
+            if not self.dim:
+                self._load_meta()
+                if not self.dim:
+                    return
+            try:
+                num_rows = (self.path / "rows.bin").stat().st_size // ROW_DTYPE.itemsize
+                num_vectors = (self.path / "vectors.bin").stat().st_size // (
+                    self.dim * self.dtype.itemsize
+                )
+            except FileNotFoundError:
+                return
+            count = min(num_rows, num_vectors)
+            if count == self._count and self._vectors is not None:
+                return
+            self._count = count
+            if count == 0:
+                self._vectors = self._rows = None
+                return
+            self._vectors = np.memmap(
+                self.path / "vectors.bin",
+                dtype=self.dtype,
+                mode="r",
+                shape=(count, self.dim),
+            )
+            self._rows = np.memmap(
+                self.path / "rows.bin", dtype=ROW_DTYPE, mode="r", shape=(count,)
+            )
+
+    def append(
+        self, vectors: NDArray[Any], entries: list[tuple[int, int, int, str]]
+    ) -> None:
+        """Add unit vectors with their (message ID, channel ID, author ID, text)."""
+        with self._lock:
+            if not self.dim:
+                self.path.mkdir(parents=True, exist_ok=True)
+                self.dim = vectors.shape[1]
+                (self.path / "meta.json").write_text(
+                    json.dumps(
+                        dict(model=self.model, dtype=self.dtype.name, dim=self.dim)
+                    )
+                )
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Expected {self.dim}-dimensional embeddings")
+
+            # Row i pairs with vector i, so drop the vectors (and any torn record) of
+            # a batch whose rows never made it
+            rows_path = self.path / "rows.bin"
+            vectors_path = self.path / "vectors.bin"
+            num_rows = (
+                rows_path.stat().st_size // ROW_DTYPE.itemsize
+                if rows_path.exists()
+                else 0
+            )
+            for path, size in (
+                (rows_path, num_rows * ROW_DTYPE.itemsize),
+                (vectors_path, num_rows * self.dim * self.dtype.itemsize),
+            ):
+                if path.exists() and path.stat().st_size > size:
+                    os.truncate(path, size)
+
+            rows = np.zeros(len(entries), dtype=ROW_DTYPE)
+            with open(self.path / "texts.bin", "ab") as texts_file:
+                offset = texts_file.tell()
+                for i, (msg_id, channel_id, author_id, text) in enumerate(entries):
+                    encoded = text.encode()
+                    texts_file.write(encoded)
+                    rows[i] = (msg_id, channel_id, author_id, offset, len(encoded), 0)
+                    offset += len(encoded)
+            with open(vectors_path, "ab") as vectors_file:
+                vectors_file.write(
+                    np.ascontiguousarray(vectors, dtype=self.dtype).tobytes()
+                )
+            with open(rows_path, "ab") as rows_file:
+                rows_file.write(rows.tobytes())
+
+    def delete(self, msg_id: int) -> bool:
+        """Flag a message's rows as deleted so searches skip them."""
+        with self._lock:
+            self.refresh()
+            if self._rows is None:
+                return False
+            matches = np.flatnonzero(self._rows["msg_id"] == msg_id)
+            if not len(matches):
+                return False
+            with open(self.path / "rows.bin", "r+b") as rows_file:
+                for row in matches:
+                    rows_file.seek(int(row) * ROW_DTYPE.itemsize + DELETED_FIELD_OFFSET)
+                    rows_file.write(b"\x01")
+            return True
+
+    def search(
+        self, queries: NDArray[Any], k: int, *, channel_id: int | None = None
+    ) -> list[list[tuple[float, int]]]:
+        """Top-k (cosine similarity, row) per unit query vector, best first."""
+        # Appends and deletes in other threads remap the arrays
+        with self._lock:
+            self.refresh()
+            results: list[list[tuple[float, int]]] = [[] for _ in range(len(queries))]
+            if self._vectors is None or self._rows is None or k <= 0:
+                return results
+            queries = np.asarray(queries, dtype=np.float32)
+
+            best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+            best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+            for start in range(0, self._count, SEARCH_CHUNK_ROWS):
+                end = min(start + SEARCH_CHUNK_ROWS, self._count)
+                rows = self._rows[start:end]
+                included = rows["deleted"] == 0
+                if channel_id is not None:
+                    included &= rows["channel_id"] == channel_id
+                candidates = np.flatnonzero(included) + start
+                if not len(candidates):
+                    continue
+
+                if len(candidates) == end - start:
+                    block = self._vectors[start:end]
+                else:
+                    # Mostly other channels: only score this channel's vectors
+                    block = self._vectors[candidates]
+                scores = queries @ np.asarray(block, dtype=np.float32).T
+
+                take = min(k, len(candidates))
+                top = np.argpartition(scores, -take, axis=1)[:, -take:]
+                best_scores = np.concatenate(
+                    [best_scores, np.take_along_axis(scores, top, axis=1)], axis=1
+                )
+                best_rows = np.concatenate([best_rows, candidates[top]], axis=1)
+                if best_scores.shape[1] > k:
+                    keep = np.argpartition(best_scores, -k, axis=1)[:, -k:]
+                    best_scores = np.take_along_axis(best_scores, keep, axis=1)
+                    best_rows = np.take_along_axis(best_rows, keep, axis=1)
+
+            for i in range(len(queries)):
+                order = np.argsort(-best_scores[i])
+                results[i] = [
+                    (float(best_scores[i, j]), int(best_rows[i, j]))
+                    for j in order
+                    if np.isfinite(best_scores[i, j])
+                ]
+            return results
+
+    def row(self, row: int) -> tuple[int, str]:
+        """(Message ID, text) of a row."""
+        with self._lock:
+            assert self._rows is not None
+            record = self._rows[row]
+        with open(self.path / "texts.bin", "rb") as texts_file:
+            texts_file.seek(int(record["text_offset"]))
+            text = texts_file.read(int(record["text_length"])).decode(errors="replace")
+        return int(record["msg_id"]), text
+
+
+class ChannelMemory:
+    """Retrieval memory over earlier messages, beyond the reply chain.
+
+    The bot process embeds message text from allowed guild channels in batches
+    through an OpenAI-compatible `/embeddings` endpoint and appends it to a per-guild
+    `GuildIndex`. For each reply, the triggering message is embedded and the closest
+    earlier messages (from the same channel, or the whole guild) that aren't already
+    in the reply chain are added to the prompt under a token budget.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.provider = "openai"
+        self.model = "text-embedding-3-small"
+        self.scope = "channel"
+        self.channels: frozenset[int] = frozenset()
+        self.top_k = 5
+        self.min_score = 0.25
+        self.max_tokens = 1000
+        self.min_chars = 20
+        self.batch_size = 64
+        self.flush_seconds = 2.0
+        self.dtype = "float32"
+        self.dimensions: int | None = None
+        self.root = Path(".llmcord") / "memory"
+        self._index_key = self.model
+        self._config: dict[str, Any] = {}
+
+        self._indexes: dict[int, GuildIndex] = {}
+        # (guild ID, message ID, channel ID, author ID, text)
+        self._pending: list[tuple[int, int, int, int, str]] = []
+        self._flush_task: asyncio.Task | None = None
+        # Message IDs of the batch being embedded and appended, and those of them
+        # forgotten meanwhile (no longer pending, but possibly not indexed yet)
+        self._flushing: set[int] = set()
+        self._forgotten: set[int] = set()
+        self._vectors: OrderedDict[int, Any] = OrderedDict()
+        self._warned_missing_numpy = False
+
+    def configure(self, config: dict[str, Any]) -> None:
+        memory_cfg = config.get("memory") or {}
+        self._config = config
+        self.enabled = memory_cfg.get("enabled", False)
+        if self.enabled and np is None:
+            if not self._warned_missing_numpy:
+                logging.error(
+                    "Channel memory needs NumPy; install llmcord with the `memory` extra"
+                )
+                self._warned_missing_numpy = True
+            self.enabled = False
+        self.provider = memory_cfg.get("provider", "openai")
+        self.scope = memory_cfg.get("scope", "channel")
+        self.channels = frozenset(memory_cfg.get("channels") or ())
+        self.top_k = memory_cfg.get("top_k", 5)
+        self.min_score = memory_cfg.get("min_score", 0.25)
+        self.max_tokens = memory_cfg.get("max_tokens", 1000)
+        self.min_chars = memory_cfg.get("min_chars", 20)
+        self.batch_size = memory_cfg.get("batch_size", 64)
+        self.flush_seconds = memory_cfg.get("flush_seconds", 2)
+        self.dimensions = memory_cfg.get("dimensions")
+
+        self.model = memory_cfg.get("model", "text-embedding-3-small")
+        # Vectors of different sizes from the same model aren't comparable either
+        index_key = f"{self.model}:{self.dimensions}" if self.dimensions else self.model
+        dtype = memory_cfg.get("dtype", "float32")
+        root = Path(config.get("state_dir", ".llmcord")) / "memory"
+        if (index_key, dtype, root) != (self._index_key, self.dtype, self.root):
+            self._index_key, self.dtype, self.root = index_key, dtype, root
+            self._indexes.clear()
+            self._vectors.clear()
+
+    def index(self, guild_id: int) -> GuildIndex:
+        index = self._indexes.get(guild_id)
+        if index is None:
+            index = self._indexes[guild_id] = GuildIndex(
+                self.root / str(guild_id), model=self._index_key, dtype=self.dtype
+            )
+        return index
+
+    def _is_indexed(self, msg: discord.Message) -> bool:
+        if msg.guild is None or len(msg.content) < self.min_chars:
+            return False
+        channel = msg.channel
+        if self.channels and self.channels.isdisjoint(
+            (
+                channel.id,
+                getattr(channel, "parent_id", None),
+                getattr(channel, "category_id", None),
+            )
+        ):
+            return False
+        return is_authorized(new_msg=msg, config=self._config, is_dm=False)
+
+    def observe(self, msg: discord.Message) -> None:
+        """Queue a new message from a guild channel to be embedded and indexed."""
+        if not self.enabled or not self._is_indexed(msg):
+            return
+        assert msg.guild is not None
+        self._pending.append(
+            (
+                msg.guild.id,
+                msg.id,
+                msg.channel.id,
+                msg.author.id,
+                f"{msg.author.display_name}: {msg.clean_content}",
+            )
+        )
+        if len(self._pending) > MAX_PENDING_MESSAGES:
+            del self._pending[: len(self._pending) - MAX_PENDING_MESSAGES]
+            metrics.incr("memory_dropped")
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush())
+
+    async def forget(self, msg_id: int, guild_id: int | None) -> None:
+        """Drop a deleted or edited message from the index."""
+        self._pending = [entry for entry in self._pending if entry[1] != msg_id]
+        self._vectors.pop(msg_id, None)
+        if msg_id in self._flushing:
+            self._forgotten.add(msg_id)
+        if guild_id is not None and (index := self._indexes.get(guild_id)) is not None:
+            await asyncio.to_thread(index.delete, msg_id)
+
+    async def _embed(self, texts: list[str]) -> NDArray[Any]:
+        provider_config = self._config["providers"][self.provider]
+        extra = dict(dimensions=self.dimensions) if self.dimensions else {}
+        response = await asyncio.wait_for(
+            get_openai_client(provider_config).embeddings.create(
+                model=self.model, input=texts, encoding_format="float", **extra
+            ),
+            timeout=EMBED_TIMEOUT_SECONDS,
+        )
+        vectors = np.array(
+            [item.embedding for item in sorted(response.data, key=lambda d: d.index)],
+            dtype=np.float32,
+        )
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    async def _flush(self) -> None:
+        while self._pending:
+            if len(self._pending) < self.batch_size:
+                # Let a batch build up; a full batch goes out right away
+                await asyncio.sleep(self.flush_seconds)
+            batch, self._pending = (
+                self._pending[: self.batch_size],
+                self._pending[self.batch_size :],
+            )
+            self._flushing = {e[1] for e in batch}
+            try:
+                await self._flush_batch(batch)
+            finally:
+                self._flushing = set()
+                self._forgotten = set()
+
+    async def _flush_batch(self, batch: list[tuple[int, int, int, int, str]]) -> None:
+        by_guild: dict[int, list[tuple[int, int, int, str]]] = {}
+        for guild_id, *entry in batch:
+            by_guild.setdefault(guild_id, []).append(tuple(entry))  # type: ignore[arg-type]
+
+        # Messages that were already embedded as a query don't need another call.
+        # Taken before awaiting: recall() may cache more query vectors meanwhile.
+        vectors = {
+            e[1]: self._vectors.pop(e[1]) for e in batch if e[1] in self._vectors
+        }
+        missing = [e for e in batch if e[1] not in vectors]
+        start = time.perf_counter()
+        try:
+            embedded = await self._embed([e[4] for e in missing]) if missing else []
+        except Exception:
+            logging.warning(
+                "Failed to embed %d messages for channel memory",
+                len(missing),
+                exc_info=True,
+            )
+            metrics.incr("memory_embed_failed", len(batch))
+            return
+        metrics.incr("memory_embed_seconds", time.perf_counter() - start)
+        vectors.update(zip((e[1] for e in missing), embedded))
+        for guild_id, entries in by_guild.items():
+            # Deleted or edited while being embedded
+            entries = [e for e in entries if e[0] not in self._forgotten]
+            if not entries:
+                continue
+            index = self.index(guild_id)
+            try:
+                await asyncio.to_thread(
+                    index.append, np.stack([vectors[e[0]] for e in entries]), entries
+                )
+            except (OSError, ValueError):
+                logging.exception(
+                    "Failed to update the memory index of guild %s", guild_id
+                )
+                continue
+            metrics.incr("memory_indexed", len(entries))
+            # Forgotten while appending: its delete may have run before the append
+            for msg_id in self._forgotten.intersection(e[0] for e in entries):
+                await asyncio.to_thread(index.delete, msg_id)
+
+    async def recall(
+        self, new_msg: discord.Message, bot_user: discord.ClientUser, *, extra: int = 0
+    ) -> list[Recollection]:
+        """Indexed messages closest to `new_msg`, best first.
+
+        `extra` more than `top_k` are returned so the caller can drop ones that turn
+        out to be in the reply chain.
+        """
+        if not self.enabled or new_msg.guild is None:
+            return []
+        query = new_msg.content.removeprefix(bot_user.mention).strip()
+        index = self.index(new_msg.guild.id)
+        await asyncio.to_thread(index.refresh)
+        if not query or not len(index):
+            return []
+
+        try:
+            vector = (await self._embed([query]))[0]
+        except Exception:
+            logging.warning("Failed to embed query for channel memory", exc_info=True)
+            metrics.incr("memory_query_failed")
+            return []
+        self._vectors[new_msg.id] = vector
+        if len(self._vectors) > MAX_CACHED_VECTORS:
+            self._vectors.popitem(last=False)
+
+        def search() -> list[Recollection]:
+            (hits,) = index.search(
+                vector[None, :],
+                self.top_k + extra,
+                channel_id=new_msg.channel.id if self.scope == "channel" else None,
+            )
+            recollections = []
+            for score, row in hits:
+                if score < self.min_score:
+                    break
+                msg_id, text = index.row(row)
+                recollections.append(Recollection(msg_id, score, text))
+            return recollections
+
+        start = time.perf_counter()
+        recollections = await asyncio.to_thread(search)
+        metrics.incr("memory_search_seconds", time.perf_counter() - start)
+        return recollections
+
+    def render(
+        self, recollections: list[Recollection], exclude_ids: Iterable[int]
+    ) -> str | None:
+        """Format the best recollections not in `exclude_ids` within the token budget."""
+        exclude_ids = set(exclude_ids)
+        budget = self.max_tokens * 4  # Approximately 4 characters per token
+        chosen: list[Recollection] = []
+        for recollection in recollections:
+            if recollection.msg_id in exclude_ids:
+                continue
+            if len(chosen) == self.top_k or len(recollection.text) > budget:
+                break
+            budget -= len(recollection.text)
+            chosen.append(recollection)
+        if not chosen:
+            return None
+
+        lines = [
+            f"[{discord.utils.snowflake_time(r.msg_id).astimezone(dt.UTC):%Y-%m-%d %H:%M} UTC] {r.text}"
+            for r in sorted(chosen, key=lambda r: r.msg_id)
+        ]
+        return MEMORY_PROMPT_HEADER + "\n" + "\n".join(lines)
+
+
+def chain_ids(msg_nodes: dict[int, MsgNode], msg_id: int, limit: int) -> set[int]:
+    """IDs of the reply chain starting at `msg_id` as far as it is cached."""
+    ids: set[int] = set()
+    curr_id: int | None = msg_id
+    while curr_id is not None and curr_id not in ids and len(ids) < limit:
+        ids.add(curr_id)
+        node = msg_nodes.get(curr_id)
+        curr_id = node.parent_id if node is not None else None
+    return ids
+
+
+channel_memory = ChannelMemory()
+
+
+__all__ = ["ChannelMemory", "GuildIndex", "Recollection", "chain_ids", "channel_memory"]
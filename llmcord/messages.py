@@ -2,10 +2,15 @@ from __future__ import annotations
 
 import asyncio
 from base64 import b64encode
+from collections import Counter, OrderedDict
+from collections.abc import Iterable, Sequence
 from dataclasses import dataclass, field
+import hashlib
+import weakref
 from typing import Any, Literal
 import httpx
 import discord
+from .history import message_history
 from .constants import (
     WARNING_MAX_TEXT_TEMPLATE,
     WARNING_MAX_IMAGES_TEMPLATE,
@@ -13,24 +18,355 @@ from .constants import (
     WARNING_UNSUPPORTED_ATTACHMENTS,
     WARNING_ONLY_USING_LAST_TEMPLATE,
 )
+from .tracing import NOOP_TRACE
 
 
-@dataclass
+class ImageStore:
+    """Image data URLs shared by all message nodes under one byte budget.
+
+    Identical images are stored once, keyed by a hash of their content, and the least
+    recently used are evicted first. Nodes whose images were evicted are resolved again
+    the next time a conversation reaches them, and the snapshots built on them dropped.
+    Images pinned by a conversation being built are kept until it is rendered, even
+    past the budget (e.g. with image_cache_mb: 0, which then caches nothing between
+    requests).
+    """
+
+    def __init__(self, max_bytes: int = 256 * 2**20) -> None:
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._images: OrderedDict[str, str] = OrderedDict()
+        # The nodes holding each image (by id() of the node)
+        self._holders: dict[str, weakref.WeakValueDictionary[int, MsgNode]] = {}
+        # Pin counts of the images in use by conversations being built
+        self._pins: Counter[str] = Counter()
+
+    def configure(self, config: dict[str, Any]) -> None:
+        self.max_bytes = int((config.get("image_cache_mb", 256) or 0) * 2**20)
+        self._evict()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._images
+
+    def __len__(self) -> int:
+        return len(self._images)
+
+    def put(
+        self,
+        content_type: str,
+        data: bytes,
+        holder: MsgNode | None = None,
+        *,
+        pin: bool = False,
+    ) -> str:
+        key = hashlib.blake2b(data, digest_size=16).hexdigest()
+        if pin:
+            self._pins[key] += 1
+        if holder is not None:
+            self._holders.setdefault(key, weakref.WeakValueDictionary())[id(holder)] = (
+                holder
+            )
+        if key in self._images:
+            self._images.move_to_end(key)
+            return key
+
+        url = f"data:{content_type};base64,{b64encode(data).decode('utf-8')}"
+        self._images[key] = url
+        self.size += len(url)
+        self._evict()
+        return key
+
+    def get(self, key: str) -> str | None:
+        url = self._images.get(key)
+        if url is not None:
+            self._images.move_to_end(key)
+        return url
+
+    def pin(self, keys: Iterable[str]) -> None:
+        self._pins.update(keys)
+
+    def unpin(self, keys: Iterable[str]) -> None:
+        for key in keys:
+            if self._pins[key] > 1:
+                self._pins[key] -= 1
+            else:
+                self._pins.pop(key, None)
+        self._evict()
+
+    def clear(self) -> None:
+        self._images.clear()
+        self.size = 0
+        while self._holders:
+            self._drop_holders(next(iter(self._holders)))
+
+    def _evict(self) -> None:
+        for _ in range(len(self._images)):
+            if self.size <= self.max_bytes:
+                break
+            key, url = self._images.popitem(last=False)
+            if key in self._pins:
+                # In use, so it counts as recently used
+                self._images[key] = url
+                continue
+            self.size -= len(url)
+            self._drop_holders(key)
+
+    def _drop_holders(self, key: str) -> None:
+        if (holders := self._holders.pop(key, None)) is not None:
+            for node in list(holders.values()):
+                _drop_snapshots(node)
+
+
+image_store = ImageStore()
+
+
+@dataclass(frozen=True, slots=True)
+class _ImageMessage:
+    """A rendered message with images, kept as image_store keys until it is sent."""
+
+    role: str
+    text: str
+    image_keys: tuple[str, ...]
+    name: str | None
+
+    def render(self) -> dict[str, Any]:
+        image_urls = [
+            url for key in self.image_keys if (url := image_store.get(key)) is not None
+        ]
+        content: Any = (
+            ([dict(type="text", text=self.text)] if self.text else [])
+            + [dict(type="image_url", image_url=dict(url=url)) for url in image_urls]
+            if image_urls
+            else self.text
+        )
+        message: dict[str, Any] = dict(content=content, role=self.role)
+        if self.name is not None:
+            message["name"] = self.name
+        return message
+
+
+@dataclass(frozen=True, slots=True)
+class ContextSnapshot:
+    """The rendered conversation ending at one message, newest message first.
+
+    Snapshots are immutable and built from their parent's ("parent snapshot + one
+    message"), so continuing a conversation only renders the messages added since the
+    last snapshot. `key` holds the rendering options; a snapshot only applies while
+    they match. Edits, deletes and evicted images drop the snapshots built on the
+    changed node (see `MsgNode.dependents`).
+    """
+
+    key: tuple[Any, ...]
+    # At most max_messages rendered messages
+    messages: tuple[dict[str, Any] | _ImageMessage, ...] = ()
+    # Per message: whether the conversation continues past its node
+    has_parent: tuple[bool, ...] = ()
+    # (messages newer than the node that raised it, warning); a None warning is the
+    # "only using last N messages" warning, with N = position + the int
+    warnings: tuple[tuple[int, str | None, int], ...] = ()
+    has_images: bool = False
+
+    def prepend(
+        self,
+        message: dict[str, Any] | _ImageMessage | None,
+        *,
+        has_parent: bool,
+        warnings: tuple[tuple[int, str | None, int], ...],
+        max_messages: int,
+    ) -> ContextSnapshot:
+        """The snapshot of a child node whose rendered message is `message`."""
+        if message is None:
+            # Empty messages aren't sent, but their warnings still apply
+            return ContextSnapshot(
+                self.key,
+                self.messages,
+                self.has_parent,
+                warnings + self.warnings,
+                self.has_images,
+            )
+        return ContextSnapshot(
+            self.key,
+            (message,) + self.messages[: max_messages - 1],
+            (has_parent,) + self.has_parent[: max_messages - 1],
+            warnings
+            + tuple(
+                (pos + 1, warning, extra)
+                for pos, warning, extra in self.warnings
+                if pos + 1 < max_messages
+            ),
+            self.has_images or isinstance(message, _ImageMessage),
+        )
+
+    def materialize(self, max_messages: int) -> tuple[list[dict[str, Any]], set[str]]:
+        """The messages (newest first) and warnings to send for this snapshot."""
+        if self.has_images:
+            messages = [
+                m.render() if isinstance(m, _ImageMessage) else m for m in self.messages
+            ]
+        else:
+            messages = list(self.messages)  # type: ignore[arg-type]
+
+        user_warnings: set[str] = set()
+        for pos, warning, extra in self.warnings:
+            if warning is None:
+                count = pos + extra
+                s = "" if count == 1 else "s"
+                warning = WARNING_ONLY_USING_LAST_TEMPLATE.format(
+                    messages_count=count, s=s
+                )
+            user_warnings.add(warning)
+        if len(messages) == max_messages and self.has_parent[-1]:
+            s = "" if max_messages == 1 else "s"
+            user_warnings.add(
+                WARNING_ONLY_USING_LAST_TEMPLATE.format(
+                    messages_count=max_messages, s=s
+                )
+            )
+        return messages, user_warnings
+
+
+@dataclass(slots=True, weakref_slot=True)
 class MsgNode:
     text: str | None = None
-    images: list[dict[str, Any]] = field(default_factory=list)
+    # Keys into image_store
+    image_keys: tuple[str, ...] = ()
 
     role: Literal["user", "assistant"] = "assistant"
     user_id: int | None = None
+    display_name: str | None = None
 
     has_bad_attachments: bool = False
     fetch_parent_failed: bool = False
 
-    parent_msg: discord.Message | None = None
+    # The parent is referenced by ID and resolved lazily, so cached nodes don't keep
+    # whole discord.Message object graphs alive
+    parent_id: int | None = None
+    parent_channel_id: int | None = None
+
+    # Set by invalidate_msg_node: the edited message to re-resolve from on next use
+    latest_msg: discord.Message | None = None
+    deleted: bool = False
+
+    # The rendered conversation ending at this message, if one was built
+    snapshot: ContextSnapshot | None = None
+    # Bumped whenever the snapshot is dropped, so a walk that read this node meanwhile
+    # doesn't cache snapshots built from what it was
+    version: int = 0
+    # Nodes whose snapshots were built on this one (by id() of the node)
+    dependents: dict[int, MsgNode] | None = None
 
     lock: asyncio.Lock = field(default_factory=asyncio.Lock)
 
 
+def _drop_snapshots(node: MsgNode) -> None:
+    """Drop the snapshots of a node and of every node built on it."""
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        node.snapshot = None
+        node.version += 1
+        if node.dependents:
+            stack.extend(node.dependents.values())
+        node.dependents = None
+
+
+# Nodes pruned from a node cache while other nodes' snapshots still include them, by
+# message ID, so an edit or delete of their message still reaches those snapshots
+MAX_PRUNED_NODES = 1000
+_pruned_nodes: OrderedDict[int, MsgNode] = OrderedDict()
+
+
+async def prune_msg_nodes(msg_nodes: dict[int, MsgNode], max_nodes: int) -> None:
+    """Drop the oldest nodes beyond `max_nodes` (waiting for any in use)."""
+    if (num_nodes := len(msg_nodes)) <= max_nodes:
+        return
+    for msg_id in sorted(msg_nodes.keys())[: num_nodes - max_nodes]:
+        node = msg_nodes.get(msg_id)
+        if node is None:
+            continue
+        async with node.lock:
+            if msg_nodes.pop(msg_id, None) is not None and node.dependents:
+                _pruned_nodes[msg_id] = node
+    while len(_pruned_nodes) > MAX_PRUNED_NODES:
+        # Can't be reached by an edit anymore: rebuild what was built on it instead
+        _drop_snapshots(_pruned_nodes.popitem(last=False)[1])
+
+
+async def _fetch_message(
+    new_msg: discord.Message, channel_id: int, msg_id: int
+) -> discord.Message | None:
+    """Fetch a message that isn't cached, from the channel it was seen in."""
+    channel: Any = (
+        new_msg.channel
+        if channel_id == new_msg.channel.id
+        else new_msg.guild and new_msg.guild.get_channel_or_thread(channel_id)
+    )
+    if channel is None:
+        # Not in the gateway cache (e.g. worker processes): fetch over REST by ID
+        channel = new_msg._state.get_partial_messageable(channel_id)
+    try:
+        return await channel.fetch_message(msg_id)
+    except (discord.NotFound, discord.HTTPException):
+        return None
+
+
+def _recent_message(channel_id: int, msg_id: int, lookup: str) -> Any:
+    """A message recently seen on the gateway, if the message history has it."""
+    if not message_history.depth:
+        return None
+    return message_history.get(channel_id, msg_id, lookup=lookup)
+
+
+async def _previous_message(msg: Any) -> Any:
+    """The message right before msg in its channel (None if there isn't one)."""
+    if message_history.depth:
+        known, previous = message_history.previous(
+            msg.channel.id, msg.id, lookup="previous"
+        )
+        if known:
+            return previous
+    return ([m async for m in msg.channel.history(before=msg, limit=1)] or [None])[0]
+
+
+async def invalidate_msg_node(
+    msg_nodes: dict[int, MsgNode],
+    msg_id: int,
+    *,
+    message: discord.Message | None = None,
+    deleted: bool = False,
+) -> bool:
+    """Drop the cached data derived from a message that was edited or deleted.
+
+    An edited node is reset and lazily re-resolved from `message` the next time a
+    conversation reaches it. A deleted node becomes a tombstone so chains that pass
+    through it stop there, as they would when resolving from scratch. Either way the
+    snapshots built on it are dropped, including when it was already pruned. Returns
+    False if the message wasn't cached.
+    """
+    if (pruned := _pruned_nodes.pop(msg_id, None)) is not None:
+        _drop_snapshots(pruned)
+    node = msg_nodes.get(msg_id)
+    if node is None:
+        return False
+
+    # Right away, so walks in progress don't cache what they read from it
+    _drop_snapshots(node)
+    async with node.lock:
+        # And again for anything built on it while waiting for the lock
+        _drop_snapshots(node)
+        node.text = None
+        node.image_keys = ()
+        node.has_bad_attachments = False
+        node.fetch_parent_failed = False
+        node.parent_id = node.parent_channel_id = None
+        node.latest_msg = message
+        node.deleted = deleted
+        if deleted:
+            node.text = ""
+            node.fetch_parent_failed = True
+    return True
+
+
 async def build_conversation_context(
     *,
     new_msg: discord.Message,
@@ -43,228 +379,415 @@ async def build_conversation_context(
     max_messages: int,
     msg_nodes: dict[int, "MsgNode"],
     httpx_client: httpx.AsyncClient,
+    trace: Any = NOOP_TRACE,
+    merged: Sequence[discord.Message] = (),
 ) -> tuple[list[dict[str, Any]], set[str]]:
-    messages: list[dict[str, Any]] = []
-    user_warnings: set[str] = set()
+    """Walk the reply chain ending at new_msg and render it for the provider.
+
+    `merged` are earlier messages folded into new_msg's reply (oldest first): new_msg
+    continues from the last of them, and each from the one before it.
+    """
+    # The images of the conversation stay in image_store until it is rendered
+    pinned: list[str] = []
+    try:
+        snapshot = await _build_snapshot(
+            new_msg=new_msg,
+            bot_user=bot_user,
+            accept_images=accept_images,
+            accept_usernames=accept_usernames,
+            experimental_message_formatting=experimental_message_formatting,
+            max_text=max_text,
+            max_images=max_images,
+            max_messages=max_messages,
+            msg_nodes=msg_nodes,
+            httpx_client=httpx_client,
+            trace=trace,
+            merged=merged,
+            pinned=pinned,
+        )
+        return snapshot.materialize(max_messages)
+    finally:
+        image_store.unpin(pinned)
+
+
+async def _build_snapshot(
+    *,
+    new_msg: discord.Message,
+    bot_user: discord.ClientUser,
+    accept_images: bool,
+    accept_usernames: bool,
+    experimental_message_formatting: bool,
+    max_text: int,
+    max_images: int,
+    max_messages: int,
+    msg_nodes: dict[int, MsgNode],
+    httpx_client: httpx.AsyncClient,
+    trace: Any,
+    merged: Sequence[discord.Message],
+    pinned: list[str],
+) -> ContextSnapshot:
+    """The snapshot of the conversation ending at new_msg, caching the ones on the way.
+
+    The image keys it uses are pinned in image_store and added to `pinned`.
+    """
+    options = (
+        accept_images,
+        accept_usernames,
+        experimental_message_formatting,
+        max_text,
+        max_images,
+        max_messages,
+    )
+    # Per node walked, newest first: (node, its version when read, rendered message,
+    # has parent, warnings)
+    walked: list[
+        tuple[
+            MsgNode,
+            int,
+            dict[str, Any] | _ImageMessage | None,
+            bool,
+            tuple[tuple[int, str | None, int], ...],
+        ]
+    ] = []
+    num_messages = 0
+    # Where the walk stopped: a cached snapshot, the end of the conversation, a
+    # message that couldn't be fetched (not cached, as that may be temporary) or
+    # max_messages (None: older messages weren't walked)
+    base: ContextSnapshot | None = ContextSnapshot(options)
+    # The node whose snapshot the walk stopped at, and its version then
+    base_node: MsgNode | None = None
+    base_version = 0
+    cache_snapshots = True
+    merged_parents = {
+        msg.id: parent for msg, parent in zip([*merged[1:], new_msg], merged)
+    }
+
     curr_msg: discord.Message | None = new_msg
+    curr_id: int | None = new_msg.id
+    curr_channel_id: int | None = new_msg.channel.id
 
-    while curr_msg is not None and len(messages) < max_messages:
-        curr_node = msg_nodes.setdefault(curr_msg.id, MsgNode())
+    while curr_id is not None:
+        if num_messages == max_messages:
+            base = None
+            break
+        curr_node = msg_nodes.setdefault(curr_id, MsgNode())
+        parent_msg: discord.Message | None = None
 
         async with curr_node.lock:
+            version = curr_node.version
+            snapshot = curr_node.snapshot
+            if (
+                snapshot is not None
+                and snapshot.key == options
+                and curr_node.text is not None
+            ):
+                # Nothing is awaited from here until it is rendered, so its images
+                # can't be evicted meanwhile
+                base, base_node, base_version = snapshot, curr_node, version
+                break
+
+            if curr_node.text is None and curr_node.latest_msg is not None:
+                # Edited since it was cached; resolve from the updated message
+                curr_msg, curr_node.latest_msg = curr_node.latest_msg, None
+
+            if curr_node.text is not None:
+                if all(key in image_store for key in curr_node.image_keys):
+                    image_store.pin(curr_node.image_keys)
+                    pinned += curr_node.image_keys
+                else:
+                    # Image data was evicted under the byte budget; resolve it again
+                    curr_node.text = None
+
+            if curr_node.text is None and curr_msg is None:
+                assert curr_channel_id is not None
+                curr_msg = _recent_message(curr_channel_id, curr_id, "message")
+                if curr_msg is None:
+                    with trace.span("fetch_message", message_id=curr_id):
+                        curr_msg = await _fetch_message(
+                            new_msg, curr_channel_id, curr_id
+                        )
+                if curr_msg is None:
+                    msg_nodes.pop(curr_id, None)
+                    base = ContextSnapshot(options, warnings=((0, None, 0),))
+                    cache_snapshots = False
+                    break
+
             if curr_node.text is None:
-                cleaned_content = curr_msg.content.removeprefix(
-                    bot_user.mention
-                ).lstrip()
-
-                good_attachments = [
-                    att
-                    for att in curr_msg.attachments
-                    if att.content_type
-                    and any(att.content_type.startswith(x) for x in ("text", "image"))
-                ]
-
-                attachment_responses = await asyncio.gather(
-                    *[httpx_client.get(att.url) for att in good_attachments]
-                )
+                assert curr_msg is not None
+                with trace.span("resolve_node", message_id=curr_msg.id):
+                    cleaned_content = curr_msg.content.removeprefix(
+                        bot_user.mention
+                    ).lstrip()
 
-                curr_node.text = "\n".join(
-                    ([cleaned_content] if cleaned_content else [])
-                    + [
-                        "\n".join(
-                            filter(
-                                None,
-                                (embed.title, embed.description, embed.footer.text),
-                            )
+                    good_attachments = [
+                        att
+                        for att in curr_msg.attachments
+                        if att.content_type
+                        and any(
+                            att.content_type.startswith(x) for x in ("text", "image")
                         )
-                        for embed in curr_msg.embeds
-                    ]
-                    + [
-                        resp.text
-                        for att, resp in zip(good_attachments, attachment_responses)
-                        if (att.content_type or "").startswith("text")
                     ]
-                )
 
-                if accept_images:
-                    curr_node.images = [
-                        dict(
-                            type="image_url",
-                            image_url=dict(
-                                url=f"data:{att.content_type};base64,{b64encode(resp.content).decode('utf-8')}"
-                            ),
+                    with trace.span(
+                        "download_attachments", count=len(good_attachments)
+                    ):
+                        attachment_responses = await asyncio.gather(
+                            *[httpx_client.get(att.url) for att in good_attachments]
                         )
-                        for att, resp in zip(good_attachments, attachment_responses)
-                        if (att.content_type or "").startswith("image")
-                    ]
 
-                curr_node.role = "assistant" if curr_msg.author == bot_user else "user"
+                    curr_node.text = "\n".join(
+                        ([cleaned_content] if cleaned_content else [])
+                        + [
+                            "\n".join(
+                                filter(
+                                    None,
+                                    (embed.title, embed.description, embed.footer.text),
+                                )
+                            )
+                            for embed in curr_msg.embeds
+                        ]
+                        + [
+                            resp.text
+                            for att, resp in zip(good_attachments, attachment_responses)
+                            if (att.content_type or "").startswith("text")
+                        ]
+                    )
 
-                curr_node.user_id = (
-                    curr_msg.author.id if curr_node.role == "user" else None
-                )
+                    if accept_images:
+                        curr_node.image_keys = tuple(
+                            image_store.put(
+                                att.content_type, resp.content, curr_node, pin=True
+                            )
+                            for att, resp in zip(good_attachments, attachment_responses)
+                            if att.content_type and att.content_type.startswith("image")
+                        )
+                        pinned += curr_node.image_keys
 
-                curr_node.has_bad_attachments = len(curr_msg.attachments) > len(
-                    good_attachments
-                )
+                    curr_node.role = (
+                        "assistant" if curr_msg.author == bot_user else "user"
+                    )
 
-                try:
-                    if (
-                        curr_msg.reference is None
-                        and bot_user.mention not in curr_msg.content
-                        and (
-                            prev_msg_in_channel := (
-                                [
-                                    m
-                                    async for m in curr_msg.channel.history(
-                                        before=curr_msg, limit=1
-                                    )
-                                ]
-                                or [None]
-                            )[0]
-                        )
-                        and prev_msg_in_channel.type
-                        in (discord.MessageType.default, discord.MessageType.reply)
-                        and prev_msg_in_channel.author
-                        == (
-                            bot_user
-                            if curr_msg.channel.type == discord.ChannelType.private
-                            else curr_msg.author
-                        )
-                    ):
-                        curr_node.parent_msg = prev_msg_in_channel
-                    else:
-                        channel = curr_msg.channel
-                        if isinstance(channel, discord.Thread):
-                            thread: discord.Thread = channel
-                            is_public_thread = (
-                                thread.type == discord.ChannelType.public_thread
-                            )
-                            parent_is_thread_start = (
-                                is_public_thread
-                                and curr_msg.reference is None
-                                and isinstance(thread.parent, discord.TextChannel)
-                            )
+                    curr_node.user_id = (
+                        curr_msg.author.id if curr_node.role == "user" else None
+                    )
+                    curr_node.display_name = (
+                        getattr(curr_msg.author, "display_name", None)
+                        or getattr(curr_msg.author, "name", None)
+                        or "unknown"
+                    )
 
-                            parent_msg_id = (
-                                thread.id
-                                if parent_is_thread_start
-                                else getattr(curr_msg.reference, "message_id", None)
-                            )
+                    curr_node.has_bad_attachments = len(curr_msg.attachments) > len(
+                        good_attachments
+                    )
 
-                            if parent_msg_id:
-                                if parent_is_thread_start and isinstance(
-                                    thread.parent, discord.TextChannel
-                                ):
-                                    curr_node.parent_msg = (
-                                        thread.starter_message
-                                        or await thread.parent.fetch_message(
-                                            parent_msg_id
+                    with trace.span("fetch_parent"):
+                        try:
+                            if curr_msg.id in merged_parents:
+                                # Folded into a later mention's reply
+                                parent_msg = merged_parents[curr_msg.id]
+                            elif (
+                                curr_msg.reference is None
+                                and bot_user.mention not in curr_msg.content
+                                and (
+                                    prev_msg_in_channel := await _previous_message(
+                                        curr_msg
+                                    )
+                                )
+                                and prev_msg_in_channel.type
+                                in (
+                                    discord.MessageType.default,
+                                    discord.MessageType.reply,
+                                )
+                                and prev_msg_in_channel.author
+                                == (
+                                    bot_user
+                                    if curr_msg.channel.type
+                                    == discord.ChannelType.private
+                                    else curr_msg.author
+                                )
+                            ):
+                                parent_msg = prev_msg_in_channel
+                            else:
+                                channel = curr_msg.channel
+                                if isinstance(channel, discord.Thread):
+                                    thread: discord.Thread = channel
+                                    is_public_thread = (
+                                        thread.type == discord.ChannelType.public_thread
+                                    )
+                                    parent_is_thread_start = (
+                                        is_public_thread
+                                        and curr_msg.reference is None
+                                        and isinstance(
+                                            thread.parent, discord.TextChannel
                                         )
                                     )
-                                else:
-                                    cached = getattr(
-                                        curr_msg.reference, "cached_message", None
+
+                                    parent_msg_id = (
+                                        thread.id
+                                        if parent_is_thread_start
+                                        else getattr(
+                                            curr_msg.reference, "message_id", None
+                                        )
                                     )
-                                    if cached is not None:
-                                        curr_node.parent_msg = cached
-                                    else:
-                                        if isinstance(
-                                            channel,
-                                            (discord.Thread, discord.TextChannel),
+
+                                    if parent_msg_id:
+                                        if parent_is_thread_start and isinstance(
+                                            thread.parent, discord.TextChannel
                                         ):
-                                            curr_node.parent_msg = (
-                                                await channel.fetch_message(
+                                            parent_msg = (
+                                                thread.starter_message
+                                                or _recent_message(
+                                                    thread.parent.id,
+                                                    parent_msg_id,
+                                                    "parent",
+                                                )
+                                                or await thread.parent.fetch_message(
                                                     parent_msg_id
                                                 )
                                             )
-                        else:
-                            if parent_msg_id := getattr(
-                                curr_msg.reference, "message_id", None
-                            ):
-                                cached = getattr(
-                                    curr_msg.reference, "cached_message", None
-                                )
-                                if cached is not None:
-                                    curr_node.parent_msg = cached
-                                elif isinstance(channel, (discord.TextChannel)):
-                                    curr_node.parent_msg = await channel.fetch_message(
-                                        parent_msg_id
-                                    )
+                                        else:
+                                            cached = getattr(
+                                                curr_msg.reference,
+                                                "cached_message",
+                                                None,
+                                            )
+                                            if cached is None:
+                                                cached = _recent_message(
+                                                    channel.id, parent_msg_id, "parent"
+                                                )
+                                            if cached is not None:
+                                                parent_msg = cached
+                                            else:
+                                                if isinstance(
+                                                    channel,
+                                                    (
+                                                        discord.Thread,
+                                                        discord.TextChannel,
+                                                    ),
+                                                ):
+                                                    parent_msg = (
+                                                        await channel.fetch_message(
+                                                            parent_msg_id
+                                                        )
+                                                    )
+                                else:
+                                    if parent_msg_id := getattr(
+                                        curr_msg.reference, "message_id", None
+                                    ):
+                                        cached = getattr(
+                                            curr_msg.reference, "cached_message", None
+                                        )
+                                        if cached is None:
+                                            cached = _recent_message(
+                                                channel.id, parent_msg_id, "parent"
+                                            )
+                                        if cached is not None:
+                                            parent_msg = cached
+                                        elif isinstance(channel, (discord.TextChannel)):
+                                            parent_msg = await channel.fetch_message(
+                                                parent_msg_id
+                                            )
 
-                except (discord.NotFound, discord.HTTPException):
-                    # Keep going; mark and warn later
-                    curr_node.fetch_parent_failed = True
+                        except (discord.NotFound, discord.HTTPException):
+                            # Keep going; mark and warn later
+                            curr_node.fetch_parent_failed = True
 
-            if curr_node.images[:max_images]:
-                content: Any = (
-                    [dict(type="text", text=curr_node.text[:max_text])]
-                    if curr_node.text[:max_text]
-                    else []
-                ) + curr_node.images[:max_images]
-            else:
-                content = curr_node.text[:max_text]
-
-            if content != "":
-                # Optionally format user messages as "nickname: content"
-                if experimental_message_formatting and curr_node.role == "user":
-                    try:
-                        display_name = (
-                            getattr(
-                                getattr(curr_msg, "author", None), "display_name", None
-                            )
-                            or getattr(getattr(curr_msg, "author", None), "name", None)
-                            or "unknown"
-                        )
-                    except Exception:
-                        display_name = "unknown"
-
-                    if isinstance(content, list):
-                        if (
-                            content
-                            and isinstance(content[0], dict)
-                            and content[0].get("type") == "text"
-                        ):
-                            original_text = content[0].get("text", "")
-                            content[0]["text"] = (
-                                f"{display_name}: {original_text}"
-                                if original_text
-                                else f"{display_name}:"
-                            )
-                        # If no text part exists, leave images as-is
-                    elif isinstance(content, str):
-                        content = f"{display_name}: {content}"
-
-                message: dict[str, Any] = dict(content=content, role=curr_node.role)
-                if accept_usernames and curr_node.user_id is not None:
-                    message["name"] = str(curr_node.user_id)
-                messages.append(message)
-
-            if len(curr_node.text or "") > max_text:
-                user_warnings.add(WARNING_MAX_TEXT_TEMPLATE.format(max_text=max_text))
-            if len(curr_node.images) > max_images:
+                        if parent_msg is not None:
+                            curr_node.parent_id = parent_msg.id
+                            curr_node.parent_channel_id = parent_msg.channel.id
+
+            text = curr_node.text[:max_text]
+            image_keys = tuple(
+                key for key in curr_node.image_keys[:max_images] if key in image_store
+            )
+            name = (
+                str(curr_node.user_id)
+                if accept_usernames and curr_node.user_id is not None
+                else None
+            )
+            # Optionally format user messages as "nickname: content"
+            if text and experimental_message_formatting and curr_node.role == "user":
+                text = f"{curr_node.display_name or 'unknown'}: {text}"
+
+            message: dict[str, Any] | _ImageMessage | None = None
+            if image_keys:
+                message = _ImageMessage(curr_node.role, text, image_keys, name)
+            elif text:
+                message = dict(content=text, role=curr_node.role)
+                if name is not None:
+                    message["name"] = name
+
+            warnings: list[tuple[int, str | None, int]] = []
+            if len(curr_node.text) > max_text:
+                warnings.append(
+                    (0, WARNING_MAX_TEXT_TEMPLATE.format(max_text=max_text), 0)
+                )
+            if len(curr_node.image_keys) > max_images:
                 if max_images > 0:
                     s = "" if max_images == 1 else "s"
-                    user_warnings.add(
-                        WARNING_MAX_IMAGES_TEMPLATE.format(max_images=max_images, s=s)
+                    warnings.append(
+                        (
+                            0,
+                            WARNING_MAX_IMAGES_TEMPLATE.format(
+                                max_images=max_images, s=s
+                            ),
+                            0,
+                        )
                     )
                 else:
-                    user_warnings.add(WARNING_CANT_SEE_IMAGES)
+                    warnings.append((0, WARNING_CANT_SEE_IMAGES, 0))
             if curr_node.has_bad_attachments:
-                user_warnings.add(WARNING_UNSUPPORTED_ATTACHMENTS)
-            if curr_node.fetch_parent_failed or (
-                curr_node.parent_msg is not None and len(messages) == max_messages
-            ):
-                s = "" if len(messages) == 1 else "s"
-                user_warnings.add(
-                    WARNING_ONLY_USING_LAST_TEMPLATE.format(
-                        messages_count=len(messages), s=s
-                    )
+                warnings.append((0, WARNING_UNSUPPORTED_ATTACHMENTS, 0))
+            if curr_node.fetch_parent_failed:
+                warnings.append((0, None, 1 if message is not None else 0))
+
+            walked.append(
+                (
+                    curr_node,
+                    version,
+                    message,
+                    curr_node.parent_id is not None,
+                    tuple(warnings),
                 )
+            )
+            if message is not None:
+                num_messages += 1
+
+            curr_msg = parent_msg
+            curr_id, curr_channel_id = curr_node.parent_id, curr_node.parent_channel_id
 
-            curr_msg = curr_node.parent_msg
+    # Build the walked nodes' snapshots oldest first on top of where the walk stopped.
+    # Without a base (max_messages reached) only snapshots whose window is full are
+    # complete. Each node is registered with the one it was built on, which drops its
+    # snapshot when it changes; one that changed during the walk (or whose base did)
+    # invalidates everything built on it here.
+    snapshot = base if base is not None else ContextSnapshot(options)
+    parent_node = base_node
+    if base_node is not None and base_node.version != base_version:
+        cache_snapshots = False
+    for node, version, message, has_parent, warnings in reversed(walked):
+        snapshot = snapshot.prepend(
+            message, has_parent=has_parent, warnings=warnings, max_messages=max_messages
+        )
+        cache_snapshots = cache_snapshots and node.version == version
+        if not cache_snapshots:
+            continue
+        if parent_node is not None:
+            if parent_node.dependents is None:
+                parent_node.dependents = {}
+            parent_node.dependents[id(node)] = node
+        parent_node = node
+        if base is not None or len(snapshot.messages) == max_messages:
+            node.snapshot = snapshot
 
-    return messages, user_warnings
+    return snapshot
 
 
-__all__ = ["MsgNode", "build_conversation_context"]
+__all__ = [
+    "ImageStore",
+    "MsgNode",
+    "build_conversation_context",
+    "image_store",
+    "invalidate_msg_node",
+    "prune_msg_nodes",
+]
@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+import logging
+import math
+from collections import defaultdict
+from typing import Any
+
+
+class Metrics:
+    """In-process counters keyed by metric name and a small set of labels."""
+
+    def __init__(self) -> None:
+        self._counters: dict[str, dict[tuple[tuple[str, str], ...], float]] = (
+            defaultdict(lambda: defaultdict(float))
+        )
+
+    @staticmethod
+    def _key(labels: dict[str, Any]) -> tuple[tuple[str, str], ...]:
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def incr(self, name: str, value: float = 1, **labels: Any) -> None:
+        self._counters[name][self._key(labels)] += value
+
+    def get(self, name: str, **labels: Any) -> float:
+        return self._counters.get(name, {}).get(self._key(labels), 0.0)
+
+    def snapshot(self) -> dict[str, list[dict[str, Any]]]:
+        return {
+            name: [dict(labels, value=value) for labels, value in series.items()]
+            for name, series in self._counters.items()
+        }
+
+
+metrics = Metrics()
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile (q in 0-100) of unsorted values; 0.0 when empty."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def record_usage(
+    model: str,
+    *,
+    prompt_tokens: int,
+    completion_tokens: int,
+    cached_tokens: int,
+) -> None:
+    """Accumulate token usage for a model and log the running prompt cache hit rate."""
+    metrics.incr("prompt_tokens", prompt_tokens, model=model)
+    metrics.incr("completion_tokens", completion_tokens, model=model)
+    metrics.incr("cached_tokens", cached_tokens, model=model)
+
+    total_prompt = metrics.get("prompt_tokens", model=model)
+    hit_rate = (
+        metrics.get("cached_tokens", model=model) / total_prompt
+        if total_prompt
+        else 0.0
+    )
+    logging.info(
+        "Usage | model=%s | prompt=%d | cached=%d | completion=%d | cache_hit_rate=%.1f%%",
+        model,
+        prompt_tokens,
+        cached_tokens,
+        completion_tokens,
+        hit_rate * 100,
+    )
+
+
+__all__ = ["Metrics", "metrics", "percentile", "record_usage"]
@@ -0,0 +1,291 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections.abc import Callable, Sequence
+from typing import TYPE_CHECKING, Any, cast
+
+import discord
+import httpx
+
+from .auth import build_users_listing, format_system_prompt, split_volatile_prompt
+from .constants import (
+    EMBED_DESCRIPTION_MAX_LENGTH,
+    MAX_MESSAGE_NODES,
+    PROVIDERS_SUPPORTING_CACHE_PROMPT,
+    PROVIDERS_SUPPORTING_PROMPT_CACHE_KEY,
+    PROVIDERS_SUPPORTING_USERNAMES,
+    STREAMING_INDICATOR,
+)
+from .discord_utils import build_warnings_embed
+from .log import format_content
+from .memory import chain_ids, channel_memory
+from .messages import (
+    MsgNode,
+    build_conversation_context,
+    image_store,
+    prune_msg_nodes,
+)
+from .providers import get_openai_client, provider_health
+from .recovery import Backend, StreamRecovery, continuation_setting
+from .streaming import stream_and_reply
+from .tracing import NOOP_TRACE
+
+if TYPE_CHECKING:
+    from openai.types.chat import ChatCompletionMessageParam
+
+
+def users_listing_for(new_msg: discord.Message, cfg: dict[str, Any]) -> str | None:
+    """Build the `{users}` listing only when the system prompt uses it."""
+    if "{users}" not in (cfg.get("system_prompt") or ""):
+        return None
+    members = getattr(new_msg.guild, "members", None)
+    return build_users_listing(members) if members else None
+
+
+def conversation_options(
+    cfg: dict[str, Any], provider_slash_model: str
+) -> dict[str, Any]:
+    """Model- and config-dependent keyword arguments for build_conversation_context."""
+    accept_images = provider_slash_model.endswith(":vision")
+    return dict(
+        accept_images=accept_images,
+        accept_usernames=any(
+            x in provider_slash_model.lower() for x in PROVIDERS_SUPPORTING_USERNAMES
+        ),
+        experimental_message_formatting=cfg.get(
+            "experimental_message_formatting", False
+        ),
+        max_text=cfg.get("max_text", 100000),
+        max_images=cfg.get("max_images", 5) if accept_images else 0,
+        max_messages=cfg.get("max_messages", 25),
+    )
+
+
+def provider_request_options(
+    cfg: dict[str, Any], provider_slash_model: str
+) -> tuple[dict[str, Any], Backend]:
+    """The provider's config entry and how to send it chat completion requests."""
+    provider, model = provider_slash_model.removesuffix(":vision").split("/", 1)
+
+    provider_config = cfg["providers"][provider]
+    openai_client = get_openai_client(provider_config)
+
+    model_parameters = cfg["models"].get(provider_slash_model, None)
+
+    extra_headers = provider_config.get("extra_headers", None)
+    extra_query = provider_config.get("extra_query", None)
+    extra_body = (provider_config.get("extra_body", None) or {}) | (
+        model_parameters or {}
+    )
+
+    try:
+        existing_stream_options = cast(
+            dict[str, Any], extra_body.get("stream_options", {})
+        )
+    except Exception:
+        existing_stream_options = {}
+    extra_body["stream_options"] = {
+        **existing_stream_options,
+        "include_usage": True,
+    }
+
+    return provider_config, Backend(
+        openai_client,
+        model,
+        provider_slash_model,
+        extra_headers,
+        extra_query,
+        extra_body,
+        continuation_setting(provider_config),
+    )
+
+
+def stream_recovery_for(
+    cfg: dict[str, Any], provider_config: dict[str, Any]
+) -> StreamRecovery | None:
+    recovery_cfg = cfg.get("stream_recovery") or {}
+    if not recovery_cfg.get("enabled", False):
+        return None
+    fallback = None
+    if fallback_model := recovery_cfg.get("fallback_model"):
+        _, fallback = provider_request_options(cfg, fallback_model)
+    return StreamRecovery(
+        max_retries=recovery_cfg.get("max_retries", 2),
+        continuation=continuation_setting(provider_config),
+        fallback=fallback,
+    )
+
+
+async def generate_reply(
+    *,
+    new_msg: discord.Message,
+    cfg: dict[str, Any],
+    provider_slash_model: str,
+    bot_user: discord.ClientUser,
+    msg_nodes: dict[int, MsgNode],
+    httpx_client: httpx.AsyncClient,
+    users_listing: str | None = None,
+    timings: dict[str, float] | None = None,
+    trace: Any = NOOP_TRACE,
+    on_response_msg: Callable[[discord.Message], None] | None = None,
+    on_usage: Callable[[int, int, int], None] | None = None,
+    merged: Sequence[discord.Message] = (),
+) -> None:
+    """Build the conversation for an authorized mention and stream the reply.
+
+    Shared by the in-process handler and worker processes, so it only relies on what
+    can be resolved over Discord REST (no gateway caches). `merged` are earlier
+    mentions from the same burst to answer along with new_msg (see coalesce.py).
+    """
+    timings = {} if timings is None else timings
+
+    provider_health.configure(cfg)
+    provider_slash_model = provider_health.route(provider_slash_model)
+    provider_config, backend = provider_request_options(cfg, provider_slash_model)
+    extra_body = backend.extra_body or {}
+
+    options = conversation_options(cfg, provider_slash_model)
+    accept_usernames = options["accept_usernames"]
+    image_store.configure(cfg)
+    channel_memory.configure(cfg)
+
+    stage_start = time.perf_counter()
+    with trace.span("build_conversation_context"):
+        # Retrieval runs alongside; it can't know the chain yet, so it over-fetches
+        (messages, user_warnings), recollections = await asyncio.gather(
+            build_conversation_context(
+                new_msg=new_msg,
+                bot_user=bot_user,
+                msg_nodes=msg_nodes,
+                httpx_client=httpx_client,
+                trace=trace,
+                merged=merged,
+                **options,
+            ),
+            channel_memory.recall(new_msg, bot_user, extra=options["max_messages"]),
+        )
+
+    timings["context"] = time.perf_counter() - stage_start
+
+    # After the conversation (like volatile prompt lines) so cached prefixes still match
+    if recollections and (
+        memory_prompt := channel_memory.render(
+            recollections, chain_ids(msg_nodes, new_msg.id, len(messages))
+        )
+    ):
+        messages.insert(0, dict(role="system", content=memory_prompt))
+
+    logging.info(
+        "Message received (user ID: %s, attachments: %d, conversation length: %d):\n%s",
+        new_msg.author.id,
+        len(new_msg.attachments),
+        len(messages),
+        format_content(new_msg.content),
+    )
+
+    # In cache-friendly mode the leading system prompt must stay byte-identical
+    # between turns, so volatile lines ({date}/{time}) are sent after the history.
+    cache_friendly_prompts = cfg.get("cache_friendly_prompts", False)
+    # A blank value in config.yaml loads as None
+    time_granularity = cfg.get("system_prompt_time_granularity") or (
+        "minute" if cache_friendly_prompts else "second"
+    )
+    raw_system_prompt = cfg.get("system_prompt", "") or ""
+    stable_prompt, volatile_prompt = (
+        split_volatile_prompt(raw_system_prompt)
+        if cache_friendly_prompts
+        else (raw_system_prompt, "")
+    )
+
+    if volatile_prompt := format_system_prompt(
+        volatile_prompt,
+        accept_usernames=False,
+        time_granularity=time_granularity,
+    ):
+        messages.insert(0, dict(role="system", content=volatile_prompt))
+
+    if system_prompt := format_system_prompt(
+        stable_prompt,
+        accept_usernames=accept_usernames,
+        users_listing=users_listing,
+        time_granularity=time_granularity,
+    ):
+        messages.append(dict(role="system", content=system_prompt))
+
+    if cache_friendly_prompts:
+        cache_key = (
+            f"llmcord-{new_msg.guild.id}"
+            if new_msg.guild
+            else f"llmcord-dm-{new_msg.author.id}"
+        )
+        if any(
+            x in provider_slash_model.lower()
+            for x in PROVIDERS_SUPPORTING_PROMPT_CACHE_KEY
+        ):
+            extra_body.setdefault("prompt_cache_key", cache_key)
+        if any(
+            x in provider_slash_model.lower() for x in PROVIDERS_SUPPORTING_CACHE_PROMPT
+        ):
+            extra_body.setdefault("cache_prompt", True)
+
+    embed = build_warnings_embed(user_warnings)
+    use_plain_responses = cfg.get("use_plain_responses", False)
+    max_message_length = (
+        2000
+        if use_plain_responses
+        else (EMBED_DESCRIPTION_MAX_LENGTH - len(STREAMING_INDICATOR))
+    )
+
+    recovery = stream_recovery_for(cfg, provider_config)
+
+    stage_start = time.perf_counter()
+    try:
+        with trace.span("stream_and_reply"):
+            await stream_and_reply(
+                new_msg=new_msg,
+                openai_client=backend.openai_client,
+                model=backend.model,
+                display_model=provider_slash_model,
+                messages=cast("list[ChatCompletionMessageParam]", messages),
+                embed=embed,
+                use_plain_responses=use_plain_responses,
+                max_message_length=max_message_length,
+                extra_headers=backend.extra_headers,
+                extra_query=backend.extra_query,
+                extra_body=extra_body,
+                msg_nodes=msg_nodes,
+                block_response_regex=cfg.get("block_response_regex"),
+                reply_length_cap=cfg.get("reply_length_cap"),
+                trace=trace,
+                on_response_msg=on_response_msg,
+                on_usage=on_usage,
+                fast_stream=cfg.get("fast_stream", False),
+                recovery=recovery,
+            )
+    except asyncio.CancelledError:
+        logging.info(f"Task for message {new_msg.id} was cancelled.")
+        raise
+    except Exception:
+        logging.exception("Error while generating response")
+        return
+
+    timings["generation"] = time.perf_counter() - stage_start
+
+    logging.info(
+        "Request complete | %s",
+        " | ".join(f"{k}={v:.3f}s" for k, v in timings.items()),
+        extra={"timings": timings},
+    )
+
+    await prune_msg_nodes(msg_nodes, MAX_MESSAGE_NODES)
+
+
+__all__ = [
+    "conversation_options",
+    "generate_reply",
+    "provider_request_options",
+    "stream_recovery_for",
+    "users_listing_for",
+]
@@ -0,0 +1,237 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from collections.abc import Awaitable, Iterable
+from typing import Any
+
+import discord
+import httpx
+
+from .messages import MsgNode, build_conversation_context, image_store
+from .metrics import metrics
+from .pipeline import conversation_options
+from .providers import get_openai_client
+
+# Bounds for the per-(channel, user) bookkeeping
+MAX_TRACKED_CONVERSATIONS = 10000
+# Provider connections are re-warmed at most this often (well within the keepalive)
+PROVIDER_WARM_INTERVAL_SECONDS = 20.0
+PROVIDER_WARM_TIMEOUT_SECONDS = 5.0
+
+
+class Prewarmer:
+    """Resolves a conversation's context while a likely follow-up is being typed.
+
+    Someone typing in a channel where the bot recently replied to them, or in a DM
+    with the bot, will probably continue from that reply. Resolving the chain (and its
+    attachments) then, and opening a provider connection, takes that work off the
+    critical path of the next reply. Speculation is rate limited per conversation and
+    globally, and every speculation is scored as a hit or miss once the next message
+    from that user arrives (or the window passes).
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.window_seconds = 300.0
+        self.cooldown_seconds = 30.0
+        self.max_per_minute = 30
+        self.max_concurrent = 2
+        self.warm_provider = True
+
+        # (channel ID, user ID) -> (ID of the bot's last reply to them, time)
+        self._recent: OrderedDict[tuple[int, int], tuple[int, float]] = OrderedDict()
+        # (channel ID, user ID) -> (message the speculation started from, time)
+        self._speculations: OrderedDict[tuple[int, int], tuple[int, float]] = (
+            OrderedDict()
+        )
+        self._last_attempt: OrderedDict[tuple[int, int], float] = OrderedDict()
+        self._recent_starts: deque[float] = deque()
+        self._active = 0
+        self._provider_warmed: dict[str, float] = {}
+
+    def configure(self, config: dict[str, Any]) -> None:
+        prewarm_cfg = config.get("prewarm") or {}
+        self.enabled = prewarm_cfg.get("enabled", False)
+        self.window_seconds = prewarm_cfg.get("window_seconds", 300)
+        self.cooldown_seconds = prewarm_cfg.get("cooldown_seconds", 30)
+        self.max_per_minute = prewarm_cfg.get("max_per_minute", 30)
+        self.max_concurrent = prewarm_cfg.get("max_concurrent", 2)
+        self.warm_provider = prewarm_cfg.get("warm_provider", True)
+
+    @staticmethod
+    def _remember(store: OrderedDict[Any, Any], key: Any, value: Any) -> None:
+        store[key] = value
+        store.move_to_end(key)
+        if len(store) > MAX_TRACKED_CONVERSATIONS:
+            store.popitem(last=False)
+
+    def note_reply(self, channel_id: int, user_id: int, msg_id: int) -> None:
+        """Record the bot's latest reply message to a user in a channel."""
+        self._remember(self._recent, (channel_id, user_id), (msg_id, time.monotonic()))
+
+    def _target(self, channel: Any, user: Any, now: float) -> int | None:
+        recent = self._recent.get((channel.id, user.id))
+        if recent is not None and now - recent[1] <= self.window_seconds:
+            return recent[0]
+        if isinstance(channel, discord.DMChannel):
+            # Un-replied DMs continue from the previous message in the channel
+            return channel.last_message_id
+        return None
+
+    def _admit(self, key: tuple[int, int], now: float) -> bool:
+        reason = None
+        if now - self._last_attempt.get(key, float("-inf")) < self.cooldown_seconds:
+            reason = "cooldown"
+        elif self._active >= self.max_concurrent:
+            reason = "concurrency"
+        else:
+            while self._recent_starts and now - self._recent_starts[0] > 60:
+                self._recent_starts.popleft()
+            if len(self._recent_starts) >= self.max_per_minute:
+                reason = "rate"
+
+        if reason is not None:
+            metrics.incr("prewarm_skipped", reason=reason)
+            return False
+        self._remember(self._last_attempt, key, now)
+        self._recent_starts.append(now)
+        return True
+
+    def _score(self, hit: bool) -> None:
+        metrics.incr("prewarm_hits" if hit else "prewarm_misses")
+        hits, misses = metrics.get("prewarm_hits"), metrics.get("prewarm_misses")
+        logging.debug(
+            "Prewarm %s (hit rate %.1f%% of %d)",
+            "hit" if hit else "miss",
+            hits / (hits + misses) * 100,
+            hits + misses,
+        )
+
+    def observe(self, new_msg: discord.Message) -> None:
+        """Score the speculation (if any) for the author of an incoming message."""
+        speculation = self._speculations.pop(
+            (new_msg.channel.id, new_msg.author.id), None
+        )
+        if speculation is None:
+            return
+        target_id, started = speculation
+        reference_id = getattr(new_msg.reference, "message_id", None)
+        self._score(
+            time.monotonic() - started <= self.window_seconds
+            and (
+                reference_id == target_id
+                or (
+                    reference_id is None
+                    and isinstance(new_msg.channel, discord.DMChannel)
+                )
+            )
+        )
+
+    async def maybe_prewarm(
+        self,
+        *,
+        channel: Any,
+        user: Any,
+        cfg: dict[str, Any],
+        provider_slash_model: str,
+        bot_user: discord.ClientUser,
+        msg_nodes: dict[int, MsgNode],
+        httpx_client: httpx.AsyncClient,
+        cached_messages: Iterable[discord.Message],
+    ) -> None:
+        """Called on typing events from authorized users."""
+        if not self.enabled:
+            return
+
+        now = time.monotonic()
+        key = (channel.id, user.id)
+        if (speculation := self._speculations.get(key)) is not None:
+            if now - speculation[1] <= self.window_seconds:
+                # Already warmed for this conversation; typing events repeat every ~10s
+                return
+            del self._speculations[key]
+            self._score(False)
+
+        target_id = self._target(channel, user, now)
+        if target_id is None:
+            return
+        if (node := msg_nodes.get(target_id)) is not None and node.lock.locked():
+            # Still being generated or resolved; nothing to gain by waiting on it
+            return
+        if not self._admit(key, now):
+            return
+
+        self._remember(self._speculations, key, (target_id, now))
+        self._active += 1
+        start = time.perf_counter()
+        nodes_before = len(msg_nodes)
+        try:
+            target = discord.utils.get(cached_messages, id=target_id)
+            if target is None:
+                target = await channel.fetch_message(target_id)
+
+            image_store.configure(cfg)
+            warm_tasks: list[Awaitable[Any]] = [
+                build_conversation_context(
+                    new_msg=target,
+                    bot_user=bot_user,
+                    msg_nodes=msg_nodes,
+                    httpx_client=httpx_client,
+                    **conversation_options(cfg, provider_slash_model),
+                )
+            ]
+            if self.warm_provider:
+                warm_tasks.append(self._warm_provider(cfg, provider_slash_model))
+            await asyncio.gather(*warm_tasks)
+
+            metrics.incr("prewarm_runs")
+            metrics.incr("prewarm_nodes_resolved", len(msg_nodes) - nodes_before)
+            logging.debug(
+                "Prewarmed conversation for user %s in channel %s (%d new nodes, %.3fs)",
+                user.id,
+                channel.id,
+                len(msg_nodes) - nodes_before,
+                time.perf_counter() - start,
+            )
+        except (discord.HTTPException, httpx.HTTPError):
+            metrics.incr("prewarm_failed")
+            logging.debug("Prewarm failed for channel %s", channel.id, exc_info=True)
+        finally:
+            self._active -= 1
+
+    async def _warm_provider(
+        self, cfg: dict[str, Any], provider_slash_model: str
+    ) -> None:
+        provider = provider_slash_model.split("/", 1)[0]
+        provider_config = cfg["providers"][provider]
+        base_url = provider_config["base_url"]
+
+        now = time.monotonic()
+        if (
+            now - self._provider_warmed.get(base_url, float("-inf"))
+            < PROVIDER_WARM_INTERVAL_SECONDS
+        ):
+            return
+        self._provider_warmed[base_url] = now
+
+        # The SDK is loaded by the time providers are warmed
+        import openai
+
+        # Any cheap request will do: the point is a pooled, already-handshaken connection
+        try:
+            await asyncio.wait_for(
+                get_openai_client(provider_config).models.list(),
+                timeout=PROVIDER_WARM_TIMEOUT_SECONDS,
+            )
+        except (openai.APIError, TimeoutError):
+            # Many providers don't implement /models; the connection is still opened
+            pass
+
+
+prewarmer = Prewarmer()
+
+
+__all__ = ["Prewarmer", "prewarmer"]
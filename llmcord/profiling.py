@@ -0,0 +1,278 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from dataclasses import dataclass
+from types import CodeType, FrameType
+from typing import Any, Literal
+
+from .metrics import metrics
+
+# Interactions can be followed up for 15 minutes
+MAX_PROFILE_SECONDS = 600
+MEMORY_TRACEBACK_FRAMES = 10
+SUMMARY_TOP_GROUPS = 12
+# The frame that runs one event loop callback; frames above it belong to the callback
+_HANDLE_RUN_LABEL = "asyncio.events:Handle._run"
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__)) + os.sep
+
+ProfileKind = Literal["cpu", "memory"]
+
+
+@dataclass(slots=True)
+class Profile:
+    kind: ProfileKind
+    seconds: float
+    # Short enough for a Discord message
+    summary: str
+    filename: str
+    data: bytes
+
+
+def _group(module: str) -> str:
+    """llmcord modules by name, anything else by its top-level package."""
+    if module.startswith("llmcord."):
+        return module
+    return f"({module.split('.', 1)[0] or 'unknown'})"
+
+
+def _module_of(filename: str) -> str:
+    if filename.startswith(_PACKAGE_DIR):
+        relative = filename[len(_PACKAGE_DIR) :].removesuffix(".py")
+        return "llmcord." + relative.replace(os.sep, ".")
+    _, sep, rest = filename.rpartition(f"site-packages{os.sep}")
+    if sep:
+        return rest.split(os.sep, 1)[0].removesuffix(".py")
+    return "python"
+
+
+def _format_bytes(size: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return f"{size:+,.0f} {unit}" if unit == "B" else f"{size:+,.1f} {unit}"
+        size /= 1024
+    return f"{size:+,.1f} GiB"
+
+
+class Profiler:
+    """Bounded CPU and memory profiles of the running bot, one at a time.
+
+    CPU profiles sample every thread's stack from a background thread every
+    `sample_interval_ms` while the bot keeps serving, and return them as collapsed
+    stacks (readable by flamegraph.pl and speedscope). Event loop samples are grouped by
+    the innermost llmcord module of the callback that was running, or counted as idle.
+    Memory profiles trace allocations with tracemalloc for the duration and return what
+    was allocated and is still alive at the end, grouped the same way.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.max_seconds = 60
+        self.sample_interval = 0.01
+        self.top = 25
+
+        # The kind of profile in progress
+        self.running: ProfileKind | None = None
+
+    def configure(self, config: dict[str, Any]) -> None:
+        profiling_cfg = config.get("profiling") or {}
+        self.enabled = profiling_cfg.get("enabled", False)
+        self.max_seconds = min(
+            profiling_cfg.get("max_seconds", 60), MAX_PROFILE_SECONDS
+        )
+        self.sample_interval = profiling_cfg.get("sample_interval_ms", 10) / 1000
+        self.top = profiling_cfg.get("top", 25)
+
+    async def run(self, kind: ProfileKind, seconds: float) -> Profile:
+        """Profile for `seconds` (clamped to max_seconds). Raises if one is running."""
+        if self.running is not None:
+            raise RuntimeError(f"A {self.running} profile is already running")
+        seconds = max(1.0, min(float(seconds), self.max_seconds))
+        self.running = kind
+        logging.info("Starting a %ds %s profile", seconds, kind)
+        try:
+            if kind == "cpu":
+                profile = await self._profile_cpu(seconds)
+            else:
+                profile = await self._profile_memory(seconds)
+        finally:
+            self.running = None
+        metrics.incr("profiles", kind=kind)
+        return profile
+
+    @staticmethod
+    def _loop_group(stack: list[tuple[str, str]]) -> str:
+        """What the event loop thread was doing in one sample (frames innermost first)."""
+        innermost_llmcord: str | None = None
+        for label, module in stack:
+            if label == _HANDLE_RUN_LABEL:
+                # Calls into libraries count toward the llmcord code that made them
+                return innermost_llmcord or _group(stack[0][1])
+            if innermost_llmcord is None and module.startswith("llmcord."):
+                innermost_llmcord = module
+        # Not in a callback: waiting for events, or the loop's own bookkeeping
+        return "(idle)" if stack and stack[0][1] == "selectors" else "(event loop)"
+
+    async def _profile_cpu(self, seconds: float) -> Profile:
+        loop_thread_id = threading.get_ident()
+        # Sampling only records code object IDs; they are labelled once at the end
+        samples: Counter[tuple[int, tuple[int, ...]]] = Counter()
+        # Code object ID -> (label, module name, code object kept alive so IDs are unique)
+        codes: dict[int, tuple[str, str, CodeType]] = {}
+        names: dict[int, str] = {}
+        stop = threading.Event()
+
+        def sample() -> None:
+            own_id = threading.get_ident()
+            while not stop.wait(self.sample_interval):
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_id:
+                        continue
+                    if thread_id not in names:
+                        names.update(
+                            (t.ident or 0, t.name) for t in threading.enumerate()
+                        )
+                        names.setdefault(thread_id, str(thread_id))
+                    stack: list[int] = []
+                    current: FrameType | None = frame
+                    while current is not None:
+                        code = current.f_code
+                        if (key := id(code)) not in codes:
+                            module = current.f_globals.get("__name__") or "?"
+                            codes[key] = (f"{module}:{code.co_qualname}", module, code)
+                        stack.append(key)
+                        current = current.f_back
+                    samples[thread_id, tuple(stack)] += 1
+
+        sampler = threading.Thread(target=sample, name="llmcord-profiler", daemon=True)
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            stop.set()
+            await asyncio.to_thread(sampler.join)
+        elapsed = time.perf_counter() - start
+
+        stacks: Counter[str] = Counter()
+        loop_groups: Counter[str] = Counter()
+        for (thread_id, stack), count in samples.items():
+            frames = [codes[key][:2] for key in stack]
+            labels = [names[thread_id]]
+            labels.extend(label for label, _ in reversed(frames))
+            stacks[";".join(labels)] += count
+            if thread_id == loop_thread_id:
+                loop_groups[self._loop_group(frames)] += count
+
+        loop_samples = sum(loop_groups.values())
+        lines = [
+            (
+                f"CPU profile: {elapsed:.1f}s, {loop_samples:,} event loop samples "
+                f"every {self.sample_interval * 1000:g} ms"
+            ),
+        ]
+        for group, count in loop_groups.most_common(SUMMARY_TOP_GROUPS):
+            lines.append(f"{count / loop_samples * 100:6.1f}%  {group}")
+        other_samples = sum(stacks.values()) - loop_samples
+        lines.append(
+            f"Other threads: {other_samples:,} samples (in the attached stacks)"
+        )
+
+        data = "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+        return Profile(
+            kind="cpu",
+            seconds=elapsed,
+            summary="\n".join(lines),
+            filename=f"cpu-{int(time.time())}.collapsed.txt",
+            data=data.encode(),
+        )
+
+    async def _profile_memory(self, seconds: float) -> Profile:
+        # Leave tracing on if it was started some other way (e.g. PYTHONTRACEMALLOC)
+        was_tracing = tracemalloc.is_tracing()
+        if not was_tracing:
+            tracemalloc.start(MEMORY_TRACEBACK_FRAMES)
+        start = time.perf_counter()
+        try:
+            before = await asyncio.to_thread(tracemalloc.take_snapshot)
+            await asyncio.sleep(seconds)
+            after = await asyncio.to_thread(tracemalloc.take_snapshot)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            if not was_tracing:
+                tracemalloc.stop()
+        elapsed = time.perf_counter() - start
+        return await asyncio.to_thread(
+            self._memory_report, before, after, elapsed, peak
+        )
+
+    def _memory_report(
+        self,
+        before: tracemalloc.Snapshot,
+        after: tracemalloc.Snapshot,
+        elapsed: float,
+        peak: int,
+    ) -> Profile:
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        before = before.filter_traces(filters)
+        after = after.filter_traces(filters)
+        by_traceback = after.compare_to(before, "traceback")
+
+        sizes: Counter[str] = Counter()
+        blocks: Counter[str] = Counter()
+        for stat in by_traceback:
+            modules = [_module_of(frame.filename) for frame in stat.traceback]
+            # Frames are oldest first; attribute to the innermost llmcord frame
+            group = next(
+                (m for m in reversed(modules) if m.startswith("llmcord.")),
+                _group(modules[-1]) if modules else "(unknown)",
+            )
+            sizes[group] += stat.size_diff
+            blocks[group] += stat.count_diff
+        total = sum(sizes.values())
+
+        lines = [
+            (
+                f"Memory profile: {elapsed:.1f}s, {_format_bytes(total)} still allocated "
+                f"at the end (peak traced {_format_bytes(peak).lstrip('+')})"
+            ),
+        ]
+        ranked = sorted(sizes, key=lambda group: abs(sizes[group]), reverse=True)
+        for group in ranked[:SUMMARY_TOP_GROUPS]:
+            lines.append(
+                f"{_format_bytes(sizes[group]):>13}  {blocks[group]:+8,} blocks  {group}"
+            )
+        summary = "\n".join(lines)
+
+        report = [summary, "", f"Top {self.top} allocation sites:"]
+        for stat in after.compare_to(before, "lineno")[: self.top]:
+            frame = stat.traceback[0]
+            report.append(
+                f"{_format_bytes(stat.size_diff):>13}  {stat.count_diff:+8,} blocks  "
+                f"{frame.filename}:{frame.lineno}"
+            )
+        report += ["", f"Top {self.top} tracebacks:"]
+        for stat in by_traceback[: self.top]:
+            report.append(
+                f"\n{_format_bytes(stat.size_diff)} in {stat.count_diff:+,} blocks"
+            )
+            report.extend(stat.traceback.format(most_recent_first=True))
+        return Profile(
+            kind="memory",
+            seconds=elapsed,
+            summary=summary,
+            filename=f"memory-{int(time.time())}.txt",
+            data="\n".join(report).encode(),
+        )
+
+
+profiler = Profiler()
+
+
+__all__ = ["Profile", "Profiler", "profiler"]
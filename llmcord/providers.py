@@ -0,0 +1,297 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Literal
+
+import httpx
+
+from .capture import recorder
+from .constants import PROVIDER_KEEPALIVE_SECONDS
+from .metrics import metrics
+from .sse import StreamError
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+
+# One client per (base_url, api_key) so connection pools are reused across requests
+_clients: dict[tuple[str, str], AsyncOpenAI] = {}
+# And the HTTP clients fast streams (sse.open_fast_stream) send their requests with
+_stream_clients: dict[tuple[str, str], httpx.AsyncClient] = {}
+
+
+def _http_client() -> httpx.AsyncClient:
+    # Deferred: the SDK takes most of a second to import and isn't needed until the
+    # first request.
+    from openai import DefaultAsyncHttpxClient
+
+    return DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=1000,
+            max_keepalive_connections=100,
+            keepalive_expiry=PROVIDER_KEEPALIVE_SECONDS,
+        ),
+        event_hooks=recorder.event_hooks(),
+    )
+
+
+def get_openai_client(provider_config: dict[str, Any]) -> AsyncOpenAI:
+    """Return a cached OpenAI-compatible client for a provider entry in config.yaml."""
+    base_url = provider_config["base_url"]
+    api_key = provider_config.get("api_key") or "sk-no-key-required"
+
+    client = _clients.get((base_url, api_key))
+    if client is None:
+        from openai import AsyncOpenAI
+
+        client = _clients[(base_url, api_key)] = AsyncOpenAI(
+            base_url=base_url, api_key=api_key, http_client=_http_client()
+        )
+    return client
+
+
+def get_stream_client(openai_client: AsyncOpenAI) -> httpx.AsyncClient:
+    """Return the cached HTTP client for fast streams to this client's provider."""
+    key = (str(openai_client.base_url), openai_client.api_key)
+    client = _stream_clients.get(key)
+    if client is None:
+        client = _stream_clients[key] = _http_client()
+    return client
+
+
+async def close_openai_clients() -> None:
+    for client in list(_clients.values()):
+        try:
+            await client.close()
+        except Exception:
+            logging.warning(
+                "Failed to close client for %s", client.base_url, exc_info=True
+            )
+    _clients.clear()
+    for stream_client in list(_stream_clients.values()):
+        try:
+            await stream_client.aclose()
+        except Exception:
+            logging.warning("Failed to close a fast stream client", exc_info=True)
+    _stream_clients.clear()
+
+
+def provider_of(provider_slash_model: str) -> str:
+    return provider_slash_model.split("/", 1)[0]
+
+
+def is_outage(error: BaseException) -> bool:
+    """Failures that suggest the provider is down, rather than the request being bad."""
+    if isinstance(error, (StreamError, httpx.TransportError)):
+        return True
+    # The SDK is imported by the time a request fails
+    import openai
+
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500
+    # Includes timeouts
+    return isinstance(error, openai.APIConnectionError)
+
+
+class ProviderUnavailable(Exception):
+    """Raised instead of sending a request to a provider whose circuit is open."""
+
+
+@dataclass(slots=True)
+class CircuitBreaker:
+    state: Literal["closed", "open"] = "closed"
+    # Consecutive outage failures (requests while closed, probes while open)
+    failures: int = 0
+    last_error: str = ""
+    # time.time() of the last state change
+    since: float = 0.0
+    last_probe: float = 0.0
+
+
+class ProviderHealth:
+    """A circuit breaker per provider, closed again by background probes.
+
+    After `failure_threshold` consecutive outages (connection errors, timeouts, 5xx
+    responses, error events mid-stream) a provider's circuit opens: its requests fail
+    at once with `ProviderUnavailable`, or go to `fallback_model` if that provider is
+    up. While any circuit is open, each such provider is probed every
+    `probe_interval_seconds` (its `/models` endpoint, or a one-token completion) and
+    the circuit closes on the first success.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.failure_threshold = 3
+        self.probe_interval = 15.0
+        self.probe_timeout = 5.0
+        self.probe: Literal["models", "completion"] = "models"
+        self.fallback_model: str | None = None
+
+        self._config: dict[str, Any] = {}
+        self._breakers: dict[str, CircuitBreaker] = {}
+        self._probe_task: asyncio.Task | None = None
+
+    def configure(self, config: dict[str, Any]) -> None:
+        breaker_cfg = config.get("circuit_breaker") or {}
+        self.enabled = breaker_cfg.get("enabled", False)
+        self.failure_threshold = breaker_cfg.get("failure_threshold", 3)
+        self.probe_interval = breaker_cfg.get("probe_interval_seconds", 15)
+        self.probe_timeout = breaker_cfg.get("probe_timeout_seconds", 5)
+        self.probe = breaker_cfg.get("probe", "models")
+        self.fallback_model = breaker_cfg.get("fallback_model") or None
+        self._config = config
+
+    def _breaker(self, provider: str) -> CircuitBreaker:
+        breaker = self._breakers.get(provider)
+        if breaker is None:
+            breaker = self._breakers[provider] = CircuitBreaker(since=time.time())
+        return breaker
+
+    def available(self, provider: str) -> bool:
+        breaker = self._breakers.get(provider)
+        return not self.enabled or breaker is None or breaker.state == "closed"
+
+    def check(self, provider_slash_model: str) -> None:
+        """Raise ProviderUnavailable if requests to this model's provider should fail fast."""
+        provider = provider_of(provider_slash_model)
+        if self.available(provider):
+            return
+        metrics.incr("provider_fail_fast", provider=provider)
+        breaker = self._breakers[provider]
+        raise ProviderUnavailable(
+            f"`{provider}` is unavailable ({breaker.last_error}). "
+            "It is being checked in the background, please try again shortly."
+        )
+
+    def route(self, provider_slash_model: str) -> str:
+        """The model to use: `fallback_model` while this model's provider is down."""
+        fallback = self.fallback_model
+        if (
+            fallback is None
+            or fallback == provider_slash_model
+            or self.available(provider_of(provider_slash_model))
+            or not self.available(provider_of(fallback))
+        ):
+            return provider_slash_model
+        logging.info(
+            "Provider of %s is unavailable, using %s", provider_slash_model, fallback
+        )
+        metrics.incr("provider_reroutes", provider=provider_of(provider_slash_model))
+        return fallback
+
+    def record_success(self, provider: str) -> None:
+        if (breaker := self._breakers.get(provider)) is not None:
+            breaker.failures = 0
+
+    def record_failure(self, provider: str, error: BaseException) -> None:
+        if not self.enabled or not is_outage(error):
+            return
+        breaker = self._breaker(provider)
+        breaker.failures += 1
+        breaker.last_error = f"{type(error).__name__}: {error}"[:200]
+        metrics.incr("provider_failures", provider=provider)
+        if breaker.state == "closed" and breaker.failures >= self.failure_threshold:
+            self._set_state(provider, breaker, "open")
+            if self._probe_task is None or self._probe_task.done():
+                self._probe_task = asyncio.create_task(self._probe_open())
+
+    def _set_state(
+        self, provider: str, breaker: CircuitBreaker, state: Literal["closed", "open"]
+    ) -> None:
+        breaker.state = state
+        breaker.since = time.time()
+        breaker.failures = 0 if state == "closed" else breaker.failures
+        metrics.incr(f"provider_circuit_{state}", provider=provider)
+        log = logging.warning if state == "open" else logging.info
+        log(
+            "Circuit for provider %s %s%s",
+            provider,
+            "opened" if state == "open" else "closed",
+            f" ({breaker.last_error})" if state == "open" else "",
+        )
+
+    async def _probe_open(self) -> None:
+        while open_providers := [
+            provider
+            for provider, breaker in self._breakers.items()
+            if breaker.state == "open"
+        ]:
+            await asyncio.sleep(self.probe_interval)
+            await asyncio.gather(*[self._probe_one(p) for p in open_providers])
+
+    async def _probe_one(self, provider: str) -> None:
+        breaker = self._breaker(provider)
+        provider_config = (self._config.get("providers") or {}).get(provider)
+        if provider_config is None:
+            # Removed from the config; nothing will be sent to it
+            self._breakers.pop(provider, None)
+            return
+
+        breaker.last_probe = time.time()
+        client = get_openai_client(provider_config).with_options(
+            timeout=self.probe_timeout, max_retries=0
+        )
+        model = next(
+            (
+                m.removesuffix(":vision").split("/", 1)[1]
+                for m in self._config.get("models") or {}
+                if provider_of(m) == provider
+            ),
+            None,
+        )
+        try:
+            if self.probe == "completion" and model is not None:
+                await client.chat.completions.create(
+                    model=model,
+                    messages=[dict(role="user", content="ping")],
+                    max_tokens=1,
+                )
+            else:
+                await client.models.list()
+        except Exception as e:
+            import openai
+
+            # Any answer below 500 (e.g. no /models endpoint) means the server is up
+            if is_outage(e) or not isinstance(e, openai.APIStatusError):
+                breaker.failures += 1
+                breaker.last_error = f"{type(e).__name__}: {e}"[:200]
+                metrics.incr("provider_probes", provider=provider, outcome="failed")
+                return
+        metrics.incr("provider_probes", provider=provider, outcome="ok")
+        self._set_state(provider, breaker, "closed")
+
+    def status(self) -> dict[str, dict[str, Any]]:
+        return {
+            provider: dict(
+                state=breaker.state,
+                failures=breaker.failures,
+                last_error=breaker.last_error,
+                since=round(breaker.since),
+                last_probe=round(breaker.last_probe),
+            )
+            for provider, breaker in self._breakers.items()
+        }
+
+    async def stop(self) -> None:
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            self._probe_task = None
+
+
+provider_health = ProviderHealth()
+
+
+__all__ = [
+    "CircuitBreaker",
+    "ProviderHealth",
+    "ProviderUnavailable",
+    "close_openai_clients",
+    "get_openai_client",
+    "get_stream_client",
+    "is_outage",
+    "provider_health",
+    "provider_of",
+]
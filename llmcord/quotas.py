@@ -0,0 +1,317 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Literal
+
+from .metrics import metrics
+
+LEDGER_FILENAME = "usage.sqlite3"
+# Idle buckets are dropped past this many (they are rebuilt from the ledger if needed)
+MAX_TRACKED_BUCKETS = 10000
+PRUNE_INTERVAL_SECONDS = 24 * 3600
+
+
+class UsageLedger:
+    """Token usage per request, kept in a local SQLite database.
+
+    Every method blocks on disk I/O; callers on the event loop go through
+    `asyncio.to_thread`. One connection is shared behind a lock.
+    """
+
+    def __init__(self) -> None:
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._conn is not None
+
+    def open(self, state_dir: str) -> None:
+        path = Path(state_dir) / LEDGER_FILENAME
+        path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS usage (
+                ts REAL NOT NULL,
+                user_id INTEGER NOT NULL,
+                guild_id INTEGER,
+                model TEXT NOT NULL,
+                prompt_tokens INTEGER NOT NULL,
+                completion_tokens INTEGER NOT NULL,
+                cached_tokens INTEGER NOT NULL
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS usage_ts ON usage (ts)")
+        conn.execute("CREATE INDEX IF NOT EXISTS usage_user ON usage (user_id, ts)")
+        conn.execute("CREATE INDEX IF NOT EXISTS usage_guild ON usage (guild_id, ts)")
+        conn.commit()
+        self._conn = conn
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def insert(self, rows: list[tuple[Any, ...]]) -> None:
+        """Rows are (ts, user_id, guild_id, model, prompt, completion, cached)."""
+        with self._lock:
+            if self._conn is None:
+                return
+            self._conn.executemany(
+                "INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            self._conn.commit()
+
+    def prune(self, before: float) -> int:
+        with self._lock:
+            if self._conn is None:
+                return 0
+            deleted = self._conn.execute(
+                "DELETE FROM usage WHERE ts < ?", (before,)
+            ).rowcount
+            self._conn.commit()
+            return deleted
+
+    def tokens_since(
+        self, scope: Literal["user", "guild"], target_id: int, model: str, since: float
+    ) -> int:
+        with self._lock:
+            if self._conn is None:
+                return 0
+            (total,) = self._conn.execute(
+                f"SELECT COALESCE(SUM(prompt_tokens + completion_tokens), 0) FROM usage "
+                f"WHERE {scope}_id = ? AND model = ? AND ts >= ?",
+                (target_id, model, since),
+            ).fetchone()
+            return int(total)
+
+    def top_consumers(
+        self, by: Literal["user", "guild"], since: float, limit: int = 10
+    ) -> list[tuple[int, int, int, int]]:
+        """(ID, prompt tokens, completion tokens, requests), heaviest first."""
+        with self._lock:
+            if self._conn is None:
+                return []
+            return self._conn.execute(
+                f"SELECT {by}_id, SUM(prompt_tokens), SUM(completion_tokens), COUNT(*) "
+                f"FROM usage WHERE ts >= ? AND {by}_id IS NOT NULL GROUP BY {by}_id "
+                f"ORDER BY SUM(prompt_tokens + completion_tokens) DESC LIMIT ?",
+                (since, limit),
+            ).fetchall()
+
+
+@dataclass(slots=True)
+class _Bucket:
+    level: float
+    updated: float
+
+
+class QuotaManager:
+    """Token-bucket quotas per user and per guild, and the usage ledger behind them.
+
+    A request is admitted while its user's and guild's buckets for the current model
+    hold any tokens; its actual usage (prompt + completion tokens, known once the
+    stream ends) is debited afterwards, so one large reply can push a bucket below
+    zero and the wait grows accordingly. Buckets refill continuously at `rate` tokens
+    per minute up to `burst`. After a restart a bucket starts out debited by what the
+    ledger recorded within one full refill period, so limits survive restarts.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.ledger_enabled = True
+        self.retention_days = 90
+        self._defaults: dict[str, dict[str, Any]] = {}
+        self._models: dict[str, dict[str, dict[str, Any]]] = {}
+
+        self.ledger = UsageLedger()
+        self._buckets: dict[tuple[str, int, str], _Bucket] = {}
+        self._pending: list[tuple[Any, ...]] = []
+        self._flush_task: asyncio.Task | None = None
+        self._last_prune = 0.0
+        # User ID -> when they may be told about being over quota again
+        self._notified: dict[int, float] = {}
+
+    def configure(self, config: dict[str, Any]) -> None:
+        quota_cfg = config.get("quotas") or {}
+        self.enabled = quota_cfg.get("enabled", False)
+        self.ledger_enabled = quota_cfg.get("ledger", True)
+        self.retention_days = quota_cfg.get("retention_days", 90)
+        self._defaults = {
+            scope: quota_cfg.get(scope) or {} for scope in ("user", "guild")
+        }
+        self._models = quota_cfg.get("models") or {}
+
+    def open(self, state_dir: str) -> None:
+        if self.ledger_enabled and not self.ledger.is_open:
+            self.ledger.open(state_dir)
+
+    def limits(self, scope: str, model: str) -> tuple[float, float] | None:
+        """(tokens per minute, burst) for a scope and model, or None when unlimited."""
+        limit = (self._models.get(model) or {}).get(scope) or self._defaults.get(scope)
+        if not limit or not limit.get("rate"):
+            return None
+        rate = float(limit["rate"])
+        return rate, float(limit.get("burst") or rate)
+
+    def _targets(
+        self, user_id: int, guild_id: int | None
+    ) -> list[tuple[Literal["user", "guild"], int]]:
+        targets: list[tuple[Literal["user", "guild"], int]] = [("user", user_id)]
+        if guild_id is not None:
+            targets.append(("guild", guild_id))
+        return targets
+
+    async def _bucket(
+        self, scope: Literal["user", "guild"], target_id: int, model: str, now: float
+    ) -> tuple[_Bucket, float, float] | None:
+        if (limits := self.limits(scope, model)) is None:
+            return None
+        rate, burst = limits
+        key = (scope, target_id, model)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            used = 0
+            if self.ledger.is_open:
+                refill_period = burst / rate * 60
+                used = await asyncio.to_thread(
+                    self.ledger.tokens_since,
+                    scope,
+                    target_id,
+                    model,
+                    time.time() - refill_period,
+                )
+            # Another check may have created it while the ledger was read
+            bucket = self._buckets.setdefault(key, _Bucket(burst - used, now))
+            if len(self._buckets) > MAX_TRACKED_BUCKETS:
+                self._drop_idle(now)
+        bucket.level = min(burst, bucket.level + (now - bucket.updated) * rate / 60)
+        bucket.updated = now
+        return bucket, rate, burst
+
+    def _drop_idle(self, now: float) -> None:
+        for key, bucket in list(self._buckets.items()):
+            if (limits := self.limits(key[0], key[2])) is None:
+                del self._buckets[key]
+                continue
+            rate, burst = limits
+            if bucket.level + (now - bucket.updated) * rate / 60 >= burst:
+                del self._buckets[key]
+
+    async def check(
+        self, *, user_id: int, guild_id: int | None, model: str
+    ) -> tuple[Literal["user", "guild"], float] | None:
+        """Return the exhausted scope and seconds until it refills, or None to admit."""
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        for scope, target_id in self._targets(user_id, guild_id):
+            found = await self._bucket(scope, target_id, model, now)
+            if found is None:
+                continue
+            bucket, rate, _ = found
+            if bucket.level <= 0:
+                metrics.incr("quota_rejections", scope=scope, model=model)
+                # Admission needs a level above zero; wait for at least one token
+                return scope, (1 - bucket.level) / rate * 60
+        return None
+
+    def should_notify(self, user_id: int, retry_after: float) -> bool:
+        """Whether to reply to a rejected message (once per user until the refill)."""
+        now = time.monotonic()
+        if now < self._notified.get(user_id, 0.0):
+            return False
+        if len(self._notified) > MAX_TRACKED_BUCKETS:
+            self._notified = {k: v for k, v in self._notified.items() if v > now}
+        self._notified[user_id] = now + retry_after
+        return True
+
+    def record(
+        self,
+        *,
+        user_id: int,
+        guild_id: int | None,
+        model: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+        cached_tokens: int,
+    ) -> None:
+        """Debit a finished request's usage and queue it for the ledger."""
+        tokens = prompt_tokens + completion_tokens
+        metrics.incr("quota_tokens", tokens, model=model)
+        if self.enabled:
+            now = time.monotonic()
+            for scope, target_id in self._targets(user_id, guild_id):
+                if (limits := self.limits(scope, model)) is None:
+                    continue
+                rate, burst = limits
+                bucket = self._buckets.setdefault(
+                    (scope, target_id, model), _Bucket(burst, now)
+                )
+                bucket.level = (
+                    min(burst, bucket.level + (now - bucket.updated) * rate / 60)
+                    - tokens
+                )
+                bucket.updated = now
+
+        if not self.ledger.is_open:
+            return
+        self._pending.append(
+            (
+                time.time(),
+                user_id,
+                guild_id,
+                model,
+                prompt_tokens,
+                completion_tokens,
+                cached_tokens,
+            )
+        )
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush())
+
+    async def _flush(self) -> None:
+        # Rows recorded while a write is in progress go out in the next batch
+        while self._pending:
+            rows, self._pending = self._pending, []
+            try:
+                await asyncio.to_thread(self.ledger.insert, rows)
+            except sqlite3.Error:
+                logging.exception("Failed to write %d usage records", len(rows))
+
+        if time.monotonic() - self._last_prune > PRUNE_INTERVAL_SECONDS:
+            self._last_prune = time.monotonic()
+            cutoff = time.time() - self.retention_days * 86400
+            try:
+                await asyncio.to_thread(self.ledger.prune, cutoff)
+            except sqlite3.Error:
+                logging.exception("Failed to prune the usage ledger")
+
+    async def top_consumers(
+        self, by: Literal["user", "guild"], since: float, limit: int = 10
+    ) -> list[tuple[int, int, int, int]]:
+        if self._flush_task is not None:
+            await asyncio.shield(self._flush_task)
+        return await asyncio.to_thread(self.ledger.top_consumers, by, since, limit)
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            await self._flush_task
+        self.ledger.close()
+
+
+quotas = QuotaManager()
+
+
+__all__ = ["QuotaManager", "UsageLedger", "quotas"]
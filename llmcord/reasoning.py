@@ -38,6 +38,10 @@ class ThinkBlockRedactor:
                 close_idx = combined.find(self.CLOSE_TAG, i)
                 saw_thinking = True
                 if close_idx == -1:
+                    # Keep what may be the start of a close tag split across chunks
+                    self._pending_prefix = combined[
+                        max(i, length - self._buffer_size) :
+                    ]
                     return "", True
                 i = close_idx + len(self.CLOSE_TAG)
                 self._inside_think_block = False
@@ -77,8 +81,9 @@ class ThinkBlockRedactor:
                 emit_now = ""
                 self._pending_prefix = sanitized_all
         else:
-            emit_now = ""
-            self._pending_prefix = ""
+            # Text before the open tag is complete
+            emit_now = sanitized_all
+            self._pending_prefix = combined[max(i, length - self._buffer_size) :]
 
         return emit_now, saw_thinking
 
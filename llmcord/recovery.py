@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any
+
+import httpx
+
+from .constants import STREAM_RECOVERY_CONTINUE_PROMPT
+from .sse import StreamError
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+
+@dataclass(frozen=True)
+class Backend:
+    """Everything needed to send a chat completion request to one provider/model."""
+
+    openai_client: AsyncOpenAI
+    model: str
+    display_model: str
+    extra_headers: dict[str, Any] | None
+    extra_query: dict[str, Any] | None
+    extra_body: dict[str, Any] | None
+    # The provider's `continuation` setting: None when it can't continue a trailing
+    # assistant message, else extra fields for that message ("message") and the
+    # request body ("body")
+    continuation: dict[str, Any] | None = None
+
+
+def continuation_setting(provider_config: dict[str, Any]) -> dict[str, Any] | None:
+    setting = provider_config.get("continuation")
+    if not setting:
+        return None
+    return setting if isinstance(setting, dict) else {}
+
+
+@dataclass(frozen=True)
+class StreamRecovery:
+    """How stream_and_reply recovers from a provider failing mid-reply.
+
+    The first retry goes to the same backend; later ones to `fallback` if set. Each
+    retry continues from the text already shown instead of starting over: as a
+    trailing assistant message the model extends where the backend supports it, else
+    followed by an instruction to continue.
+    """
+
+    max_retries: int
+    # continuation_setting() of the provider the reply started on
+    continuation: dict[str, Any] | None = None
+    fallback: Backend | None = None
+
+    def backend_for(self, attempt: int, primary: Backend) -> Backend:
+        """The backend for retry number `attempt` (1-based)."""
+        return self.fallback if self.fallback is not None and attempt > 1 else primary
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Connection drops, timeouts, server errors and rate limits; not bad requests."""
+    if isinstance(error, (StreamError, httpx.TransportError)):
+        return True
+    # The SDK is imported by the time a request fails
+    import openai
+
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    # Connection errors and error events sent mid-stream
+    return isinstance(error, openai.APIError)
+
+
+def continuation_request(
+    messages: list[Any], partial: str, backend: Backend
+) -> tuple[list[Any], dict[str, Any] | None]:
+    """Messages (oldest first) and extra body asking `backend` to continue `partial`."""
+    if not partial:
+        return messages, backend.extra_body
+    if backend.continuation is None:
+        return messages + [
+            dict(role="assistant", content=partial),
+            dict(role="user", content=STREAM_RECOVERY_CONTINUE_PROMPT),
+        ], backend.extra_body
+
+    prefix = dict(role="assistant", content=partial) | (
+        backend.continuation.get("message") or {}
+    )
+    extra_body = (backend.extra_body or {}) | (backend.continuation.get("body") or {})
+    return messages + [prefix], extra_body
+
+
+__all__ = [
+    "Backend",
+    "StreamRecovery",
+    "continuation_request",
+    "continuation_setting",
+    "is_retryable",
+]
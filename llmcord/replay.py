@@ -0,0 +1,507 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import gc
+import gzip
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict, deque
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any
+from urllib.parse import urlsplit
+
+import discord
+import httpx
+import yaml
+from aiohttp import web
+
+from .capture import CAPTURE_FORMAT_VERSION, recorder
+from .config import get_config
+from .fakes import FakeDiscord, _FakeServer
+from .history import message_history
+from .log import setup_logging
+from .providers import get_openai_client
+from .tracing import tracer
+
+REPLAY_TIMEOUT_SECONDS = 300
+
+
+@dataclass
+class ReplayResult:
+    name: str
+    runs: int
+    # Best of `runs`, so scheduling noise only ever inflates a single run
+    wall_seconds: float
+    cpu_seconds: float
+    sends: int
+    edits: int
+    recorded_sends: int
+    recorded_edits: int
+    problems: list[str] = field(default_factory=list)
+
+
+class _ReplayServer(_FakeServer):
+    """Serves a capture's recorded HTTP exchanges, in order, per method and path.
+
+    At original speed each response waits for its recorded time to first byte and
+    every chunk for its recorded delay, with the original chunk boundaries.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.fast = False
+        self._exchanges: dict[tuple[str, str], deque[dict[str, Any]]] = {}
+        self.unmatched: list[str] = []
+        self.app.router.add_route("*", "/{tail:.*}", self._serve)
+
+    def load(self, exchanges: list[dict[str, Any]], *, fast: bool) -> None:
+        self.fast = fast
+        self.unmatched = []
+        self._exchanges = defaultdict(deque)
+        for exchange in exchanges:
+            self._exchanges[(exchange["method"], exchange["path"])].append(exchange)
+
+    async def _serve(self, request: web.Request) -> web.StreamResponse:
+        queue = self._exchanges.get((request.method, request.path))
+        if not queue:
+            self.unmatched.append(f"{request.method} {request.path}")
+            return web.Response(status=404)
+        # Repeated downloads of the same URL get the last recorded response again
+        exchange = queue.popleft() if len(queue) > 1 else queue[0]
+        await request.read()
+
+        if not self.fast:
+            await asyncio.sleep(exchange["ttfb"])
+        response = web.StreamResponse(
+            status=exchange["status"],
+            headers={"Content-Type": exchange["content_type"] or "application/json"},
+        )
+        await response.prepare(request)
+        for delay, chunk in exchange["chunks"]:
+            if not self.fast and delay:
+                await asyncio.sleep(delay)
+            await response.write(chunk.encode("latin-1"))
+        await response.write_eof()
+        return response
+
+
+def _discord_writes(entries: list[dict[str, Any]]) -> tuple[int, int, list[str]]:
+    """(messages sent, edits, final text of each reply message in order)."""
+    sends = edits = 0
+    texts: dict[str, str] = {}
+    for entry in entries:
+        method, path = entry["method"], entry["path"]
+        if entry.get("status") != 200 or "/messages" not in path:
+            continue
+        if method == "POST" and path.endswith("/messages"):
+            sends += 1
+            msg_id = entry.get("id")
+        elif method == "PATCH":
+            edits += 1
+            msg_id = path.rsplit("/", 1)[-1]
+        else:
+            continue
+        payload = entry.get("payload") or {}
+        text = payload.get("content")
+        if not text and (embeds := payload.get("embeds")):
+            text = embeds[0].get("description")
+        if msg_id is not None:
+            texts[str(msg_id)] = text or ""
+    return sends, edits, list(texts.values())
+
+
+def _conversations(exchanges: list[dict[str, Any]]) -> list[list[Any]]:
+    """The messages of each chat request, minus system prompts (which hold the time)."""
+    return [
+        [
+            m
+            for m in exchange["request"].get("messages", [])
+            if m.get("role") != "system"
+        ]
+        for exchange in exchanges
+        if exchange["path"].endswith("/chat/completions")
+        and isinstance(exchange["request"], dict)
+    ]
+
+
+def load_recording(path: str, bot_id: str | None) -> dict[str, Any]:
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        text = file.read()
+    recorded_id = json.loads(text)["bot_user"]["id"]
+    if bot_id is not None and recorded_id != bot_id:
+        # Replays run as one fake bot user; IDs are unique enough to swap textually
+        text = text.replace(recorded_id, bot_id)
+    return json.loads(text)
+
+
+class _Replayer:
+    def __init__(
+        self,
+        bot: Any,
+        fake: FakeDiscord,
+        server: _ReplayServer,
+        options: argparse.Namespace,
+        directory: str,
+    ) -> None:
+        self.bot = bot
+        self.fake = fake
+        self.server = server
+        self.options = options
+        self.directory = directory
+        self.captured: list[dict[str, Any]] = []
+        self._config_text = ""
+        self._guilds: dict[int, discord.Guild] = {}
+
+    def _rewrite_urls(self, payload: dict[str, Any]) -> dict[str, Any]:
+        """A copy of a message payload with attachments served by the replay server."""
+        payload = json.loads(json.dumps(payload))
+        for att in payload.get("attachments") or []:
+            for key in ("url", "proxy_url"):
+                if att.get(key):
+                    att[key] = self.server.url + urlsplit(att[key]).path
+        return payload
+
+    def _channel(self, recording: dict[str, Any]) -> Any:
+        state = self.bot.discord_bot._connection
+        channel_data = recording["channel"]
+        self.fake.add_channel(channel_data)
+        channel_id = int(channel_data["id"])
+
+        if recording["guild"] is None:
+            return state.add_dm_channel(channel_data)
+
+        guild_data = recording["guild"]
+        guild = self._guilds.get(int(guild_data["id"]))
+        if guild is None:
+            guild = self._guilds[int(guild_data["id"])] = state._add_guild_from_data(
+                dict(
+                    id=guild_data["id"],
+                    name=guild_data["name"],
+                    icon=None,
+                    owner_id=recording["bot_user"]["id"],
+                    member_count=len(guild_data["members"]),
+                    features=[],
+                    emojis=[],
+                    stickers=[],
+                    roles=[
+                        dict(
+                            id=guild_data["id"],
+                            name="@everyone",
+                            permissions="0",
+                            position=0,
+                            color=0,
+                            hoist=False,
+                            managed=False,
+                            mentionable=False,
+                        )
+                    ],
+                    channels=[],
+                    members=[],
+                )
+            )
+        for user in guild_data["members"]:
+            if guild.get_member(int(user["id"])) is None:
+                guild._add_member(
+                    discord.Member(
+                        data=dict(user=user, roles=[], joined_at=None, flags=0),  # type: ignore[arg-type]
+                        guild=guild,
+                        state=state,
+                    )
+                )
+
+        if (channel := guild.get_channel_or_thread(channel_id)) is None:
+            if channel_data["type"] in (10, 11, 12):
+                channel = discord.Thread(guild=guild, state=state, data=channel_data)
+                guild._add_thread(channel)
+            else:
+                channel = discord.TextChannel(
+                    guild=guild, state=state, data=channel_data
+                )
+                guild._add_channel(channel)
+        return channel
+
+    def _write_config(self, recording: dict[str, Any]) -> None:
+        config = dict(recording["config"])
+        config.update(
+            bot_token="replay",
+            client_id=None,
+            status_message=None,
+            providers={
+                name: dict(
+                    base_url=self.server.url + provider["path"],
+                    extra_body=provider.get("extra_body"),
+                    continuation=provider.get("continuation"),
+                )
+                for name, provider in recording["config"]["providers"].items()
+            },
+            permissions=dict(
+                users=dict(admin_ids=[], allowed_ids=[], blocked_ids=[]),
+                roles=dict(allowed_ids=[], blocked_ids=[]),
+                channels=dict(allowed_ids=[], blocked_ids=[]),
+            ),
+            logging=dict(level=self.options.log_level),
+            # Replays are captured in memory to compare with the recording
+            capture=dict(enabled=True, sample_rate=1.0),
+            state_dir=os.path.join(self.directory, "state"),
+        )
+        # Rewriting an unchanged config could reuse a cached parse of the old one
+        if (text := yaml.safe_dump(config)) == self._config_text:
+            return
+        self._config_text = text
+        with open(
+            os.path.join(self.directory, "config.yaml"), "w", encoding="utf-8"
+        ) as file:
+            file.write(text)
+
+    async def run_once(
+        self, recording: dict[str, Any]
+    ) -> tuple[float, float, dict[str, Any] | None]:
+        bot = self.bot
+        channel = self._channel(recording)
+        for entry in recording["discord"]:
+            if entry["method"] == "GET" and entry.get("status") == 200:
+                response = entry.get("response")
+                for payload in response if isinstance(response, list) else [response]:
+                    if isinstance(payload, dict) and "author" in payload:
+                        self._seed(payload)
+        for payload in [*recording["messages"], recording["trigger"]]:
+            self._seed(payload)
+
+        self._write_config(recording)
+        self.server.load(recording["http"], fast=self.options.fast)
+        bot.msg_nodes.clear()
+        message_history.clear()
+        bot.curr_model = recording["model"]
+        self.captured.clear()
+
+        msg = bot.discord_bot._connection.create_message(
+            channel=channel, data=self._rewrite_urls(recording["trigger"])
+        )
+        gc.collect()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        await bot.on_message(msg)
+        if (request := bot.active_requests.get(msg.id)) is not None:
+            await asyncio.wait_for(asyncio.shield(request.task), REPLAY_TIMEOUT_SECONDS)
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        return wall, cpu, self.captured[0] if self.captured else None
+
+    def _seed(self, payload: dict[str, Any]) -> None:
+        payload = self._rewrite_urls(payload)
+        self.fake.messages[int(payload["channel_id"])][int(payload["id"])] = payload
+
+    async def replay(
+        self, name: str, recording: dict[str, Any], baseline: dict[str, Any] | None
+    ) -> ReplayResult:
+        recorded_sends, recorded_edits, recorded_texts = _discord_writes(
+            recording["discord"]
+        )
+        recorded_conversations = _conversations(recording["http"])
+        result = ReplayResult(
+            name=name,
+            runs=self.options.repeat,
+            wall_seconds=float("inf"),
+            cpu_seconds=float("inf"),
+            sends=0,
+            edits=0,
+            recorded_sends=recorded_sends,
+            recorded_edits=recorded_edits,
+        )
+        problems: dict[str, None] = {}
+        for _ in range(self.options.repeat):
+            wall, cpu, replayed = await self.run_once(recording)
+            result.wall_seconds = min(result.wall_seconds, wall)
+            result.cpu_seconds = min(result.cpu_seconds, cpu)
+            if replayed is None:
+                problems["no reply"] = None
+                continue
+
+            result.sends, result.edits, texts = _discord_writes(replayed["discord"])
+            if texts != recorded_texts:
+                problems["output differs"] = None
+            if _conversations(replayed["http"]) != recorded_conversations:
+                problems["conversation differs"] = None
+            if result.sends != recorded_sends:
+                problems["send count differs"] = None
+            if (
+                not self.options.fast
+                and abs(result.edits - recorded_edits) > self.options.edit_tolerance
+            ):
+                problems["edit count differs"] = None
+            for unmatched in self.server.unmatched:
+                problems[f"unrecorded request {unmatched}"] = None
+
+        if baseline is not None and (
+            result.cpu_seconds
+            > baseline["cpu_seconds"] * (1 + self.options.cpu_tolerance)
+        ):
+            problems[
+                f"CPU {result.cpu_seconds * 1000:.1f} ms over baseline "
+                f"{baseline['cpu_seconds'] * 1000:.1f} ms"
+            ] = None
+        result.problems = list(problems)
+        return result
+
+
+async def run_replay(options: argparse.Namespace) -> list[ReplayResult]:
+    """Replay captured requests through on_message offline and check the results.
+
+    Each capture's Discord messages are served by a fake REST API and its provider
+    streams and attachments by a local server, at the recorded timing (or at once
+    with --fast). A replay fails when the reply text, the conversation sent to the
+    provider, the number of messages sent or (at recorded speed) edits differ from
+    the capture, or when CPU time exceeds the --baseline.
+    """
+    from . import bot
+
+    paths = [
+        str(p)
+        for path in options.captures
+        for p in (
+            sorted(Path(path).glob("*.json.gz")) if Path(path).is_dir() else [path]
+        )
+    ]
+    if not paths:
+        print("No captures found", file=sys.stderr)
+        return []
+
+    baseline: dict[str, Any] = {}
+    if options.baseline:
+        baseline_text = await asyncio.to_thread(
+            Path(options.baseline).read_text, encoding="utf-8"
+        )
+        baseline = {r["name"]: r for r in json.loads(baseline_text)}
+
+    first = load_recording(paths[0], None)
+    fake_discord = FakeDiscord()
+    fake_discord.bot_user = first["bot_user"]
+    server = _ReplayServer()
+    await fake_discord.start()
+    await server.start()
+
+    original_base = discord.http.Route.BASE
+    original_cwd = os.getcwd()
+    workdir = tempfile.TemporaryDirectory(prefix="llmcord-replay-")
+    results: list[ReplayResult] = []
+    try:
+        replayer = _Replayer(bot, fake_discord, server, options, workdir.name)
+        replayer._write_config(first)
+        os.chdir(workdir.name)
+        bot.config = get_config()
+        setup_logging(bot.config)
+        tracer.configure(bot.config)
+        recorder.sink = replayer.captured.append
+        bot.httpx_client = httpx.AsyncClient(event_hooks=recorder.event_hooks())
+        # Import the provider SDK up front so it isn't counted in the first replay
+        for provider in bot.config["providers"].values():
+            get_openai_client(provider)
+
+        discord.http.Route.BASE = f"{fake_discord.url}/api/v10"
+        await bot.discord_bot.login(bot.config["bot_token"])
+        recorder.install(bot.discord_bot.http)
+
+        print(_format_header())
+        for path in paths:
+            name = os.path.basename(path).removesuffix(".json.gz")
+            recording = load_recording(path, first["bot_user"]["id"])
+            if recording.get("format") != CAPTURE_FORMAT_VERSION:
+                print(f"{name}: unsupported capture format", file=sys.stderr)
+                continue
+            result = await replayer.replay(name, recording, baseline.get(name))
+            results.append(result)
+            print(_format_row(result), flush=True)
+    finally:
+        recorder.sink = None
+        os.chdir(original_cwd)
+        workdir.cleanup()
+        if bot.httpx_client is not None:
+            await bot.httpx_client.aclose()
+        await bot.discord_bot.close()
+        discord.http.Route.BASE = original_base
+        await fake_discord.stop()
+        await server.stop()
+
+    if options.json:
+        await asyncio.to_thread(
+            Path(options.json).write_text,
+            json.dumps([asdict(r) for r in results], indent=2),
+            encoding="utf-8",
+        )
+    if any(r.problems for r in results):
+        sys.exit(1)
+    return results
+
+
+_COLUMNS = (
+    ("capture", 22),
+    ("wall s", 8),
+    ("cpu ms", 8),
+    ("sends", 7),
+    ("edits", 9),
+    ("result", 0),
+)
+
+
+def _format_header() -> str:
+    return " ".join(name.rjust(width) for name, width in _COLUMNS)
+
+
+def _format_row(r: ReplayResult) -> str:
+    values = (
+        r.name,
+        f"{r.wall_seconds:.2f}",
+        f"{r.cpu_seconds * 1000:.1f}",
+        f"{r.sends}/{r.recorded_sends}",
+        f"{r.edits}/{r.recorded_edits}",
+        "; ".join(r.problems) or "ok",
+    )
+    return " ".join(v.rjust(width) for v, (_, width) in zip(values, _COLUMNS))
+
+
+def add_parser(subparsers: Any) -> None:
+    parser = subparsers.add_parser(
+        "replay",
+        help="Replay captured requests offline as regression benchmarks",
+        description=run_replay.__doc__,
+    )
+    parser.add_argument(
+        "captures",
+        nargs="+",
+        help="Capture files, or directories of them (capture.dir in config.yaml)",
+    )
+    parser.add_argument(
+        "--fast",
+        action="store_true",
+        help="Serve recorded streams without their delays (edit counts aren't checked)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Replay each capture this many times and keep the best timings (default: 3)",
+    )
+    parser.add_argument(
+        "--edit-tolerance",
+        type=int,
+        default=1,
+        help="Allowed difference from the recorded edit count (default: 1)",
+    )
+    parser.add_argument(
+        "--baseline", help="Results JSON from an earlier run to compare CPU time with"
+    )
+    parser.add_argument(
+        "--cpu-tolerance",
+        type=float,
+        default=0.25,
+        help="Allowed CPU time increase over the baseline (default: 0.25)",
+    )
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", help="Also write results to this JSON file")
+    parser.set_defaults(func=lambda options: asyncio.run(run_replay(options)))
+
+
+__all__ = ["ReplayResult", "add_parser", "load_recording", "run_replay"]
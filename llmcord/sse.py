@@ -0,0 +1,225 @@
+from __future__ import annotations
+
+import json
+import logging
+from collections.abc import AsyncIterator
+from typing import TYPE_CHECKING, Any, NamedTuple
+
+import httpx
+
+from .metrics import metrics
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+
+class ChatDelta(NamedTuple):
+    """The parts of a chat completion chunk that stream_and_reply uses."""
+
+    content: str
+    reasoning: str
+    finish_reason: str | None
+    # (prompt, completion, cached) tokens, from the trailing usage chunk
+    usage: tuple[int, int, int] | None
+    # False for heartbeat/meta events and the usage chunk, which carry no choices
+    has_choice: bool
+
+
+class StreamError(Exception):
+    """An error event sent by the provider in the middle of a stream."""
+
+
+def _usage_tuple(usage: dict[str, Any] | None) -> tuple[int, int, int] | None:
+    if not usage:
+        return None
+    details = usage.get("prompt_tokens_details") or {}
+    return (
+        usage.get("prompt_tokens") or 0,
+        usage.get("completion_tokens") or 0,
+        details.get("cached_tokens") or 0,
+    )
+
+
+def decode_chunk(data: bytes) -> ChatDelta:
+    chunk = json.loads(data)
+    if (error := chunk.get("error")) is not None:
+        raise StreamError(
+            error.get("message", error) if isinstance(error, dict) else error
+        )
+    usage = _usage_tuple(chunk.get("usage"))
+    if not (choices := chunk.get("choices")):
+        return ChatDelta("", "", None, usage, False)
+    choice = choices[0]
+    delta = choice.get("delta") or {}
+    return ChatDelta(
+        delta.get("content") or "",
+        delta.get("reasoning_content") or delta.get("reasoning") or "",
+        choice.get("finish_reason"),
+        usage,
+        True,
+    )
+
+
+class FastChatStream:
+    """Chat completion stream read straight off a pooled provider connection.
+
+    Server-sent events are split from the raw bytes and only the fields in
+    `ChatDelta` are read from each chunk's JSON, skipping the SDK's per-chunk model
+    construction.
+    """
+
+    def __init__(self, response: httpx.Response) -> None:
+        self.response = response
+
+    async def close(self) -> None:
+        await self.response.aclose()
+
+    async def __aiter__(self) -> AsyncIterator[ChatDelta]:
+        buffer = bytearray()
+        data: list[bytes] = []
+        try:
+            async for received in self.response.aiter_bytes():
+                buffer += received
+                start = 0
+                while (end := buffer.find(b"\n", start)) >= 0:
+                    line = bytes(buffer[start:end]).rstrip(b"\r")
+                    start = end + 1
+                    if line.startswith(b"data:"):
+                        data.append(line[6:] if line[5:6] == b" " else line[5:])
+                    elif not line and data:
+                        # A blank line ends the event
+                        payload = data[0] if len(data) == 1 else b"\n".join(data)
+                        data.clear()
+                        if payload == b"[DONE]":
+                            return
+                        yield decode_chunk(payload)
+                del buffer[:start]
+            if data and (payload := b"\n".join(data)) != b"[DONE]":
+                yield decode_chunk(payload)
+        finally:
+            await self.response.aclose()
+
+
+def _status_error(response: httpx.Response) -> Exception:
+    """The error the SDK raises for this (read) error response."""
+    import openai
+
+    text = response.text.strip()
+    body: Any = text
+    try:
+        body = json.loads(text)
+        message = f"Error code: {response.status_code} - {body}"
+    except ValueError:
+        message = text or f"Error code: {response.status_code}"
+    if isinstance(body, dict):
+        body = body.get("error", body)
+
+    error_types: dict[int, type[openai.APIStatusError]] = {
+        400: openai.BadRequestError,
+        401: openai.AuthenticationError,
+        403: openai.PermissionDeniedError,
+        404: openai.NotFoundError,
+        409: openai.ConflictError,
+        422: openai.UnprocessableEntityError,
+        429: openai.RateLimitError,
+    }
+    error_type = error_types.get(response.status_code) or (
+        openai.InternalServerError
+        if response.status_code >= 500
+        else openai.APIStatusError
+    )
+    return error_type(message, response=response, body=body)
+
+
+async def open_fast_stream(
+    openai_client: AsyncOpenAI,
+    http_client: httpx.AsyncClient,
+    *,
+    model: str,
+    messages: list[Any],
+    extra_headers: dict[str, Any] | None,
+    extra_query: dict[str, Any] | None,
+    extra_body: dict[str, Any] | None,
+) -> FastChatStream | None:
+    """Start a streaming chat completion, or return None to use the SDK instead.
+
+    The request goes out once, on `http_client` (providers.get_stream_client), with
+    the SDK client's URL, headers and timeout. Error statuses and connection failures
+    raise what the SDK would; only a successful response that isn't an event stream
+    (a provider that ignores `stream`) returns None, for the SDK to handle.
+    """
+    import openai
+
+    headers = {
+        k: v for k, v in openai_client.default_headers.items() if isinstance(v, str)
+    }
+    headers["Accept"] = "text/event-stream"
+    headers.update(extra_headers or {})
+    body = dict(model=model, messages=messages, stream=True) | (extra_body or {})
+
+    request = http_client.build_request(
+        "POST",
+        str(openai_client.base_url.join("chat/completions")),
+        headers=headers,
+        params=extra_query,
+        content=json.dumps(body).encode(),
+        timeout=openai_client.timeout,
+    )
+    try:
+        response = await http_client.send(request, stream=True)
+    except httpx.TimeoutException as e:
+        raise openai.APITimeoutError(request=request) from e
+    except httpx.TransportError as e:
+        raise openai.APIConnectionError(request=request) from e
+
+    if response.status_code >= 400:
+        try:
+            await response.aread()
+        finally:
+            await response.aclose()
+        metrics.incr("fast_stream_errors", status=str(response.status_code))
+        raise _status_error(response)
+    if not response.headers.get("content-type", "").startswith("text/event-stream"):
+        await response.aclose()
+        logging.debug("Fast stream got a %s response; using the SDK", response)
+        metrics.incr("fast_stream_fallbacks", reason=str(response.status_code))
+        return None
+    return FastChatStream(response)
+
+
+async def sdk_deltas(stream: Any) -> AsyncIterator[ChatDelta]:
+    """Adapt an SDK chat completion stream to `ChatDelta`s."""
+    async for event in stream:
+        usage = getattr(event, "usage", None)
+        usage_tuple = None
+        if usage is not None:
+            details = getattr(usage, "prompt_tokens_details", None)
+            usage_tuple = (
+                getattr(usage, "prompt_tokens", 0) or 0,
+                getattr(usage, "completion_tokens", 0) or 0,
+                getattr(details, "cached_tokens", 0) or 0,
+            )
+        if not getattr(event, "choices", None):
+            yield ChatDelta("", "", None, usage_tuple, False)
+            continue
+        choice = event.choices[0]
+        delta = getattr(choice, "delta", None)
+        yield ChatDelta(
+            getattr(delta, "content", "") or "",
+            getattr(delta, "reasoning_content", "")
+            or getattr(delta, "reasoning", "")
+            or "",
+            getattr(choice, "finish_reason", None),
+            usage_tuple,
+            True,
+        )
+
+
+__all__ = [
+    "ChatDelta",
+    "FastChatStream",
+    "StreamError",
+    "decode_chunk",
+    "open_fast_stream",
+    "sdk_deltas",
+]
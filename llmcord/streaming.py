@@ -1,14 +1,14 @@
 from __future__ import annotations
 
+import asyncio
 import time
-from typing import Any, Awaitable, cast
+from collections.abc import AsyncIterator, Awaitable, Callable
+from typing import TYPE_CHECKING, Any, cast
 import inspect
 import logging
 import re
 
 import discord
-from openai import AsyncOpenAI
-from openai.types.chat import ChatCompletionMessageParam
 
 from .constants import (
     EMBED_COLOR_COMPLETE,
@@ -18,9 +18,130 @@ from .constants import (
     THINKING_SINCE_TEMPLATE,
     DONE_THINKING_PREFIX,
     FOOTER_STREAMING_SUFFIX,
+    FOOTER_CANCELLED_TEMPLATE,
+    CANCEL_REASON_DEFAULT,
+    STREAM_RETRY_DELAY_SECONDS,
 )
 from .messages import MsgNode
+from .log import format_content
+from .metrics import metrics, record_usage
+from .providers import get_stream_client, provider_health, provider_of
 from .reasoning import ThinkBlockRedactor
+from .recovery import Backend, StreamRecovery, continuation_request, is_retryable
+from .sse import ChatDelta, FastChatStream, open_fast_stream, sdk_deltas
+from .tracing import NOOP_TRACE
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+    from openai.types.chat import ChatCompletionMessageParam
+
+
+async def close_stream(stream: Any) -> None:
+    """Best-effort close of a provider stream so the upstream generation stops."""
+    if stream is None:
+        return
+    try:
+        # Different providers may implement close differently
+        close_func = getattr(stream, "close", None)
+        if callable(close_func):
+            maybe_awaitable = close_func()
+            if inspect.isawaitable(maybe_awaitable):
+                await cast(Awaitable[object], maybe_awaitable)
+
+        # Some variants expose an underlying HTTP response with close()/aclose()
+        response_obj = getattr(stream, "response", None)
+        if response_obj is not None:
+            aclose_func = getattr(response_obj, "aclose", None)
+            close_func = getattr(response_obj, "close", None)
+            if callable(aclose_func):
+                maybe_awaitable = aclose_func()
+                if inspect.isawaitable(maybe_awaitable):
+                    await cast(Awaitable[object], maybe_awaitable)
+            elif callable(close_func):
+                close_func()
+    except Exception:
+        pass
+
+
+async def open_chat_stream(
+    backend: Backend,
+    messages: list[Any],
+    extra_body: dict[str, Any] | None,
+    *,
+    fast_stream: bool,
+) -> Any:
+    """Start a streaming chat completion, with the lean decoder when `fast_stream`."""
+    opened: Any = None
+    if fast_stream:
+        opened = await open_fast_stream(
+            backend.openai_client,
+            get_stream_client(backend.openai_client),
+            model=backend.model,
+            messages=messages,
+            extra_headers=backend.extra_headers,
+            extra_query=backend.extra_query,
+            extra_body=extra_body,
+        )
+    if opened is None:
+        # Correct usage: await create() to get an async iterator
+        opened = await backend.openai_client.chat.completions.create(
+            model=backend.model,
+            messages=messages,
+            stream=True,
+            extra_headers=backend.extra_headers,
+            extra_query=backend.extra_query,
+            extra_body=extra_body,
+        )
+    return opened
+
+
+def chat_deltas(stream: Any) -> AsyncIterator[ChatDelta]:
+    """The deltas of a stream started by open_chat_stream."""
+    return stream if isinstance(stream, FastChatStream) else sdk_deltas(stream)
+
+
+def estimate_prompt_tokens(messages: list[ChatCompletionMessageParam]) -> int:
+    """Roughly how many tokens the text of `messages` takes (~4 chars per token)."""
+    chars = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            chars += len(content)
+        elif content:
+            chars += sum(len(part.get("text", "")) for part in content)
+    return round(chars / 4)
+
+
+def find_plain_split(text: str, limit: int, in_fence: bool = False) -> int:
+    """Return where to end a plain message of at most `limit` characters.
+
+    Prefers paragraph, line, sentence and word boundaries (in that order) in the second
+    half of the window that are outside a code fence (`in_fence` if `text` starts inside
+    one), then line boundaries inside one (the caller closes the fence and re-opens it in
+    the next message); falls back to a hard split.
+    """
+    if len(text) <= limit:
+        return len(text)
+    window = text[:limit]
+    for sep in ("\n\n", "\n", ". ", "! ", "? ", " "):
+        idx = window.rfind(sep)
+        while idx > limit // 2:
+            end = idx + len(sep)
+            if (in_fence + window.count("```", 0, end)) % 2 == 0:
+                return end
+            idx = window.rfind(sep, 0, idx)
+    idx = window.rfind("\n")
+    return idx + 1 if idx > limit // 2 else limit
+
+
+def open_fence_after(text: str, fence: str | None) -> str | None:
+    """Return the code fence line (e.g. "```py") still open at the end of `text`.
+
+    `fence` is the one open at its start, if any.
+    """
+    for match in re.finditer(r"```[^`\n]*", text):
+        fence = None if fence is not None else match.group(0)
+    return fence
 
 
 async def stream_and_reply(
@@ -39,8 +160,26 @@ async def stream_and_reply(
     msg_nodes: dict[int, MsgNode],
     block_response_regex: str | None = None,
     reply_length_cap: int | None = None,
+    trace: Any = NOOP_TRACE,
+    on_response_msg: Callable[[discord.Message], None] | None = None,
+    on_usage: Callable[[int, int, int], None] | None = None,
+    fast_stream: bool = False,
+    recovery: StreamRecovery | None = None,
 ) -> tuple[list[discord.Message], list[str]]:
-    """Stream chat completion and update Discord messages."""
+    """Stream chat completion and update Discord messages.
+
+    `on_usage` receives the prompt, completion and cached token counts from the
+    provider's usage chunk, or estimates from the text if none came (e.g. the reply was
+    cancelled, aborted or failed first). With `fast_stream` the response is read
+    by `sse.FastChatStream` instead of the SDK where possible. With `recovery`, a
+    retryable provider failure mid-reply continues the reply from the text already
+    sent, in the same messages.
+
+    If the task is cancelled (e.g. via `task.cancel(reason)`), the provider stream is
+    closed, partial output is kept with the reason in the footer and the
+    CancelledError is re-raised. However it ends, the response nodes hold the output
+    and their locks are released.
+    """
 
     response_msgs: list[discord.Message] = []
     response_contents: list[str] = []
@@ -71,41 +210,27 @@ async def stream_and_reply(
     # Keep a handle to the underlying OpenAI stream so we can close it early on abort
     stream: Any | None = None
 
-    def _truncate_for_log(text: str, limit: int = 200) -> str:
-        if text is None:
-            return ""
-        if len(text) <= limit:
-            return text
-        return text[:limit] + "… (truncated)"
+    # Plain mode: characters already sent as completed messages, the code fence they
+    # left open (re-opened at the top of the next message), and the text currently shown
+    # in the live (last, still growing) message
+    plain_sent_chars: int = 0
+    plain_fence: str | None = None
+    plain_live_text: str | None = None
+
+    # Set when the task is cancelled mid-stream
+    cancelled: asyncio.CancelledError | None = None
+    cancel_reason: str | None = None
+
+    # Usage reported by the provider (sent in a trailing chunk without choices)
+    usage: tuple[int, int, int] | None = None
+    finished: bool = False
+    # Set once a provider accepted the request, so it bills for it
+    opened: bool = False
 
     async def abort_and_send_error(error_text: str) -> None:
         """Delete any messages we created, release locks, and notify the user."""
         # Proactively close the OpenAI stream if it's still open
-        try:
-            if stream is not None:
-                try:
-                    # Best-effort close; different providers may implement close differently
-                    close_func = getattr(stream, "close", None)
-                    if callable(close_func):
-                        maybe_awaitable = close_func()
-                        if inspect.isawaitable(maybe_awaitable):
-                            await cast(Awaitable[object], maybe_awaitable)
-
-                    # Some variants expose an underlying HTTP response with close()/aclose()
-                    response_obj = getattr(stream, "response", None)
-                    if response_obj is not None:
-                        aclose_func = getattr(response_obj, "aclose", None)
-                        close_func = getattr(response_obj, "close", None)
-                        if callable(aclose_func):
-                            maybe_awaitable = aclose_func()
-                            if inspect.isawaitable(maybe_awaitable):
-                                await cast(Awaitable[object], maybe_awaitable)
-                        elif callable(close_func):
-                            close_func()
-                except Exception:
-                    pass
-        except Exception:
-            pass
+        await close_stream(stream)
         # Delete any partial response messages (including warnings embed if present)
         for msg in list(response_msgs):
             try:
@@ -128,324 +253,575 @@ async def stream_and_reply(
         except Exception:
             pass
 
-    try:
-        # If warnings exist and we're using embeds, send them as a separate message first
-        if (not use_plain_responses) and getattr(embed, "fields", None):
-            try:
-                if len(embed.fields) > 0:
-                    warn_msg = await new_msg.reply(embed=embed, silent=True)
-                    response_msgs.append(warn_msg)
-                    msg_nodes[warn_msg.id] = MsgNode(parent_msg=new_msg)
-                    await msg_nodes[warn_msg.id].lock.acquire()
-            except Exception:
-                pass
+    primary = Backend(
+        openai_client,
+        model,
+        display_model,
+        extra_headers,
+        extra_query,
+        extra_body,
+        recovery.continuation if recovery is not None else None,
+    )
+
+    async def open_stream(
+        backend: Backend,
+        request_messages: list[Any],
+        request_body: dict[str, Any] | None,
+    ) -> Any:
+        provider_health.check(backend.display_model)
+        with trace.span("provider_connect", model=backend.display_model):
+            return await open_chat_stream(
+                backend, request_messages, request_body, fast_stream=fast_stream
+            )
 
-        async with new_msg.channel.typing():
-            # Correct usage: await create() to get an async iterator
-            stream = await openai_client.chat.completions.create(
-                model=model,
-                messages=messages[::-1],
-                stream=True,
-                extra_headers=extra_headers,
-                extra_query=extra_query,
-                extra_body=extra_body,
+    async def recovering_deltas() -> AsyncIterator[ChatDelta]:
+        """The provider's deltas, continued on a new request after retryable failures."""
+        nonlocal stream, display_model, think_redactor, response_full_text, opened
+        backend = primary
+        request_messages: list[Any] = messages[::-1]
+        request_body = extra_body
+        attempt = 0
+        recovered_chars = 0
+        while True:
+            try:
+                stream = await open_stream(backend, request_messages, request_body)
+                opened = True
+                async for delta in chat_deltas(stream):
+                    yield delta
+            except Exception as e:
+                provider_health.record_failure(provider_of(backend.display_model), e)
+                if (
+                    recovery is None
+                    or finished
+                    or attempt >= recovery.max_retries
+                    or not is_retryable(e)
+                ):
+                    if attempt:
+                        metrics.incr("stream_recoveries", outcome="failed")
+                    raise
+                attempt += 1
+                await close_stream(stream)
+                stream = None
+                # Text held back in case it started a <think> tag is part of the reply;
+                # a think block cut off by the failure isn't continued
+                response_full_text += think_redactor.flush()
+                think_redactor = ThinkBlockRedactor()
+                backend = recovery.backend_for(attempt, primary)
+                logging.warning(
+                    "Stream failed (%s: %s), retry %d/%d on %s continuing from %d chars",
+                    type(e).__name__,
+                    e,
+                    attempt,
+                    recovery.max_retries,
+                    backend.display_model,
+                    len(response_full_text),
+                )
+                metrics.incr(
+                    "stream_retries", model=display_model, reason=type(e).__name__
+                )
+                request_messages, request_body = continuation_request(
+                    messages[::-1], response_full_text, backend
+                )
+                recovered_chars = len(response_full_text)
+                display_model = backend.display_model
+                await asyncio.sleep(STREAM_RETRY_DELAY_SECONDS * attempt)
+                continue
+
+            provider_health.record_success(provider_of(backend.display_model))
+            if attempt:
+                metrics.incr("stream_recoveries", outcome="recovered")
+                # Text that was kept instead of generated again (~4 chars per token)
+                metrics.incr(
+                    "recovered_completion_tokens",
+                    recovered_chars / 4.0,
+                    model=display_model,
+                )
+            return
+
+    async def track_response_msg(msg: discord.Message) -> None:
+        response_msgs.append(msg)
+        msg_nodes[msg.id] = MsgNode(
+            parent_id=new_msg.id, parent_channel_id=new_msg.channel.id
+        )
+        await msg_nodes[msg.id].lock.acquire()
+        if on_response_msg is not None:
+            on_response_msg(msg)
+
+    def release_response_nodes() -> None:
+        """Store the partial output on our nodes and release their locks."""
+        for msg in response_msgs:
+            node = msg_nodes.get(msg.id)
+            if node is not None and node.lock.locked():
+                node.text = response_full_text
+                node.lock.release()
+
+    def debit_usage() -> None:
+        """Pass on the provider's usage, or an estimate if it never sent any."""
+        if usage is not None:
+            prompt_tokens, completion_tokens, cached_tokens = usage
+            record_usage(
+                display_model,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                cached_tokens=cached_tokens,
+            )
+        elif opened:
+            # The provider bills what it generated even without sending a usage chunk
+            prompt_tokens = estimate_prompt_tokens(messages)
+            completion_tokens = round(len(response_full_text) / 4)
+            cached_tokens = 0
+            metrics.incr(
+                "estimated_usage_tokens",
+                prompt_tokens + completion_tokens,
+                model=display_model,
             )
+        else:
+            return
+        if on_usage is not None:
+            on_usage(prompt_tokens, completion_tokens, cached_tokens)
+
+    def plain_fence_prefix() -> str:
+        """The re-opened code fence the live plain message starts with, if any."""
+        return f"{plain_fence}\n" if plain_fence is not None else ""
+
+    async def plain_is_blocked(text: str) -> bool:
+        """Apply the block regex to an outgoing plain message; abort the reply on a match."""
+        if regex_pattern is None:
+            return False
+        match_obj = regex_pattern.search(text or "")
+        if match_obj is None:
+            return False
+        logging.info(
+            "Blocked by regex before sending plain chunk | model=%s | matched=%r | preview=%r",
+            display_model,
+            format_content(match_obj.group(0)),
+            format_content(text or ""),
+        )
+        await abort_and_send_error("Response blocked by server policy.")
+        return True
+
+    async def plain_send_or_edit(text: str) -> None:
+        """Show `text` in the live plain message, creating it if needed."""
+        nonlocal plain_live_text
+        if plain_live_text is not None:
+            with trace.span("discord_edit", index=len(response_msgs) - 1):
+                await response_msgs[-1].edit(content=text)
+        else:
+            reply_to_msg = new_msg if not response_msgs else response_msgs[-1]
+            with trace.span("discord_send", index=len(response_msgs)):
+                response_msg = await reply_to_msg.reply(
+                    content=text, suppress_embeds=True
+                )
+            await track_response_msg(response_msg)
+        plain_live_text = text
+
+    # Every exit releases the response nodes locked while streaming (exactly once:
+    # releasing twice could release a lock someone else has acquired since)
+    try:
+        try:
+            # If warnings exist and we're using embeds, send them as a separate message first
+            if (not use_plain_responses) and getattr(embed, "fields", None):
+                try:
+                    if len(embed.fields) > 0:
+                        warn_msg = await new_msg.reply(embed=embed, silent=True)
+                        await track_response_msg(warn_msg)
+                except Exception:
+                    pass
 
-            async for event in stream:
-                # Some providers send heartbeat/meta events without choices
-                if not hasattr(event, "choices") or not event.choices:
-                    continue
+            async with new_msg.channel.typing():
+                async for delta in recovering_deltas():
+                    if delta.usage is not None:
+                        usage = delta.usage
 
-                choice = event.choices[0]
-                # Extract raw content delta if present
-                raw_delta = getattr(getattr(choice, "delta", None), "content", "") or ""
-                visible_delta = ""
+                    # Some providers send heartbeat/meta events without choices
+                    if not delta.has_choice:
+                        continue
 
-                if raw_delta:
-                    visible_delta, saw_thinking = think_redactor.process(raw_delta)
-                    if saw_thinking and not reasoning_started:
+                    # Keep draining after the finish chunk only to pick up usage
+                    if finished:
+                        continue
+
+                    raw_delta = delta.content
+                    visible_delta = ""
+
+                    # Reasoning sent in its own field (not as <think> tags) is never shown
+                    if delta.reasoning and not reasoning_started:
                         reasoning_started = True
                         reasoning_start_perf = time.perf_counter()
                         reasoning_start_unix = int(time.time())
 
-                # On finish, flush any buffered think text even if no content in this chunk
-                if getattr(choice, "finish_reason", None) is not None:
-                    tail = think_redactor.flush()
-                    if tail:
-                        visible_delta += tail
-
-                # Record first visible output time
-                if output_start_perf is None and visible_delta:
-                    output_start_perf = time.perf_counter()
+                    if raw_delta:
+                        visible_delta, saw_thinking = think_redactor.process(raw_delta)
+                        if saw_thinking and not reasoning_started:
+                            reasoning_started = True
+                            reasoning_start_perf = time.perf_counter()
+                            reasoning_start_unix = int(time.time())
+
+                    # On finish, flush any buffered think text even if no content in this chunk
+                    if delta.finish_reason is not None:
+                        tail = think_redactor.flush()
+                        if tail:
+                            visible_delta += tail
+
+                    # Record first visible output time
+                    if output_start_perf is None and visible_delta:
+                        output_start_perf = time.perf_counter()
+                        trace.set(
+                            ttft_ms=round((output_start_perf - start_perf) * 1000, 1)
+                        )
 
-                # Skip if no visible content and not finishing AND no thinking detected
-                if (
-                    not visible_delta
-                    and getattr(choice, "finish_reason", None) is None
-                    and not reasoning_started
-                ):
-                    continue
-
-                # Accumulate visible output
-                if visible_delta:
-                    response_full_text += visible_delta
-
-                # If a block regex is configured, abort immediately if the accumulated
-                # outgoing text would match it (works for both embed and plain modes).
-                if regex_pattern is not None:
-                    try:
-                        match_obj = regex_pattern.search(response_full_text or "")
-                        if match_obj is not None:
-                            try:
-                                logging.info(
-                                    "Blocked by regex during stream accumulation | model=%s | matched=%r | preview=%r",
-                                    display_model,
-                                    _truncate_for_log(match_obj.group(0), 120),
-                                    _truncate_for_log(response_full_text, 200),
+                    # Skip if no visible content and not finishing AND no thinking detected
+                    if (
+                        not visible_delta
+                        and delta.finish_reason is None
+                        and not reasoning_started
+                    ):
+                        continue
+
+                    # Accumulate visible output
+                    if visible_delta:
+                        response_full_text += visible_delta
+
+                    # If a block regex is configured, abort immediately if the accumulated
+                    # outgoing text would match it (works for both embed and plain modes).
+                    if regex_pattern is not None:
+                        try:
+                            match_obj = regex_pattern.search(response_full_text or "")
+                            if match_obj is not None:
+                                try:
+                                    logging.info(
+                                        "Blocked by regex during stream accumulation | model=%s | matched=%r | preview=%r",
+                                        display_model,
+                                        format_content(match_obj.group(0)),
+                                        format_content(response_full_text),
+                                    )
+                                except Exception:
+                                    pass
+                                await abort_and_send_error(
+                                    "Response blocked by server policy."
                                 )
-                            except Exception:
-                                pass
+                                return [], []
+                        except Exception:
+                            pass
+
+                    # Enforce global reply length cap (across the whole reply), if configured
+                    if reply_length_cap is not None and reply_length_cap > 0:
+                        if len(response_full_text) >= reply_length_cap:
                             await abort_and_send_error(
-                                "Response blocked by server policy."
+                                f"Reply length exceeded the configured cap ({reply_length_cap} characters)."
                             )
                             return [], []
-                    except Exception:
-                        pass
-
-                # Enforce global reply length cap (across the whole reply), if configured
-                if reply_length_cap is not None and reply_length_cap > 0:
-                    if len(response_full_text) >= reply_length_cap:
-                        await abort_and_send_error(
-                            f"Reply length exceeded the configured cap ({reply_length_cap} characters)."
-                        )
-                        return [], []
-
-                # Update Discord messages
-                if not use_plain_responses:
-                    ready_to_edit = (
-                        time.monotonic() - last_edit_time
-                    ) >= EDIT_DELAY_SECONDS
-                    is_final_edit = getattr(choice, "finish_reason", None) is not None
-
-                    if ready_to_edit or is_final_edit:
-                        # Build header for the first message only
-                        header = ""
-                        if reasoning_started:
-                            if (
-                                output_start_perf is None
-                                and reasoning_start_unix is not None
-                            ):
-                                header = THINKING_SINCE_TEMPLATE.replace(
-                                    "{ts}", str(reasoning_start_unix)
-                                )
-                            elif (
-                                output_start_perf is not None
-                                and reasoning_start_perf is not None
-                            ):
-                                elapsed_head = output_start_perf - reasoning_start_perf
-                                mins, secs = divmod(int(elapsed_head), 60)
-                                time_str = f"{mins}m {secs}s"
-                                header = DONE_THINKING_PREFIX.replace(
-                                    "{time}", time_str
-                                )
-
-                        # Build full body including streaming indicator (only for the last segment)
-                        body_now = response_full_text
-                        if not is_final_edit:
-                            body_now = body_now + STREAMING_INDICATOR
-
-                        # Split content across multiple messages so nothing is overwritten
-                        split_descriptions: list[str] = []
-                        remaining = body_now.lstrip("\n")
-                        # First message description
-                        newline_len = 1 if header and remaining else 0
-                        first_capacity = max(
-                            0, max_message_length - len(header) - newline_len
-                        )
-                        first_chunk = remaining[:first_capacity]
-                        desc0 = (
-                            header
-                            + ("\n" if header and first_chunk else "")
-                            + first_chunk
-                        )
-                        split_descriptions.append(desc0)
-                        remaining = remaining[len(first_chunk) :]
-                        # Subsequent messages descriptions
-                        while remaining:
-                            chunk = remaining[:max_message_length]
-                            split_descriptions.append(chunk)
-                            remaining = remaining[len(chunk) :]
-
-                        # If a block regex is configured, block immediately if any outgoing message
-                        # (embed description) would match it.
-                        if regex_pattern is not None:
-                            try:
-                                for desc in split_descriptions:
-                                    match_obj = regex_pattern.search(desc or "")
-                                    if match_obj is not None:
-                                        try:
-                                            logging.info(
-                                                "Blocked by regex before sending embed chunk | model=%s | matched=%r | preview=%r",
-                                                display_model,
-                                                _truncate_for_log(
-                                                    match_obj.group(0), 120
-                                                ),
-                                                _truncate_for_log(desc or "", 200),
-                                            )
-                                        except Exception:
-                                            pass
-                                        await abort_and_send_error(
-                                            "Response blocked by server policy."
-                                        )
-                                        return [], []
-                            except Exception:
-                                # If anything goes wrong applying the regex, fail open (continue)
-                                pass
 
-                        # Compute live tokens/sec estimate for footer
-                        try:
-                            now = time.perf_counter()
-                            elapsed_live = (
-                                now - (output_start_perf or start_perf)
-                            ) or 1e-6
-                            approx_tokens_live = len(response_full_text) / 4.0
-                            tps_live = (
-                                approx_tokens_live / elapsed_live
-                                if elapsed_live > 0
-                                else 0.0
+                    # Update Discord messages
+                    if not use_plain_responses:
+                        ready_to_edit = (
+                            time.monotonic() - last_edit_time
+                        ) >= EDIT_DELAY_SECONDS
+                        is_final_edit = delta.finish_reason is not None
+
+                        if ready_to_edit or is_final_edit:
+                            # Build header for the first message only
+                            header = ""
+                            if reasoning_started:
+                                if (
+                                    output_start_perf is None
+                                    and reasoning_start_unix is not None
+                                ):
+                                    header = THINKING_SINCE_TEMPLATE.replace(
+                                        "{ts}", str(reasoning_start_unix)
+                                    )
+                                elif (
+                                    output_start_perf is not None
+                                    and reasoning_start_perf is not None
+                                ):
+                                    elapsed_head = (
+                                        output_start_perf - reasoning_start_perf
+                                    )
+                                    mins, secs = divmod(int(elapsed_head), 60)
+                                    time_str = f"{mins}m {secs}s"
+                                    header = DONE_THINKING_PREFIX.replace(
+                                        "{time}", time_str
+                                    )
+
+                            # Build full body including streaming indicator (only for the last segment)
+                            body_now = response_full_text
+                            if not is_final_edit:
+                                body_now = body_now + STREAMING_INDICATOR
+
+                            # Split content across multiple messages so nothing is overwritten
+                            split_descriptions: list[str] = []
+                            remaining = body_now.lstrip("\n")
+                            # First message description
+                            newline_len = 1 if header and remaining else 0
+                            first_capacity = max(
+                                0, max_message_length - len(header) - newline_len
                             )
-                        except Exception:
-                            tps_live = 0.0
-                        footer_live = f"{display_model} • {tps_live:.1f} tok/s{FOOTER_STREAMING_SUFFIX}"
-
-                        # Create or edit messages to match descriptions
-                        for i, desc in enumerate(split_descriptions):
-                            embed_i = discord.Embed(
-                                description=desc,
-                                color=(
-                                    EMBED_COLOR_COMPLETE
-                                    if is_final_edit
-                                    else EMBED_COLOR_INCOMPLETE
-                                ),
+                            first_chunk = remaining[:first_capacity]
+                            desc0 = (
+                                header
+                                + ("\n" if header and first_chunk else "")
+                                + first_chunk
                             )
-                            embed_i.set_footer(text=footer_live)
+                            split_descriptions.append(desc0)
+                            remaining = remaining[len(first_chunk) :]
+                            # Subsequent messages descriptions
+                            while remaining:
+                                chunk = remaining[:max_message_length]
+                                split_descriptions.append(chunk)
+                                remaining = remaining[len(chunk) :]
+
+                            # If a block regex is configured, block immediately if any outgoing message
+                            # (embed description) would match it.
+                            if regex_pattern is not None:
+                                try:
+                                    for desc in split_descriptions:
+                                        match_obj = regex_pattern.search(desc or "")
+                                        if match_obj is not None:
+                                            try:
+                                                logging.info(
+                                                    "Blocked by regex before sending embed chunk | model=%s | matched=%r | preview=%r",
+                                                    display_model,
+                                                    format_content(match_obj.group(0)),
+                                                    format_content(desc or ""),
+                                                )
+                                            except Exception:
+                                                pass
+                                            await abort_and_send_error(
+                                                "Response blocked by server policy."
+                                            )
+                                            return [], []
+                                except Exception:
+                                    # If anything goes wrong applying the regex, fail open (continue)
+                                    pass
 
-                            if i < len(response_msgs):
-                                # Edit existing message
-                                await response_msgs[i].edit(embed=embed_i)
-                            else:
-                                # Create a new message, chained to the last one for readability
-                                reply_to = (
-                                    new_msg if not response_msgs else response_msgs[-1]
+                            # Compute live tokens/sec estimate for footer
+                            try:
+                                now = time.perf_counter()
+                                elapsed_live = (
+                                    now - (output_start_perf or start_perf)
+                                ) or 1e-6
+                                approx_tokens_live = len(response_full_text) / 4.0
+                                tps_live = (
+                                    approx_tokens_live / elapsed_live
+                                    if elapsed_live > 0
+                                    else 0.0
                                 )
-                                msg = await reply_to.reply(embed=embed_i, silent=True)
-                                response_msgs.append(msg)
-                                msg_nodes[msg.id] = MsgNode(parent_msg=new_msg)
-                                await msg_nodes[msg.id].lock.acquire()
-
-                        last_edit_time = time.monotonic()
-
-                # Break after final finish chunk
-                if getattr(choice, "finish_reason", None) is not None:
-                    break
+                            except Exception:
+                                tps_live = 0.0
+                            footer_live = f"{display_model} • {tps_live:.1f} tok/s{FOOTER_STREAMING_SUFFIX}"
+
+                            # Create or edit messages to match descriptions
+                            for i, desc in enumerate(split_descriptions):
+                                embed_i = discord.Embed(
+                                    description=desc,
+                                    color=(
+                                        EMBED_COLOR_COMPLETE
+                                        if is_final_edit
+                                        else EMBED_COLOR_INCOMPLETE
+                                    ),
+                                )
+                                embed_i.set_footer(text=footer_live)
+
+                                if i < len(response_msgs):
+                                    # Edit existing message
+                                    with trace.span("discord_edit", index=i):
+                                        await response_msgs[i].edit(embed=embed_i)
+                                else:
+                                    # Create a new message, chained to the last one for readability
+                                    reply_to = (
+                                        new_msg
+                                        if not response_msgs
+                                        else response_msgs[-1]
+                                    )
+                                    with trace.span("discord_send", index=i):
+                                        msg = await reply_to.reply(
+                                            embed=embed_i, silent=True
+                                        )
+                                    await track_response_msg(msg)
 
-    except Exception as e:
-        # Handle any streaming errors
-        error_embed = discord.Embed(
-            description=f"Error during streaming: {str(e)}", color=discord.Color.red()
-        )
-        if response_msgs:
-            await response_msgs[-1].edit(embed=error_embed)
-        else:
-            await new_msg.reply(embed=error_embed, silent=True)
-        raise
-
-    # Handle plain text responses (split into multiple messages respecting max length)
-    if use_plain_responses:
-        content = response_full_text
-        remaining = content
-        while remaining:
-            chunk = remaining[:max_message_length]
-            # If a block regex is configured, block immediately if any outgoing chunk would match it.
-            if regex_pattern is not None:
-                try:
-                    match_obj = regex_pattern.search(chunk or "")
-                    if match_obj is not None:
-                        try:
-                            logging.info(
-                                "Blocked by regex before sending plain chunk | model=%s | matched=%r | preview=%r",
+                            last_edit_time = time.monotonic()
+                            logging.debug(
+                                "Stream edit | model=%s | messages=%d | chars=%d",
                                 display_model,
-                                _truncate_for_log(match_obj.group(0), 120),
-                                _truncate_for_log(chunk or "", 200),
+                                len(split_descriptions),
+                                len(response_full_text),
                             )
-                        except Exception:
-                            pass
-                        await abort_and_send_error("Response blocked by server policy.")
-                        return [], []
-                except Exception:
+
+                    else:
+                        ready_to_edit = (
+                            time.monotonic() - last_edit_time
+                        ) >= EDIT_DELAY_SECONDS
+                        is_final_edit = delta.finish_reason is not None
+                        live_capacity = max_message_length - len(STREAMING_INDICATOR)
+
+                        # Complete each full message at a natural boundary as soon as
+                        # possible. A code block split across messages is closed at the
+                        # end of one and re-opened at the top of the next
+                        while (
+                            len(plain_fence_prefix())
+                            + len(response_full_text)
+                            - plain_sent_chars
+                            > live_capacity
+                        ):
+                            prefix = plain_fence_prefix()
+                            pending = response_full_text[plain_sent_chars:]
+                            chunk = pending[
+                                : find_plain_split(
+                                    pending,
+                                    live_capacity - len(prefix) - len("\n```"),
+                                    in_fence=plain_fence is not None,
+                                )
+                            ]
+                            if await plain_is_blocked(chunk):
+                                return [], []
+                            next_fence = open_fence_after(chunk, plain_fence)
+                            if next_fence is not None:
+                                chunk_text = chunk.removesuffix("\n") + "\n```"
+                            else:
+                                chunk_text = chunk
+                            await plain_send_or_edit(prefix + chunk_text)
+                            plain_sent_chars += len(chunk)
+                            plain_fence = next_fence
+                            plain_live_text = None
+                            last_edit_time = time.monotonic()
+
+                        tail = response_full_text[plain_sent_chars:]
+                        if tail and (ready_to_edit or is_final_edit):
+                            live_text = plain_fence_prefix() + tail
+                            if not is_final_edit:
+                                live_text += STREAMING_INDICATOR
+                            if live_text != plain_live_text:
+                                if await plain_is_blocked(tail):
+                                    return [], []
+                                await plain_send_or_edit(live_text)
+                                last_edit_time = time.monotonic()
+
+                    if delta.finish_reason is not None:
+                        finished = True
+
+        except asyncio.CancelledError as e:
+            # Stop paying for the upstream completion right away, then finalize what the
+            # user already sees below before re-raising
+            cancelled = e
+            cancel_reason = str(e.args[0]) if e.args else CANCEL_REASON_DEFAULT
+            await close_stream(stream)
+            logging.info(
+                "Generation cancelled | model=%s | reason=%s | chars=%d",
+                display_model,
+                cancel_reason,
+                len(response_full_text),
+            )
+            metrics.incr("cancelled_requests", reason=cancel_reason)
+            metrics.incr(
+                "cancelled_completion_tokens",
+                len(response_full_text) / 4.0,
+                model=display_model,
+            )
+        except Exception as e:
+            if not finished:
+                # Handle any streaming errors
+                error_embed = discord.Embed(
+                    description=f"Error during streaming: {e!s}",
+                    color=discord.Color.red(),
+                )
+                try:
+                    if response_msgs:
+                        await response_msgs[-1].edit(embed=error_embed)
+                    else:
+                        await new_msg.reply(embed=error_embed, silent=True)
+                except discord.HTTPException:
+                    # E.g. the reply was deleted mid-stream
                     pass
-            reply_to_msg = new_msg if not response_msgs else response_msgs[-1]
-            response_msg = await reply_to_msg.reply(content=chunk, suppress_embeds=True)
-            response_msgs.append(response_msg)
-            msg_nodes[response_msg.id] = MsgNode(parent_msg=new_msg)
-            await msg_nodes[response_msg.id].lock.acquire()
-            remaining = remaining[len(chunk) :]
+                raise
+            # The reply is complete; only the trailing usage chunk was lost
+            await close_stream(stream)
+            logging.warning(
+                "Stream failed after the finish chunk (%s: %s), estimating usage"
+                " | model=%s",
+                type(e).__name__,
+                e,
+                display_model,
+            )
 
-    # Finalize: compute tok/s and update the first message with final footer
-    try:
-        if response_msgs:
-            end_perf = time.perf_counter()
-            elapsed = (end_perf - (output_start_perf or start_perf)) or 1e-6
+        # Plain mode: make sure the live message ends without the streaming indicator (e.g.
+        # when the provider closed the stream without a finish chunk)
+        if use_plain_responses:
+            tail = response_full_text[plain_sent_chars:]
+            if tail and plain_fence_prefix() + tail != plain_live_text:
+                if await plain_is_blocked(tail):
+                    return [], []
+                await plain_send_or_edit(plain_fence_prefix() + tail)
 
-            approx_tokens = len(response_full_text) / 4.0
-            tps = approx_tokens / elapsed if elapsed > 0 else 0.0
+        # Finalize: compute tok/s and update the first message with final footer
+        try:
+            if response_msgs and not use_plain_responses:
+                end_perf = time.perf_counter()
+                elapsed = (end_perf - (output_start_perf or start_perf)) or 1e-6
 
-            footer_text = f"{display_model} • {tps:.1f} tok/s"
+                approx_tokens = len(response_full_text) / 4.0
+                tps = approx_tokens / elapsed if elapsed > 0 else 0.0
 
-            # Build the final set of message descriptions (split across messages)
-            header = ""
-            if reasoning_started:
-                if output_start_perf is None and reasoning_start_unix is not None:
-                    header = THINKING_SINCE_TEMPLATE.replace(
-                        "{ts}", str(reasoning_start_unix)
+                footer_text = f"{display_model} • {tps:.1f} tok/s"
+                if cancel_reason is not None:
+                    footer_text += FOOTER_CANCELLED_TEMPLATE.format(
+                        reason=cancel_reason
                     )
-                elif output_start_perf is not None and reasoning_start_perf is not None:
-                    elapsed_head = output_start_perf - reasoning_start_perf
-                    mins, secs = divmod(int(elapsed_head), 60)
-                    time_str = f"{mins}m {secs}s"
-                    header = DONE_THINKING_PREFIX.replace("{time}", time_str)
-
-            remaining = response_full_text.lstrip("\n")
-            final_descriptions: list[str] = []
-            newline_len = 1 if header and remaining else 0
-            first_capacity = max(0, max_message_length - len(header) - newline_len)
-            first_chunk = remaining[:first_capacity]
-            desc0 = header + ("\n" if header and first_chunk else "") + first_chunk
-            final_descriptions.append(desc0)
-            remaining = remaining[len(first_chunk) :]
-            while remaining:
-                chunk = remaining[:max_message_length]
-                final_descriptions.append(chunk)
-                remaining = remaining[len(chunk) :]
-
-            # Apply final embeds and footer to all messages
-            for i, desc in enumerate(final_descriptions):
-                color = EMBED_COLOR_COMPLETE
-                embed_i = discord.Embed(description=desc, color=color)
-                # Add '(cont.)' marker on continuation messages for clarity
-                footer_text_i = footer_text + (" • (cont.)" if i > 0 else "")
-                embed_i.set_footer(text=footer_text_i)
-                if i < len(response_msgs):
-                    await response_msgs[i].edit(embed=embed_i)
-                else:
-                    reply_to = new_msg if not response_msgs else response_msgs[-1]
-                    msg = await reply_to.reply(embed=embed_i, silent=True)
-                    response_msgs.append(msg)
-                    msg_nodes[msg.id] = MsgNode(parent_msg=new_msg)
-                    await msg_nodes[msg.id].lock.acquire()
-    except Exception:
-        pass
 
-    # Return a single consolidated content segment
-    response_contents = [response_full_text]
-    return response_msgs, response_contents
+                # Build the final set of message descriptions (split across messages)
+                header = ""
+                if reasoning_started:
+                    if output_start_perf is None and reasoning_start_unix is not None:
+                        header = THINKING_SINCE_TEMPLATE.replace(
+                            "{ts}", str(reasoning_start_unix)
+                        )
+                    elif (
+                        output_start_perf is not None
+                        and reasoning_start_perf is not None
+                    ):
+                        elapsed_head = output_start_perf - reasoning_start_perf
+                        mins, secs = divmod(int(elapsed_head), 60)
+                        time_str = f"{mins}m {secs}s"
+                        header = DONE_THINKING_PREFIX.replace("{time}", time_str)
+
+                remaining = response_full_text.lstrip("\n")
+                final_descriptions: list[str] = []
+                newline_len = 1 if header and remaining else 0
+                first_capacity = max(0, max_message_length - len(header) - newline_len)
+                first_chunk = remaining[:first_capacity]
+                desc0 = header + ("\n" if header and first_chunk else "") + first_chunk
+                final_descriptions.append(desc0)
+                remaining = remaining[len(first_chunk) :]
+                while remaining:
+                    chunk = remaining[:max_message_length]
+                    final_descriptions.append(chunk)
+                    remaining = remaining[len(chunk) :]
+
+                # Apply final embeds and footer to all messages
+                for i, desc in enumerate(final_descriptions):
+                    color = EMBED_COLOR_COMPLETE
+                    embed_i = discord.Embed(description=desc, color=color)
+                    # Add '(cont.)' marker on continuation messages for clarity
+                    footer_text_i = footer_text + (" • (cont.)" if i > 0 else "")
+                    embed_i.set_footer(text=footer_text_i)
+                    if i < len(response_msgs):
+                        await response_msgs[i].edit(embed=embed_i)
+                    else:
+                        reply_to = new_msg if not response_msgs else response_msgs[-1]
+                        msg = await reply_to.reply(embed=embed_i, silent=True)
+                        await track_response_msg(msg)
+        except Exception:
+            pass
+
+        if cancelled is not None:
+            raise cancelled
+
+        # Return a single consolidated content segment
+        response_contents = [response_full_text]
+        return response_msgs, response_contents
+    finally:
+        # Every exit is charged, including cancellations, aborts and errors
+        try:
+            debit_usage()
+        except Exception:
+            logging.exception("Failed to record usage")
+        release_response_nodes()
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any
+
+DRAIN_LOG_INTERVAL_SECONDS = 5.0
+
+
+@dataclass
+class ActiveRequest:
+    # The handler task, or in worker mode a future resolved when the worker finishes
+    task: asyncio.Future[Any]
+    requester_id: int
+    channel_id: int
+    started: float = field(default_factory=time.monotonic)
+    response_msg_ids: set[int] = field(default_factory=set)
+
+
+class RequestRegistry:
+    """In-flight generations keyed by the ID of the message that triggered them."""
+
+    def __init__(self) -> None:
+        self._requests: dict[int, ActiveRequest] = {}
+        self._by_response: dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._requests)
+
+    def __contains__(self, trigger_id: int) -> bool:
+        return trigger_id in self._requests
+
+    def get(self, trigger_id: int) -> ActiveRequest | None:
+        return self._requests.get(trigger_id)
+
+    def items(self) -> list[tuple[int, ActiveRequest]]:
+        return list(self._requests.items())
+
+    def add(self, trigger_id: int, request: ActiveRequest) -> None:
+        self._requests[trigger_id] = request
+
+    def pop(self, trigger_id: int) -> ActiveRequest | None:
+        request = self._requests.pop(trigger_id, None)
+        if request is not None:
+            for msg_id in request.response_msg_ids:
+                self._by_response.pop(msg_id, None)
+        return request
+
+    def add_response(self, trigger_id: int, response_msg_id: int) -> None:
+        if (request := self._requests.get(trigger_id)) is not None:
+            request.response_msg_ids.add(response_msg_id)
+            self._by_response[response_msg_id] = trigger_id
+
+    def find(self, msg_id: int) -> tuple[int, ActiveRequest] | None:
+        """Look up a request by its triggering message or one of its response messages."""
+        trigger_id = self._by_response.get(msg_id, msg_id)
+        request = self._requests.get(trigger_id)
+        return (trigger_id, request) if request is not None else None
+
+    def cancel(self, trigger_id: int, reason: str) -> bool:
+        request = self._requests.get(trigger_id)
+        if request is None or request.task.done():
+            return False
+        # The reason reaches stream_and_reply as CancelledError.args[0]
+        request.task.cancel(reason)
+        return True
+
+    def cancel_all(self, reason: str) -> int:
+        return sum(
+            self.cancel(trigger_id, reason) for trigger_id in list(self._requests)
+        )
+
+    async def drain(
+        self, timeout: float, reason: str, *, finalize_timeout: float = 10.0
+    ) -> int:
+        """Wait up to `timeout` seconds for in-flight requests, then cancel the rest.
+
+        Cancelled requests get up to `finalize_timeout` more seconds to finalize their
+        replies with `reason`. Returns how many were cancelled.
+        """
+        deadline = time.monotonic() + timeout
+        while pending := [r.task for r in self._requests.values() if not r.task.done()]:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            logging.info(
+                "Draining: %d request%s in flight, %.0fs left",
+                len(pending),
+                "" if len(pending) == 1 else "s",
+                remaining,
+            )
+            await asyncio.wait(
+                pending, timeout=min(DRAIN_LOG_INTERVAL_SECONDS, remaining)
+            )
+
+        pending = [r.task for r in self._requests.values() if not r.task.done()]
+        if not pending:
+            return 0
+        logging.warning("Drain deadline passed, cancelling %d request(s)", len(pending))
+        cancelled = self.cancel_all(reason)
+        await asyncio.wait(pending, timeout=finalize_timeout)
+        return cancelled
+
+
+__all__ = ["ActiveRequest", "RequestRegistry"]
@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import heapq
+import itertools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager, nullcontext
+from typing import Any
+
+
+class Span:
+    __slots__ = ("attrs", "depth", "end_ns", "name", "start_ns")
+
+    def __init__(
+        self, name: str, start_ns: int, depth: int, attrs: dict[str, Any]
+    ) -> None:
+        self.name = name
+        self.start_ns = start_ns
+        self.end_ns: int | None = None
+        self.depth = depth
+        self.attrs = attrs
+
+    @property
+    def duration(self) -> float:
+        return ((self.end_ns or time.perf_counter_ns()) - self.start_ns) / 1e9
+
+
+class Trace:
+    """Request-scoped collection of nested spans with monotonic timings."""
+
+    enabled: bool = True
+
+    def __init__(self, name: str, trace_id: int, **attrs: Any) -> None:
+        self.trace_id = trace_id
+        # Anchor monotonic timestamps to wall-clock time once, for exporting
+        self.wall_start_us = time.time_ns() // 1000
+        self.spans: list[Span] = []
+        self._stack: list[Span] = []
+        self.root = self._open(name, attrs)
+
+    def _open(self, name: str, attrs: dict[str, Any]) -> Span:
+        span = Span(name, time.perf_counter_ns(), len(self._stack), attrs)
+        self.spans.append(span)
+        self._stack.append(span)
+        return span
+
+    @contextmanager
+    def span(self, name: str, **attrs: Any) -> Iterator[Span]:
+        span = self._open(name, attrs)
+        try:
+            yield span
+        except BaseException as e:
+            span.attrs["error"] = type(e).__name__
+            raise
+        finally:
+            span.end_ns = time.perf_counter_ns()
+            if span in self._stack:
+                self._stack.remove(span)
+
+    def set(self, **attrs: Any) -> None:
+        """Set attributes on the innermost open span."""
+        (self._stack[-1] if self._stack else self.root).attrs.update(attrs)
+
+    def finish(self) -> None:
+        if self.root.end_ns is None:
+            self.root.end_ns = time.perf_counter_ns()
+        self._stack.clear()
+
+    @property
+    def duration(self) -> float:
+        return self.root.duration
+
+    def to_events(self) -> list[dict[str, Any]]:
+        """Export spans as Chrome trace "complete" events (one per span)."""
+        origin_ns = self.root.start_ns
+        return [
+            {
+                "name": span.name,
+                "ph": "X",
+                "ts": self.wall_start_us + (span.start_ns - origin_ns) // 1000,
+                "dur": ((span.end_ns or span.start_ns) - span.start_ns) // 1000,
+                "pid": os.getpid(),
+                "tid": self.trace_id,
+                "args": span.attrs,
+            }
+            for span in self.spans
+        ]
+
+    def summary(self, max_spans: int = 12) -> str:
+        attrs = " ".join(f"{k}={v}" for k, v in self.root.attrs.items())
+        lines = [
+            f"{self.root.name} {self.trace_id} • {self.duration * 1000:.0f} ms {attrs}"
+        ]
+        for span in self.spans[1 : max_spans + 1]:
+            lines.append(
+                f"{'  ' * span.depth}{span.name}: {span.duration * 1000:.1f} ms"
+            )
+        return "\n".join(lines)
+
+
+class _NoopTrace:
+    """Stand-in used when a request is not sampled; every operation is a no-op."""
+
+    enabled: bool = False
+    _null_span = nullcontext()
+
+    def span(self, name: str, **attrs: Any) -> Any:
+        return self._null_span
+
+    def set(self, **attrs: Any) -> None:
+        pass
+
+    def finish(self) -> None:
+        pass
+
+
+NOOP_TRACE: Any = _NoopTrace()
+
+
+class Tracer:
+    """Samples request traces, keeps the slowest recent ones and exports spans to disk."""
+
+    def __init__(self) -> None:
+        self.sample_rate: float = 0.0
+        self.file: str | None = None
+        self.keep_slowest: int = 20
+        self._slowest: list[tuple[float, int, Trace]] = []
+        self._seq = itertools.count()
+        self._queue: queue.SimpleQueue[tuple[str, list[dict[str, Any]]]] = (
+            queue.SimpleQueue()
+        )
+        self._writer: threading.Thread | None = None
+
+    def configure(self, config: dict[str, Any]) -> None:
+        trace_cfg = config.get("tracing") or {}
+        self.sample_rate = trace_cfg.get("sample_rate", 0.0) or 0.0
+        self.file = trace_cfg.get("file", "traces.jsonl")
+        self.keep_slowest = trace_cfg.get("keep_slowest", 20)
+
+    def start(self, name: str, trace_id: int, **attrs: Any) -> Any:
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return NOOP_TRACE
+        return Trace(name, trace_id, **attrs)
+
+    def finish(self, trace: Any) -> None:
+        if not trace.enabled:
+            return
+        trace.finish()
+
+        entry = (trace.duration, next(self._seq), trace)
+        if len(self._slowest) < self.keep_slowest:
+            heapq.heappush(self._slowest, entry)
+        else:
+            heapq.heappushpop(self._slowest, entry)
+
+        if self.file:
+            if self._writer is None:
+                self._writer = threading.Thread(
+                    target=self._write_loop, name="llmcord-trace-writer", daemon=True
+                )
+                self._writer.start()
+            self._queue.put((self.file, trace.to_events()))
+
+    def slowest(self, limit: int = 5) -> list[Trace]:
+        return [trace for _, _, trace in heapq.nlargest(limit, self._slowest)]
+
+    def _write_loop(self) -> None:
+        while True:
+            path, events = self._queue.get()
+            try:
+                with open(path, "a", encoding="utf-8") as file:
+                    file.writelines(
+                        json.dumps(event, default=str) + "\n" for event in events
+                    )
+            except OSError:
+                logging.exception("Failed to write trace spans to %s", path)
+
+
+tracer = Tracer()
+
+
+__all__ = ["NOOP_TRACE", "Span", "Trace", "Tracer", "tracer"]
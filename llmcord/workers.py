@@ -0,0 +1,376 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from collections.abc import Callable
+from functools import partial
+from typing import Any
+
+import discord
+import httpx
+
+from .config import get_config
+from .constants import CANCEL_REASON_DEFAULT
+from .health import loop_monitor
+from .log import bind_request, setup_logging
+from .messages import MsgNode, invalidate_msg_node
+from .metrics import metrics
+from .pipeline import generate_reply
+from .providers import close_openai_clients
+from .tracing import tracer
+
+HEARTBEAT_INTERVAL_SECONDS = 2.0
+
+
+class _Worker:
+    """Gateway-side handle for one worker process."""
+
+    def __init__(self, index: int, ctx: Any, max_jobs: int, event_queue: Any) -> None:
+        self.index = index
+        self.jobs: Any = ctx.Queue(maxsize=max_jobs)
+        self.control: Any = ctx.Queue()
+        self.process: Any = ctx.Process(
+            target=worker_main,
+            args=(index, self.jobs, self.control, event_queue),
+            name=f"llmcord-worker-{index}",
+            daemon=True,
+        )
+        self.inflight: set[int] = set()
+        self.last_heartbeat = time.monotonic()
+
+    @property
+    def healthy(self) -> bool:
+        return self.process.is_alive()
+
+
+class WorkerPool:
+    """Dispatches generation jobs from the gateway process to N local worker processes.
+
+    Workers log in to Discord over REST only, pull jobs from a bounded
+    multiprocessing queue each, build context, stream from the provider and post/edit
+    replies themselves. Jobs stick to a worker per channel so its message node cache
+    stays warm; when a worker's queue and in-flight budget are full the job goes to
+    the least loaded healthy worker, and if all are full `dispatch` refuses it.
+    """
+
+    def __init__(
+        self, num_workers: int, *, max_jobs: int, heartbeat_timeout: float
+    ) -> None:
+        self._ctx = multiprocessing.get_context("spawn")
+        self._events: Any = self._ctx.Queue()
+        self.max_jobs = max_jobs
+        self.heartbeat_timeout = heartbeat_timeout
+        self.workers = [
+            _Worker(i, self._ctx, max_jobs, self._events) for i in range(num_workers)
+        ]
+        self._futures: dict[int, asyncio.Future[None]] = {}
+        self._assigned: dict[int, _Worker] = {}
+        self._on_response: Callable[[int, int], None] | None = None
+        self._on_usage: Callable[..., None] | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._monitor: asyncio.Task | None = None
+
+    def start(
+        self,
+        *,
+        on_response: Callable[[int, int], None],
+        on_usage: Callable[..., None] | None = None,
+    ) -> None:
+        """`on_usage` gets each finished job's token usage as keyword arguments."""
+        self._loop = asyncio.get_running_loop()
+        self._on_response = on_response
+        self._on_usage = on_usage
+        for worker in self.workers:
+            worker.process.start()
+        threading.Thread(
+            target=self._read_events, name="llmcord-worker-events", daemon=True
+        ).start()
+        self._monitor = asyncio.create_task(self._monitor_health())
+        logging.info("Started %d worker processes", len(self.workers))
+
+    def dispatch(self, job: dict[str, Any]) -> asyncio.Future[None] | None:
+        """Queue a job without blocking; returns a future resolved when it finishes.
+
+        Cancelling the future cancels the job in its worker. Returns None when every
+        worker is at capacity (back-pressure).
+        """
+        preferred = self.workers[job["channel_id"] % len(self.workers)]
+        candidates = [preferred] + sorted(
+            (w for w in self.workers if w is not preferred),
+            key=lambda w: len(w.inflight),
+        )
+        for worker in candidates:
+            if not worker.healthy or len(worker.inflight) >= self.max_jobs:
+                continue
+            try:
+                worker.jobs.put_nowait(job)
+            except queue.Full:
+                continue
+
+            trigger_id = job["trigger_id"]
+            assert self._loop is not None
+            future: asyncio.Future[None] = self._loop.create_future()
+            future.add_done_callback(partial(self._on_future_done, trigger_id))
+            worker.inflight.add(trigger_id)
+            self._futures[trigger_id] = future
+            self._assigned[trigger_id] = worker
+            metrics.incr("worker_jobs_dispatched", worker=worker.index)
+            return future
+
+        metrics.incr("worker_jobs_rejected")
+        return None
+
+    def broadcast(self, message: tuple[Any, ...]) -> None:
+        for worker in self.workers:
+            if worker.healthy:
+                worker.control.put(message)
+
+    def _on_future_done(self, trigger_id: int, future: asyncio.Future[None]) -> None:
+        if future.cancelled() and (worker := self._assigned.get(trigger_id)):
+            # Registry cancellation (delete, stop reaction, /stop) reaches the worker here
+            try:
+                future.result()
+            except asyncio.CancelledError as e:
+                reason = str(e.args[0]) if e.args else CANCEL_REASON_DEFAULT
+                worker.control.put(("cancel", trigger_id, reason))
+        self._release(trigger_id)
+
+    def _release(self, trigger_id: int) -> None:
+        self._futures.pop(trigger_id, None)
+        if (worker := self._assigned.pop(trigger_id, None)) is not None:
+            worker.inflight.discard(trigger_id)
+
+    def _read_events(self) -> None:
+        while True:
+            try:
+                event = self._events.get()
+            except (EOFError, OSError):
+                return
+            if event is None:
+                return
+            assert self._loop is not None
+            self._loop.call_soon_threadsafe(self._handle_event, event)
+
+    def _handle_event(self, event: tuple[Any, ...]) -> None:
+        kind, index = event[0], event[1]
+        worker = self.workers[index]
+        if kind == "heartbeat":
+            worker.last_heartbeat = time.monotonic()
+        elif kind == "response" and self._on_response is not None:
+            self._on_response(event[2], event[3])
+        elif kind == "usage" and self._on_usage is not None:
+            self._on_usage(**event[2])
+        elif kind == "done":
+            future = self._futures.get(event[2])
+            if future is not None and not future.done():
+                future.set_result(None)
+            self._release(event[2])
+
+    async def _monitor_health(self) -> None:
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL_SECONDS)
+            for i, worker in enumerate(self.workers):
+                stale = (
+                    time.monotonic() - worker.last_heartbeat > self.heartbeat_timeout
+                )
+                if worker.healthy and not stale:
+                    continue
+
+                logging.warning(
+                    "Worker %d is %s; restarting it (%d in-flight jobs lost)",
+                    worker.index,
+                    "unresponsive" if worker.healthy else "dead",
+                    len(worker.inflight),
+                )
+                metrics.incr("worker_restarts", worker=worker.index)
+                if worker.healthy:
+                    worker.process.terminate()
+                for trigger_id in list(worker.inflight):
+                    if (future := self._futures.get(trigger_id)) and not future.done():
+                        future.set_result(None)
+                    self._release(trigger_id)
+
+                replacement = _Worker(
+                    worker.index, self._ctx, self.max_jobs, self._events
+                )
+                self.workers[i] = replacement
+                replacement.process.start()
+
+    def stats(self) -> list[dict[str, Any]]:
+        return [
+            dict(
+                worker=w.index,
+                alive=w.healthy,
+                inflight=len(w.inflight),
+                heartbeat_age=round(time.monotonic() - w.last_heartbeat, 1),
+            )
+            for w in self.workers
+        ]
+
+    async def stop(self, timeout: float = 5.0) -> None:
+        if self._monitor is not None:
+            self._monitor.cancel()
+        for worker in self.workers:
+            if worker.healthy:
+                worker.control.put(("stop",))
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            await asyncio.to_thread(
+                worker.process.join, max(0.0, deadline - time.monotonic())
+            )
+            if worker.healthy:
+                worker.process.terminate()
+        self._events.put(None)
+
+
+def worker_main(index: int, jobs: Any, control: Any, events: Any) -> None:
+    """Entry point of a worker process (spawned by WorkerPool)."""
+    config = get_config()
+    setup_logging(config)
+    try:
+        asyncio.run(_worker_loop(index, config, jobs, control, events))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _worker_loop(
+    index: int, config: dict[str, Any], jobs: Any, control: Any, events: Any
+) -> None:
+    # REST-only client: no gateway connection, so this is not a shard
+    client = discord.Client(intents=discord.Intents.none())
+    await client.login(config["bot_token"])
+    assert client.user is not None
+
+    httpx_client = httpx.AsyncClient()
+    msg_nodes: dict[int, MsgNode] = {}
+    tasks: dict[int, asyncio.Task] = {}
+    stopping = asyncio.Event()
+
+    async def heartbeat() -> None:
+        while not stopping.is_set():
+            events.put(("heartbeat", index))
+            await asyncio.sleep(HEARTBEAT_INTERVAL_SECONDS)
+
+    async def run_job(job: dict[str, Any]) -> None:
+        trigger_id = job["trigger_id"]
+        bind_request(
+            request_id=str(trigger_id),
+            guild_id=job.get("guild_id"),
+            channel_id=job["channel_id"],
+            user_id=job.get("requester_id"),
+            worker=index,
+        )
+        cfg = await asyncio.to_thread(get_config)
+        tracer.configure(cfg)
+        trace = tracer.start("worker_job", trigger_id, worker=index)
+        try:
+            with trace.span("fetch_trigger"):
+                channel = client.get_channel(
+                    job["channel_id"]
+                ) or await client.fetch_channel(job["channel_id"])
+                new_msg = await channel.fetch_message(trigger_id)  # type: ignore[union-attr]
+            await generate_reply(
+                new_msg=new_msg,
+                cfg=cfg,
+                provider_slash_model=job["model"],
+                bot_user=client.user,  # type: ignore[arg-type]
+                msg_nodes=msg_nodes,
+                httpx_client=httpx_client,
+                users_listing=job.get("users_listing"),
+                timings=job.get("timings"),
+                trace=trace,
+                on_response_msg=lambda msg: events.put(
+                    ("response", index, trigger_id, msg.id)
+                ),
+                on_usage=lambda prompt, completion, cached: events.put(
+                    (
+                        "usage",
+                        index,
+                        dict(
+                            user_id=job["requester_id"],
+                            guild_id=job.get("guild_id"),
+                            model=job["model"],
+                            prompt_tokens=prompt,
+                            completion_tokens=completion,
+                            cached_tokens=cached,
+                        ),
+                    )
+                ),
+            )
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logging.exception("Worker %d failed job for message %s", index, trigger_id)
+        finally:
+            tracer.finish(trace)
+            tasks.pop(trigger_id, None)
+            events.put(("done", index, trigger_id))
+
+    async def pull_jobs() -> None:
+        while not stopping.is_set():
+            try:
+                job = await asyncio.to_thread(jobs.get, True, 1.0)
+            except queue.Empty:
+                continue
+            tasks[job["trigger_id"]] = asyncio.create_task(run_job(job))
+
+    async def invalidate(msg_id: int, channel_id: int, deleted: bool) -> None:
+        updated = None
+        # Uncached messages may still be rendered in snapshots, which only need to
+        # be invalidated, not re-resolved
+        if not deleted and msg_id in msg_nodes:
+            try:
+                channel = client.get_channel(channel_id) or await client.fetch_channel(
+                    channel_id
+                )
+                updated = await channel.fetch_message(msg_id)  # type: ignore[union-attr]
+            except discord.HTTPException:
+                deleted = True
+        await invalidate_msg_node(msg_nodes, msg_id, message=updated, deleted=deleted)
+
+    # In-flight invalidations (held so they aren't garbage collected)
+    invalidations: set[asyncio.Task] = set()
+
+    async def pull_control() -> None:
+        while not stopping.is_set():
+            try:
+                message = await asyncio.to_thread(control.get, True, 1.0)
+            except queue.Empty:
+                continue
+            kind = message[0]
+            if kind == "stop":
+                stopping.set()
+            elif kind == "cancel" and (task := tasks.get(message[1])) is not None:
+                task.cancel(message[2])
+            elif kind == "invalidate":
+                # Waits for the node's lock (e.g. a reply being streamed) and may
+                # fetch over REST; cancels must not queue behind it
+                invalidation = asyncio.create_task(invalidate(*message[1:4]))
+                invalidations.add(invalidation)
+                invalidation.add_done_callback(invalidations.discard)
+
+    # Stalls in workers are logged with their stack like in the main process
+    loop_monitor.configure(config)
+    loop_monitor.start()
+    logging.info("Worker %d ready", index)
+    background = [
+        asyncio.create_task(coro) for coro in (heartbeat(), pull_jobs(), pull_control())
+    ]
+    await stopping.wait()
+
+    # Let in-flight jobs finish before exiting
+    if tasks:
+        await asyncio.wait(list(tasks.values()), timeout=30)
+    for task in background:
+        task.cancel()
+    await loop_monitor.stop()
+    await httpx_client.aclose()
+    await close_openai_clients()
+    await client.close()
+
+
+__all__ = ["WorkerPool", "worker_main"]
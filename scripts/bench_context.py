@@ -0,0 +1,142 @@
+"""Per-turn cost of building conversation context on long reply chains.
+
+Grows a reply chain turn by turn with max_messages set to the chain depth, and times
+build_conversation_context for each new turn: once continuing from the cached context
+snapshots, and once with the snapshots dropped before every turn (re-rendering the
+whole window from the cached nodes, as every turn did before snapshots). Messages are
+built in memory and attachments served by a stub client, so nothing is contacted.
+
+    uv run python scripts/bench_context.py [--depths 25 100 500] [--turns 200]
+        [--image-every 0]
+
+With snapshots the per-turn cost should stay flat as the chain gets deeper. Images
+(--image-every N attaches one to every Nth message) still cost a little per image in
+the window each turn, as their data URLs are rendered into every request.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+from typing import Any
+
+import discord
+
+from llmcord.messages import MsgNode, build_conversation_context, image_store
+
+BOT = SimpleNamespace(id=1, mention="<@1>")
+USER = SimpleNamespace(id=2, display_name="user", name="user")
+
+
+class Channel(discord.TextChannel):
+    """A text channel with no history before the chain starts."""
+
+    id = 100
+    type = discord.ChannelType.text
+
+    def __init__(self) -> None:
+        pass
+
+    def history(self, *, before: Any, limit: int) -> Any:
+        async def empty() -> Any:
+            return
+            yield
+
+        return empty()
+
+
+class AttachmentClient:
+    """Serves every attachment URL as its own small image."""
+
+    async def get(self, url: str) -> Any:
+        return SimpleNamespace(content=url.encode() * 64, text=url)
+
+
+def message(msg_id: int, parent: Any, channel: Channel, image_every: int) -> Any:
+    attachments = (
+        [SimpleNamespace(content_type="image/png", url=f"image-{msg_id}")]
+        if image_every and msg_id % image_every == 0
+        else []
+    )
+    return SimpleNamespace(
+        id=msg_id,
+        content=f"message {msg_id}: " + "lorem ipsum " * 20,
+        attachments=attachments,
+        embeds=[],
+        author=USER if msg_id % 2 else BOT,
+        reference=(
+            SimpleNamespace(message_id=parent.id, cached_message=parent)
+            if parent is not None
+            else None
+        ),
+        channel=channel,
+    )
+
+
+async def run(
+    depth: int, turns: int, image_every: int, snapshots: bool
+) -> tuple[float, int]:
+    """Median seconds per turn over `turns` turns past `depth`, and messages sent."""
+    channel = Channel()
+    client = AttachmentClient()
+    msg_nodes: dict[int, MsgNode] = {}
+    image_store.clear()
+    parent = None
+    times: list[float] = []
+    num_messages = 0
+    for msg_id in range(1, depth + turns + 1):
+        parent = message(msg_id, parent, channel, image_every)
+        if not snapshots:
+            for node in msg_nodes.values():
+                node.snapshot = None
+        start = time.perf_counter()
+        messages, _ = await build_conversation_context(
+            new_msg=parent,
+            bot_user=BOT,
+            accept_images=True,
+            accept_usernames=True,
+            experimental_message_formatting=False,
+            max_text=100_000,
+            max_images=5,
+            max_messages=depth,
+            msg_nodes=msg_nodes,
+            httpx_client=client,
+        )
+        if msg_id > depth:
+            times.append(time.perf_counter() - start)
+        num_messages = len(messages)
+    return statistics.median(times), num_messages
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--depths", type=int, nargs="+", default=[25, 100, 500], help="chain depths"
+    )
+    parser.add_argument("--turns", type=int, default=200, help="turns timed per depth")
+    parser.add_argument(
+        "--image-every", type=int, default=0, help="attach an image every N messages"
+    )
+    args = parser.parse_args()
+
+    for depth in args.depths:
+        cached_s, num_messages = asyncio.run(
+            run(depth, args.turns, args.image_every, snapshots=True)
+        )
+        uncached_s, _ = asyncio.run(
+            run(depth, args.turns, args.image_every, snapshots=False)
+        )
+        print(
+            f"depth {depth:>4} ({num_messages} messages sent): "
+            f"{cached_s * 1e6:8.1f} us per turn with snapshots, "
+            f"{uncached_s * 1e6:8.1f} us without ({uncached_s / cached_s:.1f}x)"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""Build throughput and query latency of the memory index (llmcord.memory) at scale.
+
+Appends random unit vectors in batches to a fresh GuildIndex (1M rows by default,
+spread over 50 channels), then times top-k searches over the whole guild, filtered to
+one channel, and for a batch of queries at once. The index is written to a temporary
+directory (or --dir) and removed afterwards.
+
+    uv run --extra memory python scripts/bench_memory.py [--rows 1000000] [--dim 384]
+        [--dtype float32] [--k 30] [--queries 20]
+"""
+
+from __future__ import annotations
+
+import argparse
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from llmcord.memory import GuildIndex
+from llmcord.metrics import percentile
+
+CHANNELS = 50
+APPEND_BATCH = 1024
+TEXT = "a chat message of fairly typical length, a sentence or two long"
+
+
+def unit_vectors(rng: np.random.Generator, count: int, dim: int) -> Any:
+    vectors = rng.standard_normal((count, dim), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def benchmark(path: Path, args: argparse.Namespace) -> None:
+    rng = np.random.default_rng(0)
+    index = GuildIndex(path, model="bench", dtype=args.dtype)
+
+    start = time.perf_counter()
+    for first in range(0, args.rows, APPEND_BATCH):
+        count = min(APPEND_BATCH, args.rows - first)
+        index.append(
+            unit_vectors(rng, count, args.dim),
+            [
+                (msg_id, msg_id % CHANNELS, 7, TEXT)
+                for msg_id in range(first, first + count)
+            ],
+        )
+    build_s = time.perf_counter() - start
+    size = sum(file.stat().st_size for file in path.iterdir())
+    print(
+        f"{args.rows:,} rows, {args.dim} dims {args.dtype}: built at "
+        f"{args.rows / build_s:,.0f} rows/s ({build_s:.1f} s), "
+        f"{size / 2**20:,.0f} MiB on disk"
+    )
+
+    # Map the files and warm the page cache
+    index.search(unit_vectors(rng, 1, args.dim), args.k)
+    for label, num_queries, channel_id in (
+        ("guild", 1, None),
+        ("one channel", 1, 3),
+        ("guild, 16 queries", 16, None),
+    ):
+        latencies = []
+        for _ in range(args.queries):
+            queries = unit_vectors(rng, num_queries, args.dim)
+            start = time.perf_counter()
+            index.search(queries, args.k, channel_id=channel_id)
+            latencies.append(time.perf_counter() - start)
+        print(
+            f"  top-{args.k} search, {label}: "
+            f"p50 {percentile(latencies, 50) * 1000:.0f} ms, "
+            f"p95 {percentile(latencies, 95) * 1000:.0f} ms"
+        )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000, help="indexed messages")
+    parser.add_argument("--dim", type=int, default=384, help="embedding dimensions")
+    parser.add_argument(
+        "--dtype", default="float32", help="stored vector type (memory.dtype)"
+    )
+    parser.add_argument("--k", type=int, default=30, help="matches per query")
+    parser.add_argument("--queries", type=int, default=20, help="searches timed each")
+    parser.add_argument("--dir", type=Path, help="where to build the index")
+    args = parser.parse_args()
+
+    root = Path(tempfile.mkdtemp(dir=args.dir))
+    try:
+        benchmark(root / "guild", args)
+    finally:
+        shutil.rmtree(root)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,206 @@
+"""Memory retained per message node on deep reply chains with images.
+
+Seeds a reply chain on the fake Discord server (llmcord.fakes), every message with its
+own image and one image shared by all of them, and builds the conversation context for
+a reply at its end. Reports the memory msg_nodes keeps afterwards, per node:
+
+- before: the previous node layout, rebuilt here for comparison. Each node kept its
+  images as base64 data URLs of its own and its parent as a discord.Message.
+- after: llmcord.messages.MsgNode, with slots, parents by ID and images stored once in
+  the shared image store, under the image_cache_mb budget (and unbounded).
+
+    uv run python scripts/bench_nodes.py [--depth 200] [--image-kb 64] [--budget-mb 4]
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import gc
+import os
+import random
+import sys
+import tracemalloc
+from base64 import b64encode
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+from typing import Any
+
+import discord
+import httpx
+
+from llmcord import messages
+from llmcord.fakes import FakeDiscord
+from llmcord.loadtest import _World
+
+
+@dataclass
+class LegacyNode:
+    """The node layout before slots, parent IDs and the shared image store."""
+
+    text: str | None = None
+    images: list[dict[str, Any]] = field(default_factory=list)
+    role: str = "assistant"
+    user_id: int | None = None
+    has_bad_attachments: bool = False
+    fetch_parent_failed: bool = False
+    parent_msg: discord.Message | None = None
+    latest_msg: discord.Message | None = None
+    deleted: bool = False
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+
+async def build_legacy(
+    new_msg: discord.Message,
+    bot_user: Any,
+    max_messages: int,
+    http: httpx.AsyncClient,
+) -> dict[int, LegacyNode]:
+    """Resolve the chain into legacy nodes, as the previous walk did."""
+    msg_nodes: dict[int, LegacyNode] = {}
+    curr_msg: discord.Message | None = new_msg
+    while curr_msg is not None and len(msg_nodes) < max_messages:
+        node = msg_nodes[curr_msg.id] = LegacyNode()
+        images = [att for att in curr_msg.attachments if att.content_type]
+        responses = await asyncio.gather(*[http.get(att.url) for att in images])
+        node.text = curr_msg.content
+        node.images = [
+            dict(
+                type="image_url",
+                image_url=dict(
+                    url=f"data:{att.content_type};base64,"
+                    f"{b64encode(resp.content).decode('utf-8')}"
+                ),
+            )
+            for att, resp in zip(images, responses)
+        ]
+        node.role = "assistant" if curr_msg.author == bot_user else "user"
+        node.user_id = curr_msg.author.id if node.role == "user" else None
+        if curr_msg.reference is not None and curr_msg.reference.message_id:
+            node.parent_msg = curr_msg.reference.cached_message or (
+                await curr_msg.channel.fetch_message(curr_msg.reference.message_id)
+            )
+        curr_msg = node.parent_msg
+    return msg_nodes
+
+
+async def retained(build: Callable[[], Awaitable[dict[int, Any]]]) -> tuple[int, int]:
+    """Bytes kept alive by the nodes `build` returns (with their images), and nodes."""
+    gc.collect()
+    tracemalloc.start()
+    msg_nodes = await build()
+    num_nodes = len(msg_nodes)
+    gc.collect()
+    with_nodes = tracemalloc.get_traced_memory()[0]
+    msg_nodes.clear()
+    messages.image_store.clear()
+    gc.collect()
+    without = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return with_nodes - without, num_nodes
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--depth", type=int, default=200, help="messages in the chain")
+    parser.add_argument("--image-kb", type=int, default=64, help="size of each image")
+    parser.add_argument(
+        "--budget-mb", type=float, default=4, help="image_cache_mb for the budgeted run"
+    )
+    args = parser.parse_args()
+
+    fake = FakeDiscord(global_limit=100_000, route_limits={})
+    await fake.start()
+    discord.http.Route.BASE = f"{fake.url}/api/v10"
+    client = discord.Client(intents=discord.Intents.all())
+    await client.login("token")
+    http = httpx.AsyncClient()
+    try:
+        world = _World(
+            fake,
+            client._connection,
+            random.Random(0),
+            guilds=1,
+            channels_per_guild=1,
+            guild_sizes=[5],
+        )
+        channel, users = world.channels[0]
+        image_size = args.image_kb * 1024
+        shared_url = fake.add_attachment("shared.png", os.urandom(image_size))
+        parent_id = None
+        for i in range(args.depth):
+            attachments = [
+                dict(
+                    id=str(fake.snowflake()),
+                    filename=filename,
+                    size=image_size,
+                    url=url,
+                    proxy_url=url,
+                    content_type="image/png",
+                )
+                for filename, url in (
+                    (
+                        f"image{i}.png",
+                        fake.add_attachment(f"image{i}.png", os.urandom(image_size)),
+                    ),
+                    ("shared.png", shared_url),
+                )
+            ]
+            data = fake.seed_message(
+                channel.id,
+                author=fake.bot_user if i % 2 else users[0],
+                content=f"message {i} " + "lorem ipsum " * 20,
+                guild_id=channel.guild.id,
+                reference_id=parent_id,
+                attachments=attachments,
+                mentions=[fake.bot_user],
+            )
+            parent_id = int(data["id"])
+        data = fake.seed_message(
+            channel.id,
+            author=users[0],
+            content=f"<@{fake.bot_user['id']}> hi",
+            guild_id=channel.guild.id,
+            reference_id=parent_id,
+            mentions=[fake.bot_user],
+        )
+        new_msg = client._connection.create_message(channel=channel, data=data)
+        max_messages = args.depth + 1
+
+        async def build_current(budget_mb: float) -> dict[int, Any]:
+            messages.image_store.configure(dict(image_cache_mb=budget_mb))
+            msg_nodes: dict[int, messages.MsgNode] = {}
+            await messages.build_conversation_context(
+                new_msg=new_msg,
+                bot_user=client.user,
+                accept_images=True,
+                accept_usernames=False,
+                experimental_message_formatting=False,
+                max_text=100_000,
+                max_images=5,
+                max_messages=max_messages,
+                msg_nodes=msg_nodes,
+                httpx_client=http,
+            )
+            return msg_nodes
+
+        runs = [
+            ("before", lambda: build_legacy(new_msg, client.user, max_messages, http)),
+            ("after, unbounded", lambda: build_current(1024**2)),
+            (f"after, {args.budget_mb:g} MB", lambda: build_current(args.budget_mb)),
+        ]
+        for label, build in runs:
+            size, num_nodes = await retained(build)
+            print(
+                f"{label:>18}: {num_nodes} nodes, {size / 2**20:7.2f} MiB retained, "
+                f"{size / num_nodes / 1024:6.1f} KiB per node"
+            )
+    finally:
+        await http.aclose()
+        await client.close()
+        await fake.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,145 @@
+"""CPU per token of the fast-path SSE decoder (llmcord.sse) against the OpenAI SDK.
+
+Streams the same completion (one token per event, then finish_reason and usage
+chunks) from an in-process transport, delivered in 4 KiB reads like a socket, and
+measures process CPU time to consume it through the SDK (chat.completions.create +
+sse.sdk_deltas) and through sse.open_fast_stream.
+
+    uv run python scripts/bench_sse.py [--tokens 20000] [--runs 3]
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from collections.abc import AsyncIterator
+from typing import Any
+
+import httpx
+from openai import AsyncOpenAI
+
+from llmcord.sse import open_fast_stream, sdk_deltas
+
+READ_SIZE = 4096
+
+
+def event(**fields: Any) -> bytes:
+    chunk = dict(
+        id="chatcmpl-bench",
+        object="chat.completion.chunk",
+        created=1700000000,
+        model="bench",
+        system_fingerprint="fp_bench",
+    )
+    return b"data: " + json.dumps(chunk | fields).encode() + b"\n\n"
+
+
+def stream_body(tokens: int) -> bytes:
+    return b"".join(
+        [
+            *(
+                event(
+                    choices=[
+                        dict(
+                            index=0,
+                            delta=dict(content=f" token{i}"),
+                            logprobs=None,
+                            finish_reason=None,
+                        )
+                    ]
+                )
+                for i in range(tokens)
+            ),
+            event(
+                choices=[dict(index=0, delta={}, logprobs=None, finish_reason="stop")]
+            ),
+            event(
+                choices=[],
+                usage=dict(
+                    prompt_tokens=10,
+                    completion_tokens=tokens,
+                    total_tokens=tokens + 10,
+                    prompt_tokens_details=dict(cached_tokens=0),
+                ),
+            ),
+            b"data: [DONE]\n\n",
+        ]
+    )
+
+
+async def run(body: bytes, tokens: int, fast: bool) -> float:
+    """Process CPU seconds to open and consume one stream."""
+
+    async def reads() -> AsyncIterator[bytes]:
+        for start in range(0, len(body), READ_SIZE):
+            yield body[start : start + READ_SIZE]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(
+            200, headers={"content-type": "text/event-stream"}, content=reads()
+        )
+
+    http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    openai_client = AsyncOpenAI(
+        base_url="http://bench/v1", api_key="bench", http_client=http_client
+    )
+    messages = [dict(role="user", content="hi")]
+    start = time.process_time()
+    stream = (
+        await open_fast_stream(
+            openai_client,
+            http_client,
+            model="bench",
+            messages=messages,
+            extra_headers=None,
+            extra_query=None,
+            extra_body=None,
+        )
+        if fast
+        else None
+    )
+    if stream is None:
+        stream = sdk_deltas(
+            await openai_client.chat.completions.create(
+                model="bench", messages=messages, stream=True
+            )
+        )
+    num_deltas, usage = 0, None
+    async for delta in stream:
+        num_deltas += 1
+        usage = delta.usage or usage
+    cpu_s = time.process_time() - start
+    await http_client.aclose()
+    assert num_deltas == tokens + 2 and usage == (10, tokens, 0), (num_deltas, usage)
+    return cpu_s
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tokens", type=int, default=20_000, help="tokens per stream")
+    parser.add_argument("--runs", type=int, default=3, help="runs per decoder (best)")
+    args = parser.parse_args()
+
+    body = stream_body(args.tokens)
+    # Warm up imports and the SDK's lazily built models
+    for fast in (False, True):
+        await run(body, args.tokens, fast)
+    results = {}
+    for fast in (False, True):
+        results[fast] = min(
+            [await run(body, args.tokens, fast) for _ in range(args.runs)]
+        )
+        label = "fast path" if fast else "SDK"
+        print(
+            f"{label:>9}: {results[fast] * 1e6 / args.tokens:5.1f} us CPU per token "
+            f"({args.tokens / results[fast]:,.0f} tokens/s per core)"
+        )
+    print(f"fast path uses {results[False] / results[True]:.1f}x less CPU per token")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,166 @@
+"""Consistency checks for the channel memory index (llmcord.memory).
+
+Checks that a message deleted or edited while its batch is being embedded doesn't stay
+recallable (or keep its old text), and that an append failing partway doesn't pair
+later rows with other messages' vectors. Embeddings come from the fake provider's
+hashed bag-of-words, so nothing is contacted.
+
+    uv run --extra memory python scripts/check_memory.py
+
+Exits non-zero if any check fails.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import builtins
+import sys
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
+
+import numpy as np
+
+from llmcord import memory
+from llmcord.fakes import FakeOpenAI
+
+GUILD_ID, CHANNEL_ID = 1, 10
+EMBED_SECONDS = 0.2
+
+
+def embed(texts: list[str]) -> np.ndarray:
+    vectors = np.array([FakeOpenAI.embed(text) for text in texts], dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+class SlowMemory(memory.ChannelMemory):
+    """Channel memory whose embeddings call takes EMBED_SECONDS."""
+
+    async def _embed(self, texts: list[str]) -> Any:
+        await asyncio.sleep(EMBED_SECONDS)
+        return embed(texts)
+
+
+def message(msg_id: int, text: str) -> SimpleNamespace:
+    author = SimpleNamespace(id=100, roles=[], display_name="user", bot=False)
+    return SimpleNamespace(
+        id=msg_id,
+        guild=SimpleNamespace(id=GUILD_ID),
+        channel=SimpleNamespace(id=CHANNEL_ID, parent_id=None, category_id=None),
+        author=author,
+        content=text,
+        clean_content=text,
+    )
+
+
+def live_rows(index: memory.GuildIndex) -> list[tuple[int, str]]:
+    index.refresh()
+    if index._rows is None:
+        return []
+    return [
+        index.row(row)
+        for row in np.flatnonzero(np.asarray(index._rows["deleted"]) == 0)
+    ]
+
+
+async def check_forget_during_embed(state_dir: Path) -> list[str]:
+    channel_memory = SlowMemory()
+    channel_memory.configure(
+        dict(
+            memory=dict(enabled=True, batch_size=3, flush_seconds=0),
+            state_dir=str(state_dir),
+            providers={},
+            permissions=dict(
+                users=dict(admin_ids=[], allowed_ids=[], blocked_ids=[]),
+                roles=dict(admin_ids=[], allowed_ids=[], blocked_ids=[]),
+                channels=dict(allowed_ids=[], blocked_ids=[]),
+            ),
+        )
+    )
+    for msg_id, text in (
+        (1, "deleted while embedding, must not be recalled"),
+        (2, "edited while embedding, this is the old text"),
+        (3, "untouched message that stays indexed"),
+    ):
+        channel_memory.observe(message(msg_id, text))
+
+    # Once the batch is taken off the queue and waiting on the embeddings call
+    await asyncio.sleep(EMBED_SECONDS / 2)
+    await channel_memory.forget(1, GUILD_ID)
+    await channel_memory.forget(2, GUILD_ID)
+    channel_memory.observe(message(2, "edited while embedding, this is the new text"))
+    while (
+        channel_memory._flush_task is not None and not channel_memory._flush_task.done()
+    ):
+        await channel_memory._flush_task
+
+    rows = live_rows(channel_memory.index(GUILD_ID))
+    expected = [
+        (3, "user: untouched message that stays indexed"),
+        (2, "user: edited while embedding, this is the new text"),
+    ]
+    if sorted(rows) != sorted(expected):
+        return [f"forget during embedding: indexed {rows}, expected {expected}"]
+    return []
+
+
+def check_failed_append(state_dir: Path) -> list[str]:
+    index = memory.GuildIndex(
+        state_dir / "failed-append", model="fake", dtype="float32"
+    )
+    batches = [
+        ["first batch one", "first batch two"],
+        ["lost batch one", "lost batch two"],
+        ["third batch one", "third batch two"],
+    ]
+
+    def append(texts: list[str], msg_id: int) -> None:
+        index.append(
+            embed(texts),
+            [(msg_id + i, CHANNEL_ID, 100, text) for i, text in enumerate(texts)],
+        )
+
+    append(batches[0], 1)
+
+    # The records of the second batch fail to write after its vectors were
+    real_open = builtins.open
+
+    def failing_open(file: Any, mode: str = "r", *args: Any, **kwargs: Any) -> Any:
+        if Path(file).name == "rows.bin" and mode == "ab":
+            raise OSError("No space left on device")
+        return real_open(file, mode, *args, **kwargs)
+
+    memory.open = failing_open  # type: ignore[attr-defined]
+    try:
+        append(batches[1], 3)
+    except OSError:
+        pass
+    finally:
+        del memory.open  # type: ignore[attr-defined]
+    append(batches[2], 5)
+
+    failures: list[str] = []
+    index.refresh()
+    assert index._vectors is not None
+    for row, (msg_id, text) in enumerate(live_rows(index)):
+        if not np.allclose(index._vectors[row], embed([text])[0]):
+            failures.append(f"failed append: row {row} ({text!r}) has another vector")
+    texts = [text for _, text in live_rows(index)]
+    if texts != batches[0] + batches[2]:
+        failures.append(f"failed append: indexed {texts}")
+    return failures
+
+
+async def main() -> int:
+    with tempfile.TemporaryDirectory() as state_dir:
+        failures = await check_forget_during_embed(Path(state_dir))
+        failures += check_failed_append(Path(state_dir))
+    for failure in failures:
+        print(f"FAIL {failure}")
+    print("memory index checks " + ("failed" if failures else "passed"))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
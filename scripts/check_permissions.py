@@ -0,0 +1,309 @@
+"""Permission matrix and micro-benchmark for llmcord.auth.
+
+Checks is_authorized, is_admin and is_channel_allowed against hand-written expected
+outcomes (admin/allowed/blocked users and roles, allowed/blocked channels with their
+threads and categories, DMs with and without allow_dms), checks that compiled policies
+are cached per config object, then times authorization against large ID lists.
+
+    uv run python scripts/check_permissions.py [--ids 100000] [--lookups 100000]
+
+Exits non-zero if any check fails.
+"""
+
+from __future__ import annotations
+
+import argparse
+import copy
+import sys
+import time
+from types import SimpleNamespace
+from typing import Any
+
+from llmcord import auth
+
+ADMIN, ALLOWED, BLOCKED, NOBODY = 1, 2, 3, 9
+ADMIN_ROLE, ALLOWED_ROLE, BLOCKED_ROLE = 10, 20, 30
+ALLOWED_CHANNEL, BLOCKED_CHANNEL, ALLOWED_CATEGORY = 100, 101, 200
+
+
+def make_config(
+    *,
+    users: tuple[list[int], list[int], list[int]] = ([], [], []),
+    roles: tuple[list[int], list[int], list[int]] = ([], [], []),
+    channels: tuple[list[int], list[int]] = ([], []),
+    allow_dms: bool = True,
+) -> dict[str, Any]:
+    """A config with (admin, allowed, blocked) users and roles, (allowed, blocked) channels."""
+    return dict(
+        allow_dms=allow_dms,
+        permissions=dict(
+            users=dict(admin_ids=users[0], allowed_ids=users[1], blocked_ids=users[2]),
+            roles=dict(admin_ids=roles[0], allowed_ids=roles[1], blocked_ids=roles[2]),
+            channels=dict(allowed_ids=channels[0], blocked_ids=channels[1]),
+        ),
+    )
+
+
+RESTRICTED = make_config(
+    users=([ADMIN], [ALLOWED], [BLOCKED]),
+    roles=([ADMIN_ROLE], [ALLOWED_ROLE], [BLOCKED_ROLE]),
+    channels=([ALLOWED_CHANNEL, ALLOWED_CATEGORY], [BLOCKED_CHANNEL]),
+)
+RESTRICTED_NO_DMS = RESTRICTED | dict(allow_dms=False)
+OPEN = make_config()
+OPEN_NO_DMS = make_config(allow_dms=False)
+OPEN_WITH_BLOCKS = make_config(
+    users=([], [], [BLOCKED]),
+    roles=([], [], [BLOCKED_ROLE]),
+    channels=([], [BLOCKED_CHANNEL]),
+)
+
+
+def user(user_id: int, *role_ids: int) -> SimpleNamespace:
+    return SimpleNamespace(id=user_id, roles=[SimpleNamespace(id=r) for r in role_ids])
+
+
+def channel(
+    channel_id: int, *, parent_id: int | None = None, category_id: int | None = None
+) -> SimpleNamespace:
+    return SimpleNamespace(id=channel_id, parent_id=parent_id, category_id=category_id)
+
+
+DM = channel(500)
+LISTED = channel(ALLOWED_CHANNEL)
+THREAD_IN_LISTED = channel(103, parent_id=ALLOWED_CHANNEL)
+IN_LISTED_CATEGORY = channel(102, category_id=ALLOWED_CATEGORY)
+UNLISTED = channel(104)
+BLOCKED_IN_LISTED_CATEGORY = channel(BLOCKED_CHANNEL, category_id=ALLOWED_CATEGORY)
+THREAD_IN_BLOCKED = channel(105, parent_id=BLOCKED_CHANNEL)
+
+# (case, config, user, channel, is_dm, expected is_authorized)
+AUTHORIZATION_MATRIX: list[tuple[str, dict[str, Any], Any, Any, bool, bool]] = [
+    # Users and roles in a listed channel
+    ("admin user", RESTRICTED, user(ADMIN), LISTED, False, True),
+    ("admin role", RESTRICTED, user(NOBODY, ADMIN_ROLE), LISTED, False, True),
+    ("allowed user", RESTRICTED, user(ALLOWED), LISTED, False, True),
+    ("allowed role", RESTRICTED, user(NOBODY, ALLOWED_ROLE), LISTED, False, True),
+    ("blocked user", RESTRICTED, user(BLOCKED), LISTED, False, False),
+    ("blocked role", RESTRICTED, user(NOBODY, BLOCKED_ROLE), LISTED, False, False),
+    (
+        "allowed and blocked role",
+        RESTRICTED,
+        user(NOBODY, ALLOWED_ROLE, BLOCKED_ROLE),
+        LISTED,
+        False,
+        False,
+    ),
+    ("unlisted user", RESTRICTED, user(NOBODY), LISTED, False, False),
+    # Channels, threads and categories
+    (
+        "thread of listed channel",
+        RESTRICTED,
+        user(ALLOWED),
+        THREAD_IN_LISTED,
+        False,
+        True,
+    ),
+    (
+        "channel in listed category",
+        RESTRICTED,
+        user(ALLOWED),
+        IN_LISTED_CATEGORY,
+        False,
+        True,
+    ),
+    ("unlisted channel", RESTRICTED, user(ALLOWED), UNLISTED, False, False),
+    ("admin in unlisted channel", RESTRICTED, user(ADMIN), UNLISTED, False, False),
+    (
+        "blocked channel in listed category",
+        RESTRICTED,
+        user(ADMIN),
+        BLOCKED_IN_LISTED_CATEGORY,
+        False,
+        False,
+    ),
+    # DMs
+    ("DM: admin user", RESTRICTED, user(ADMIN), DM, True, True),
+    ("DM: allowed user", RESTRICTED, user(ALLOWED), DM, True, True),
+    ("DM: blocked user", RESTRICTED, user(BLOCKED), DM, True, False),
+    ("DM: unlisted user", RESTRICTED, user(NOBODY), DM, True, False),
+    ("DM off: admin user", RESTRICTED_NO_DMS, user(ADMIN), DM, True, True),
+    ("DM off: allowed user", RESTRICTED_NO_DMS, user(ALLOWED), DM, True, False),
+    # No allow lists
+    ("open: anyone", OPEN, user(NOBODY), UNLISTED, False, True),
+    ("open: DM", OPEN, user(NOBODY), DM, True, True),
+    ("open, DM off: DM", OPEN_NO_DMS, user(NOBODY), DM, True, False),
+    ("open: blocked user", OPEN_WITH_BLOCKS, user(BLOCKED), UNLISTED, False, False),
+    (
+        "open: blocked role",
+        OPEN_WITH_BLOCKS,
+        user(NOBODY, BLOCKED_ROLE),
+        UNLISTED,
+        False,
+        False,
+    ),
+    (
+        "open: blocked channel",
+        OPEN_WITH_BLOCKS,
+        user(NOBODY),
+        channel(BLOCKED_CHANNEL),
+        False,
+        False,
+    ),
+    (
+        "open: thread of blocked channel",
+        OPEN_WITH_BLOCKS,
+        user(NOBODY),
+        THREAD_IN_BLOCKED,
+        False,
+        False,
+    ),
+    ("open: blocked user in DM", OPEN_WITH_BLOCKS, user(BLOCKED), DM, True, False),
+]
+
+# (case, config, user, expected is_admin)
+ADMIN_MATRIX: list[tuple[str, dict[str, Any], Any, bool]] = [
+    ("admin user", RESTRICTED, user(ADMIN), True),
+    ("admin role", RESTRICTED, user(NOBODY, ADMIN_ROLE), True),
+    ("allowed user", RESTRICTED, user(ALLOWED, ALLOWED_ROLE), False),
+    ("user without roles (DM)", RESTRICTED, SimpleNamespace(id=NOBODY), False),
+    ("no admins", OPEN, user(ADMIN, ADMIN_ROLE), False),
+]
+
+# (case, config, channel, is_dm, expected is_channel_allowed)
+CHANNEL_MATRIX: list[tuple[str, dict[str, Any], Any, bool, bool]] = [
+    ("listed channel", RESTRICTED, LISTED, False, True),
+    ("thread of listed channel", RESTRICTED, THREAD_IN_LISTED, False, True),
+    ("unlisted channel", RESTRICTED, UNLISTED, False, False),
+    (
+        "blocked channel in listed category",
+        RESTRICTED,
+        BLOCKED_IN_LISTED_CATEGORY,
+        False,
+        False,
+    ),
+    ("DM", RESTRICTED, DM, True, True),
+    ("DM off, but admins may", RESTRICTED_NO_DMS, DM, True, True),
+    ("DM off, no admins", OPEN_NO_DMS, DM, True, False),
+    ("open", OPEN, UNLISTED, False, True),
+    ("open: blocked channel", OPEN_WITH_BLOCKS, channel(BLOCKED_CHANNEL), False, False),
+]
+
+
+def check_matrix() -> list[str]:
+    failures: list[str] = []
+    for case, config, who, where, is_dm, expected in AUTHORIZATION_MATRIX:
+        # Twice: the second answer comes from the policy's decision cache
+        for attempt in ("", " (cached)"):
+            got = auth.is_user_authorized(
+                user=who, channel=where, config=config, is_dm=is_dm
+            )
+            if got != expected:
+                failures.append(
+                    f"is_authorized: {case}{attempt}: got {got}, expected {expected}"
+                )
+    for case, config, who, expected in ADMIN_MATRIX:
+        if (got := auth.is_admin(who, config)) != expected:
+            failures.append(f"is_admin: {case}: got {got}, expected {expected}")
+    for case, config, where, is_dm, expected in CHANNEL_MATRIX:
+        got = auth.is_channel_allowed(channel=where, config=config, is_dm=is_dm)
+        if got != expected:
+            failures.append(
+                f"is_channel_allowed: {case}: got {got}, expected {expected}"
+            )
+    return failures
+
+
+def check_policy_cache() -> list[str]:
+    failures: list[str] = []
+    config = copy.deepcopy(RESTRICTED)
+    policy = auth.get_policy(config)
+    if auth.get_policy(config) is not policy:
+        failures.append("policy cache: the same config object rebuilt its policy")
+
+    # A reload yields a new config object with its own policy
+    reloaded = copy.deepcopy(RESTRICTED)
+    reloaded["permissions"]["users"]["blocked_ids"] = [ALLOWED]
+    if auth.get_policy(reloaded) is policy:
+        failures.append("policy cache: a new config object reused the old policy")
+    if auth.is_user_authorized(
+        user=user(ALLOWED), channel=LISTED, config=reloaded, is_dm=False
+    ):
+        failures.append("policy cache: the reloaded config's block list was ignored")
+
+    # Holders of the previous config keep its policy while the new one is in use
+    if auth.get_policy(config) is not policy:
+        failures.append(
+            "policy cache: alternating between two configs rebuilt the policy"
+        )
+    return failures
+
+
+def benchmark(id_count: int, lookups: int) -> None:
+    config = make_config(
+        users=(
+            list(range(1, 51)),
+            list(range(1, id_count + 1)),
+            list(range(id_count, 2 * id_count)),
+        ),
+        roles=(
+            [],
+            list(range(1, id_count // 2 + 1)),
+            list(range(id_count, id_count + id_count // 2)),
+        ),
+        channels=(
+            list(range(1, id_count // 2 + 1)),
+            list(range(id_count, id_count + id_count // 2)),
+        ),
+    )
+    # Every lookup a new (user, roles, channel) key, so each is evaluated
+    members = [user(i % id_count + 1, i % 7 + 1, i % 11 + 1) for i in range(lookups)]
+    channels = [channel(i % 1000 + 1, category_id=1) for i in range(lookups)]
+    # A few hundred active users in a handful of channels, answered from the cache
+    active = [
+        (user(i % 500 + 1, i % 7 + 1), channel(i % 5 + 1)) for i in range(lookups)
+    ]
+
+    start = time.perf_counter()
+    auth.get_policy(config)
+    compile_s = time.perf_counter() - start
+
+    def run(requests: list[tuple[Any, Any]]) -> float:
+        start = time.perf_counter()
+        for member, where in requests:
+            auth.is_user_authorized(
+                user=member, channel=where, config=config, is_dm=False
+            )
+        return (time.perf_counter() - start) / len(requests)
+
+    uncached_s = run(list(zip(members, channels)))
+    cached_s = run(active)
+    print(
+        f"{id_count} IDs per list: compile {compile_s * 1000:.1f} ms | "
+        f"{lookups} lookups: {uncached_s * 1e6:.2f} us each uncached, "
+        f"{cached_s * 1e6:.2f} us each cached"
+    )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--ids", type=int, default=100_000, help="IDs per allow/block list"
+    )
+    parser.add_argument(
+        "--lookups", type=int, default=100_000, help="authorizations to time"
+    )
+    args = parser.parse_args()
+
+    failures = check_matrix() + check_policy_cache()
+    for failure in failures:
+        print(f"FAIL {failure}")
+    checks = len(AUTHORIZATION_MATRIX) * 2 + len(ADMIN_MATRIX) + len(CHANNEL_MATRIX) + 4
+    print(f"{checks - len(failures)}/{checks} permission checks passed")
+
+    benchmark(args.ids, args.lookups)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())